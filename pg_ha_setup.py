@@ -13,18 +13,36 @@ from __future__ import annotations
 __version__ = "1.0.0"
 
 import argparse
+import contextlib
+import errno
 import functools
 import getpass
+import hashlib
+import http.client
+import json
 import logging
+import math
 import os
 import re
+import selectors
+import shlex
 import shutil
 import socket
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
 import time
+import urllib.request
+import xml.etree.ElementTree as ET
+from abc import ABC, abstractmethod
+from array import array
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dataclasses import dataclass, field
-from datetime import datetime
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 from typing import Any, Callable, Optional
 
@@ -33,6 +51,16 @@ try:
 except ImportError:
     yaml = None
 
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 # -----------------------------------------------------------------------------
 # Constants
 # -----------------------------------------------------------------------------
@@ -45,6 +73,7 @@ HAPROXY_CONFIG = "/etc/haproxy/haproxy.cfg"
 REPLICATION_SLOT_NAME = "patroni"
 REPLICATION_USER = "replicator"
 SUPERUSER = "postgres"
+SEED_SCRIPT = f"{CONFIG_DIR}/pg_ha_setup.py"  # copy Patroni runs as its localbackup create-replica method
 
 # Port definitions with metadata
 PORTS = {
@@ -206,6 +235,15 @@ def setup_logging() -> logging.Logger:
 
 logger = setup_logging()
 
+# Serializes console output from concurrent workers so lines never interleave
+console_lock = threading.Lock()
+
+
+def tagged_print(tag: str, msg: str) -> None:
+    """Print one line prefixed with a stage tag, safe across threads."""
+    with console_lock:
+        print(f"{Colors.DIM}[{tag}]{Colors.RESET} {msg}", flush=True)
+
 
 # -----------------------------------------------------------------------------
 # Configuration Dataclass
@@ -223,7 +261,53 @@ class HAConfig:
     postgres_password: str = ""
     haproxy_port: int = 5000
     read_replica_port: int = 7000
+    read_replica_max_lag: str = ""  # e.g. "16MB": replicas further behind leave the pg_read pool
+    read_fallback_to_leader: bool = True
+
+    # HAProxy sizing: 0 = derive from host cores/memory and pg_max_connections
+    haproxy_maxconn: int = 0
+    haproxy_server_maxconn: int = 0
+    haproxy_nbthread: int = 0
+    haproxy_bufsize: int = 0
+    haproxy_timeout_client: str = "30m"
+    haproxy_timeout_server: str = "30m"
+    haproxy_check_inter: str = "2s"
+    haproxy_check_fastinter: str = "500ms"
+    haproxy_check_downinter: str = "5s"
+
+    # PostgreSQL max_connections (patroni.yml); HAProxy per-server maxconn stays below it
+    pg_max_connections: int = 200
+    # PostgreSQL parameters sized from this host's RAM, CPUs and storage: oltp | olap | mixed | off
+    pg_tuning_profile: str = "off"
+
+    # Benchmark (pgbench): dataset scale, seconds per run, client counts, database and results directory
+    bench_scale: int = 50
+    bench_duration: int = 30
+    bench_clients: list[int] = field(default_factory=lambda: [1, 8, 32])
+    bench_dbname: str = "pgbench"
+    bench_results_dir: str = "/var/lib/pg_ha_setup/benchmarks"
+    failover_trial_pause: int = 30  # seconds between measured failover trials (old leader rejoins)
+    switchover_max_lag: int = 16384  # bytes; planned switchover waits until the candidate is this close
+    switchover_catchup_timeout: int = 60  # seconds to wait for catch-up (and for the leader change)
+    switchover_drain_timeout: float = 5.0  # seconds for HAProxy sessions on the old leader to finish
+    backup_dir: str = "/var/lib/pgsql/backups"
+    backup_source: str = "replica"  # replica (least-lagging, else leader), leader, or a node name
+    backup_format: str = "tar"  # tar or plain
+    backup_compression: str = "server-zstd"  # pg_basebackup --compress spec; none to disable
+    backup_compress_workers: int = 0  # zstd threads; 0 = half this host's CPUs (max 8) for zstd, single-threaded for server-zstd
+    backup_max_rate: str = ""  # pg_basebackup --max-rate, e.g. 100M; empty = unlimited
+    backup_mode: str = "full"  # full or incremental (PostgreSQL 17; sets summarize_wal = on)
+    backup_full_every: int = 7  # incremental: start a new chain after this many backups
+    backup_retention_full: int = 3  # keep this many full backups and their incrementals; 0 = keep all
+    backup_manifest_checksums: str = "SHA256"  # pg_basebackup --manifest-checksums (verification speed)
+    backup_verify_after: bool = True  # verify each new backup in the background at low priority
+    backup_verify_workers: int = 2  # backups / tar archives verified at once
+    replica_seed_from_backup: bool = False  # Patroni create_replica_methods: localbackup, then basebackup
+    replica_seed_backup_dir: str = ""  # local or NFS backup directory to seed from; empty = backup_dir
+    replica_seed_max_age_hours: float = 24.0  # older backups may need WAL the leader has already recycled
+    replica_rebuild_timeout: int = 86400  # rebuild-replica: seconds to wait for the member to stream again
     haproxy_bind: str = "0.0.0.0"
+    haproxy_host: str = ""  # address clients use to reach HAProxy; default haproxy_bind, or current_node_ip if wildcard
     enable_tls: bool = False
     dry_run: bool = False
 
@@ -236,6 +320,222 @@ class HAConfig:
     intellidb_bin_dir: str = "/usr/pgsql-17/bin"
     intellidb_data_dir: str = "/var/lib/intellidb/data"
 
+    # Fleet mode: run setup steps on every node from one host
+    fleet_transport: str = "ssh"
+    fleet_ssh_user: str = "root"
+    fleet_remote_dir: str = "/opt/intellidb-ha"
+    fleet_remote_config: str = "config.yaml"
+    fleet_step_timeout: int = 1800
+
+    # Full automated setup: max steps running at once
+    setup_parallelism: int = 3
+
+    # Health watch (menu 11 / health --watch): snapshots kept in memory
+    health_watch_history: int = 300
+
+    # serve-metrics: Prometheus endpoint; upstreams are scraped at most once per cache interval
+    metrics_bind: str = "0.0.0.0"
+    metrics_port: int = 9188
+    metrics_cache_seconds: float = 5.0
+
+    # Replication lag: failover threshold written to patroni.yml, sampler sizing and report windows (s)
+    maximum_lag_on_failover: int = 1048576
+    lag_sample_capacity: int = 3600
+    lag_report_windows: list[int] = field(default_factory=lambda: [60, 300, 900])
+
+
+# -----------------------------------------------------------------------------
+# Listening Socket Index
+# -----------------------------------------------------------------------------
+@dataclass
+class ListeningSocket:
+    """One listening (TCP) or bound (UDP) socket on this host."""
+
+    proto: str
+    address: str
+    port: int
+    inode: int = 0
+    pid: Optional[int] = None
+    process: str = ""
+
+    @property
+    def is_wildcard(self) -> bool:
+        return self.address in ("0.0.0.0", "::", "*")
+
+    def describe(self) -> str:
+        addr = f"[{self.address}]" if ":" in self.address else self.address
+        owner = f' users:(("{self.process}",pid={self.pid}))' if self.pid else ""
+        return f"{self.proto} {addr}:{self.port}{owner}"
+
+
+class ListeningSocketIndex:
+    """
+    Snapshot of listening sockets keyed by port, built without forking.
+
+    Reads /proc/net/{tcp,tcp6,udp,udp6} once and caches the result for a short
+    TTL so repeated port checks are dict lookups against one snapshot. Owning
+    pid/process are resolved lazily (one /proc/<pid>/fd walk per snapshot),
+    only when a caller asks for them. Falls back to a single `ss -Htulnp`
+    snapshot when /proc/net is unreadable.
+    """
+
+    PROC_TABLES = (
+        ("tcp", "/proc/net/tcp"),
+        ("tcp", "/proc/net/tcp6"),
+        ("udp", "/proc/net/udp"),
+        ("udp", "/proc/net/udp6"),
+    )
+    TCP_LISTEN = "0A"
+    UDP_UNCONN = "07"
+    DEFAULT_TTL = 2.0
+
+    _cached: Optional["ListeningSocketIndex"] = None
+
+    def __init__(self, sockets: list[ListeningSocket], owners_resolved: bool = False):
+        self.created = time.monotonic()
+        self._owners_resolved = owners_resolved
+        self._by_port: dict[int, list[ListeningSocket]] = {}
+        for s in sockets:
+            self._by_port.setdefault(s.port, []).append(s)
+
+    @classmethod
+    def get(cls, ttl: float = DEFAULT_TTL) -> "ListeningSocketIndex":
+        """Return the cached snapshot, rebuilding it when older than ttl seconds."""
+        cached = cls._cached
+        if cached is None or time.monotonic() - cached.created > ttl:
+            cached = cls.build()
+            cls._cached = cached
+        return cached
+
+    @classmethod
+    def invalidate(cls) -> None:
+        cls._cached = None
+
+    @classmethod
+    def build(cls) -> "ListeningSocketIndex":
+        sockets = cls._read_proc_net()
+        if sockets is not None:
+            return cls(sockets)
+        logger.debug("/proc/net unreadable; falling back to one ss snapshot")
+        return cls(cls._read_ss_snapshot(), owners_resolved=True)
+
+    @staticmethod
+    def _decode_proc_addr(hex_addr: str) -> str:
+        """Decode a /proc/net address (host-order 32-bit words) to text form."""
+        raw = bytes.fromhex(hex_addr)
+        if sys.byteorder == "little":
+            raw = b"".join(raw[i:i + 4][::-1] for i in range(0, len(raw), 4))
+        family = socket.AF_INET if len(raw) == 4 else socket.AF_INET6
+        return socket.inet_ntop(family, raw)
+
+    @classmethod
+    def _read_proc_net(cls) -> Optional[list[ListeningSocket]]:
+        sockets: list[ListeningSocket] = []
+        readable = False
+        for proto, path in cls.PROC_TABLES:
+            try:
+                with open(path, "r", encoding="ascii") as f:
+                    lines = f.readlines()[1:]
+            except OSError:
+                continue
+            readable = True
+            wanted = cls.TCP_LISTEN if proto == "tcp" else cls.UDP_UNCONN
+            for line in lines:
+                parts = line.split()
+                if len(parts) < 10 or parts[3] != wanted:
+                    continue
+                local_hex, port_hex = parts[1].split(":")
+                try:
+                    sockets.append(
+                        ListeningSocket(
+                            proto=proto,
+                            address=cls._decode_proc_addr(local_hex),
+                            port=int(port_hex, 16),
+                            inode=int(parts[9]),
+                        )
+                    )
+                except (ValueError, OSError):
+                    continue
+        return sockets if readable else None
+
+    @staticmethod
+    def _read_ss_snapshot() -> list[ListeningSocket]:
+        try:
+            r = subprocess.run(
+                ["ss", "-Htulnp"],
+                capture_output=True,
+                text=True,
+                timeout=10,
+            )
+        except Exception as e:
+            logger.warning("Could not run ss: %s", e)
+            return []
+        sockets = []
+        for line in r.stdout.splitlines() if r.returncode == 0 else []:
+            parts = line.split()
+            if len(parts) < 5:
+                continue
+            addr, _, port_str = parts[4].rpartition(":")
+            if not port_str.isdigit():
+                continue
+            addr = addr.strip("[]").split("%", 1)[0]
+            m = re.search(r'\("([^"]+)",pid=(\d+)', line)
+            sockets.append(
+                ListeningSocket(
+                    proto=parts[0],
+                    address=addr,
+                    port=int(port_str),
+                    pid=int(m.group(2)) if m else None,
+                    process=m.group(1) if m else "",
+                )
+            )
+        return sockets
+
+    def _resolve_owners(self) -> None:
+        """Map socket inodes to pid/process with a single /proc walk."""
+        self._owners_resolved = True
+        pending = {s.inode: s for socks in self._by_port.values() for s in socks if s.inode}
+        if not pending:
+            return
+        try:
+            pids = [p for p in os.listdir("/proc") if p.isdigit()]
+        except OSError:
+            return
+        for pid in pids:
+            fd_dir = f"/proc/{pid}/fd"
+            try:
+                fds = os.listdir(fd_dir)
+            except OSError:
+                continue
+            for fd in fds:
+                try:
+                    target = os.readlink(f"{fd_dir}/{fd}")
+                except OSError:
+                    continue
+                if not target.startswith("socket:["):
+                    continue
+                s = pending.pop(int(target[8:-1]), None)
+                if s is None:
+                    continue
+                s.pid = int(pid)
+                try:
+                    with open(f"/proc/{pid}/comm", "r", encoding="utf-8") as f:
+                        s.process = f.read().strip()
+                except OSError:
+                    pass
+            if not pending:
+                return
+
+    def lookup(self, port: int, with_owner: bool = False) -> list[ListeningSocket]:
+        """Return sockets bound to port (empty list when free)."""
+        socks = self._by_port.get(port, [])
+        if socks and with_owner and not self._owners_resolved:
+            self._resolve_owners()
+        return socks
+
+    def ports(self) -> dict[int, list[ListeningSocket]]:
+        return dict(self._by_port)
+
 
 # -----------------------------------------------------------------------------
 # Port Validation
@@ -271,22 +571,15 @@ class PortValidator:
     @staticmethod
     def check_port_conflict(port: int) -> tuple[bool, str]:
         """Check if port has conflict. Returns (has_conflict, message)."""
-        output = PortValidator.get_listening_services()
-        # ss output: *:5432 or 0.0.0.0:5432 or 127.0.0.1:5432 or :::5432
-        for line in output.splitlines():
-            # Match port as separate number (avoid 5432 matching 15432)
-            if re.search(rf"(?<![0-9]){port}(?![0-9])", line) and ("LISTEN" in line or ":" in line):
-                return True, f"Port {port} in use: {line.strip()}"
+        socks = ListeningSocketIndex.get().lookup(port, with_owner=True)
+        if socks:
+            return True, f"Port {port} in use: " + "; ".join(s.describe() for s in socks)
         return False, ""
 
     @staticmethod
     def is_listening_on_all_interfaces(port: int) -> bool:
-        """Check if port listens on 0.0.0.0 (all interfaces)."""
-        output = PortValidator.get_listening_services()
-        for line in output.splitlines():
-            if re.search(rf"(?<![0-9]){port}(?![0-9])", line) and (":" in line or "*" in line):
-                return "*" in line or "0.0.0.0" in line or ":::" in line
-        return False
+        """Check if port listens on 0.0.0.0 / :: (all interfaces)."""
+        return any(s.is_wildcard for s in ListeningSocketIndex.get().lookup(port))
 
     @staticmethod
     def validate_connectivity(host: str, port: int, timeout: float = 2.0) -> bool:
@@ -300,6 +593,267 @@ class PortValidator:
             return False
 
 
+# -----------------------------------------------------------------------------
+# Concurrent Connectivity Probe
+# -----------------------------------------------------------------------------
+@dataclass
+class ProbeResult:
+    """Connect results for one (node, port) target; error is set only if no attempt connected."""
+
+    node: str
+    host: str
+    port: int
+    description: str = ""
+    attempts: int = 0
+    rtts_ms: list[float] = field(default_factory=list)
+    error: str = ""
+
+    @property
+    def ok(self) -> bool:
+        return bool(self.rtts_ms)
+
+    @property
+    def lost(self) -> int:
+        """Attempts that failed after (or before) a successful connect."""
+        return self.attempts - len(self.rtts_ms)
+
+    def fail(self, error: str) -> None:
+        if not self.rtts_ms:
+            self.error = error
+
+    @property
+    def rtt_min(self) -> Optional[float]:
+        return min(self.rtts_ms) if self.rtts_ms else None
+
+    @property
+    def rtt_avg(self) -> Optional[float]:
+        return sum(self.rtts_ms) / len(self.rtts_ms) if self.rtts_ms else None
+
+    @property
+    def rtt_max(self) -> Optional[float]:
+        return max(self.rtts_ms) if self.rtts_ms else None
+
+    def to_dict(self) -> dict[str, Any]:
+        def _r(v: Optional[float]) -> Optional[float]:
+            return round(v, 3) if v is not None else None
+
+        return {
+            "node": self.node,
+            "host": self.host,
+            "port": self.port,
+            "description": self.description,
+            "ok": self.ok,
+            "attempts": self.attempts,
+            "successes": len(self.rtts_ms),
+            "lost": self.lost,
+            "rtt_ms": {"min": _r(self.rtt_min), "avg": _r(self.rtt_avg), "max": _r(self.rtt_max)},
+            "error": self.error,
+        }
+
+
+class ConnectivityProbe:
+    """
+    Non-blocking TCP connect prober.
+
+    Every target is connected at once with selectors; rounds are repeated
+    `attempts` times to measure connect RTT. Targets that time out are not
+    retried, so total wall time is bounded by roughly one connect timeout
+    plus the RTT rounds, and never exceeds `deadline`.
+    """
+
+    def __init__(self, attempts: int = 3, timeout: float = 2.0, deadline: float = 5.0):
+        self.attempts = max(1, attempts)
+        self.timeout = timeout
+        self.deadline = deadline
+
+    @staticmethod
+    def _resolve(host: str, port: int) -> tuple[int, tuple]:
+        family, _, _, _, addr = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+        return family, addr
+
+    def _round(self, targets: list[ProbeResult], budget: float) -> None:
+        """Start one connect per target and wait for all of them (or budget)."""
+        sel = selectors.DefaultSelector()
+        started: dict[socket.socket, tuple[ProbeResult, float]] = {}
+        try:
+            for res in targets:
+                res.attempts += 1
+                try:
+                    family, addr = self._resolve(res.host, res.port)
+                except (socket.gaierror, OSError) as e:
+                    res.fail(f"resolve: {e}")
+                    continue
+                s = socket.socket(family, socket.SOCK_STREAM)
+                s.setblocking(False)
+                t0 = time.perf_counter()
+                rc = s.connect_ex(addr)
+                if rc not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    res.fail(os.strerror(rc))
+                    s.close()
+                    continue
+                started[s] = (res, t0)
+                sel.register(s, selectors.EVENT_WRITE)
+
+            end = time.perf_counter() + budget
+            while started:
+                remaining = end - time.perf_counter()
+                if remaining <= 0:
+                    break
+                for key, _ in sel.select(remaining):
+                    s = key.fileobj
+                    res, t0 = started.pop(s)
+                    elapsed_ms = (time.perf_counter() - t0) * 1000.0
+                    sel.unregister(s)
+                    err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err == 0:
+                        res.rtts_ms.append(elapsed_ms)
+                    else:
+                        res.fail(os.strerror(err))
+                    s.close()
+            for s, (res, _) in started.items():
+                res.fail("timeout")
+                s.close()
+        finally:
+            sel.close()
+
+    def probe(self, targets: list[tuple[str, str, int, str]]) -> list[ProbeResult]:
+        """Probe (node, host, port, description) targets; returns results in input order."""
+        results = [ProbeResult(node=n, host=h, port=p, description=d) for n, h, p, d in targets]
+        start = time.perf_counter()
+        pending = list(results)
+        for _ in range(self.attempts):
+            remaining = self.deadline - (time.perf_counter() - start)
+            if not pending or remaining <= 0:
+                break
+            self._round(pending, min(self.timeout, remaining))
+            # Failed connects may already have cost a full timeout; only re-measure targets
+            # that have answered every attempt so far.
+            pending = [r for r in pending if r.ok and not r.lost]
+        return results
+
+
+# -----------------------------------------------------------------------------
+# Firewalld State Reader
+# -----------------------------------------------------------------------------
+@dataclass
+class FirewallState:
+    """Permanent firewalld configuration of one zone."""
+
+    zone: str
+    source: str
+    ports: set[str] = field(default_factory=set)
+    services: list[str] = field(default_factory=list)
+    service_ports: dict[str, set[str]] = field(default_factory=dict)
+    rich_rules: list[str] = field(default_factory=list)
+
+    def open_specs(self) -> set[str]:
+        """Explicit ports plus the ports of every enabled service."""
+        specs = set(self.ports)
+        for svc_ports in self.service_ports.values():
+            specs |= svc_ports
+        return specs
+
+
+class FirewalldStateReader:
+    """
+    Read firewalld permanent state straight from its XML configuration.
+
+    firewall-cmd is a Python program with a slow start-up; the permanent
+    configuration it reports lives in /etc/firewalld (admin overrides) and
+    /usr/lib/firewalld (shipped defaults), so read-only checks parse those
+    files instead. read() returns None when they cannot be read.
+    """
+
+    ETC_DIR = "/etc/firewalld"
+    LIB_DIR = "/usr/lib/firewalld"
+
+    def __init__(self, etc_dir: str = ETC_DIR, lib_dir: str = LIB_DIR):
+        self.etc_dir = etc_dir
+        self.lib_dir = lib_dir
+
+    def default_zone(self) -> Optional[str]:
+        try:
+            with open(f"{self.etc_dir}/firewalld.conf", "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line.startswith("DefaultZone="):
+                        return line.split("=", 1)[1].strip().strip('"') or None
+        except OSError:
+            return None
+        return None
+
+    def _load(self, kind: str, name: str) -> Optional[ET.Element]:
+        """Parse <kind>/<name>.xml, preferring /etc over /usr/lib."""
+        for base in (self.etc_dir, self.lib_dir):
+            path = f"{base}/{kind}/{name}.xml"
+            try:
+                return ET.parse(path).getroot()
+            except FileNotFoundError:
+                continue
+            except (OSError, ET.ParseError) as e:
+                logger.debug("Could not parse %s: %s", path, e)
+                return None
+        return None
+
+    @staticmethod
+    def _port_specs(elem: ET.Element) -> set[str]:
+        return {
+            f"{p.get('port')}/{p.get('protocol')}"
+            for p in elem.findall("port")
+            if p.get("port") and p.get("protocol")
+        }
+
+    def service_ports(self, name: str, _seen: Optional[set[str]] = None) -> set[str]:
+        """Ports of a firewalld service, following <include service=.../>."""
+        seen = _seen if _seen is not None else set()
+        if name in seen:
+            return set()
+        seen.add(name)
+        root = self._load("services", name)
+        if root is None:
+            return set()
+        specs = self._port_specs(root)
+        for inc in root.findall("include"):
+            if inc.get("service"):
+                specs |= self.service_ports(inc.get("service"), seen)
+        return specs
+
+    @staticmethod
+    def _rich_rule_text(rule: ET.Element) -> str:
+        """Render a <rule> element in firewall-cmd --list-rich-rules syntax."""
+
+        def _attrs(e: ET.Element) -> str:
+            return "".join(f' {k}="{v}"' for k, v in e.attrib.items() if k != "invert")
+
+        parts = ["rule" + _attrs(rule)]
+        for child in rule:
+            text = child.tag
+            if child.get("invert") == "True":
+                text += " NOT"
+            text += _attrs(child)
+            for sub in child:
+                text += f" {sub.tag}" + _attrs(sub)
+            parts.append(text)
+        return " ".join(parts)
+
+    def read(self, zone: Optional[str] = None) -> Optional[FirewallState]:
+        zone = zone or self.default_zone()
+        if not zone:
+            return None
+        root = self._load("zones", zone)
+        if root is None:
+            return None
+        services = [s.get("name") for s in root.findall("service") if s.get("name")]
+        return FirewallState(
+            zone=zone,
+            source="xml",
+            ports=self._port_specs(root),
+            services=services,
+            service_ports={svc: self.service_ports(svc) for svc in services},
+            rich_rules=[self._rich_rule_text(r) for r in root.findall("rule")],
+        )
+
+
 # -----------------------------------------------------------------------------
 # Firewall Manager
 # -----------------------------------------------------------------------------
@@ -350,16 +904,8 @@ class FirewallManager:
             return False
 
     def add_port(self, port: int, protocol: str = "tcp") -> bool:
-        """Add port to firewall permanently and reload."""
-        ok, msg = self._run_firewall_cmd("--permanent", f"--add-port={port}/{protocol}")
-        if not ok:
-            logger.error("Failed to add port %s: %s", port, msg)
-            return False
-        ok2, msg2 = self._run_firewall_cmd("--reload")
-        if not ok2:
-            logger.error("Failed to reload firewall: %s", msg2)
-            return False
-        return True
+        """Add port to firewall permanently and reload (no-op if already open)."""
+        return self.open_ports([port], protocol)
 
     def remove_port(self, port: int, protocol: str = "tcp") -> bool:
         """Remove port from firewall."""
@@ -367,47 +913,125 @@ class FirewallManager:
         self._run_firewall_cmd("--reload")
         return True
 
+    def get_state(self) -> FirewallState:
+        """
+        Permanent state of the default zone.
+
+        Parsed from the firewalld XML files; firewall-cmd --list-all is only
+        spawned when those files are unreadable.
+        """
+        state = FirewalldStateReader().read()
+        if state is not None:
+            return state
+        logger.debug("firewalld XML unreadable; falling back to firewall-cmd")
+        state = FirewallState(zone="", source="firewall-cmd")
+        ok, out = self._run_firewall_cmd("--permanent", "--list-all")
+        if not ok or self.dry_run:
+            return state
+        in_rich = False
+        for line in out.splitlines():
+            stripped = line.strip()
+            if in_rich and line.startswith(("\t", "        ")) and stripped.startswith("rule"):
+                state.rich_rules.append(stripped)
+                continue
+            in_rich = False
+            key, sep, value = stripped.partition(":")
+            if not sep:
+                if stripped and not state.zone:
+                    state.zone = stripped.split()[0]
+                continue
+            if key == "ports":
+                state.ports = {p for p in value.split() if "/" in p}
+            elif key == "services":
+                state.services = value.split()
+            elif key == "rich rules":
+                in_rich = True
+        reader = FirewalldStateReader()
+        state.service_ports = {svc: reader.service_ports(svc) for svc in state.services}
+        return state
+
+    def get_permanent_port_specs(self) -> set[str]:
+        """Permanently open port specs of the default zone, e.g. {'5432/tcp', '6000-6010/tcp'}."""
+        return set(self.get_state().ports)
+
+    @staticmethod
+    def _port_covered(port: int, protocol: str, specs: set[str]) -> bool:
+        """True if port/protocol is in specs, including port ranges like 6000-6010/tcp."""
+        for spec in specs:
+            port_part, _, proto = spec.partition("/")
+            if proto != protocol:
+                continue
+            lo, _, hi = port_part.partition("-")
+            try:
+                if int(lo) <= port <= int(hi or lo):
+                    return True
+            except ValueError:
+                continue
+        return False
+
     def get_permanent_ports(self) -> list[int]:
         """List permanently open ports."""
-        ok, out = self._run_firewall_cmd("--permanent", "--list-ports")
-        if not ok:
-            return []
         ports = []
-        for p in out.split():
-            if "/" in p:
-                port_str = p.split("/")[0]
-                try:
-                    ports.append(int(port_str))
-                except ValueError:
-                    pass
+        for p in self.get_permanent_port_specs():
+            port_str = p.split("/")[0]
+            try:
+                ports.append(int(port_str))
+            except ValueError:
+                pass
         return ports
 
-    def open_required_ports(self) -> bool:
-        """Open all required HA stack ports."""
-        db_port = self._db_port()
-        required = [db_port, 8008, 2379, 2380, self.config.haproxy_port]
+    def required_ports(self) -> list[int]:
+        """Ports the HA stack needs open on this node."""
+        required = [self._db_port(), 8008, 2379, 2380, self.config.haproxy_port]
         if self.config.read_replica_port and self.config.read_replica_port != 5432:
             required.append(self.config.read_replica_port)
-        required = list(dict.fromkeys(required))
+        return list(dict.fromkeys(required))
+
+    def open_ports(self, ports: list[int], protocol: str = "tcp") -> bool:
+        """
+        Open ports as one firewalld transaction.
+
+        Diffs against the permanent configuration, adds only the missing ports
+        in a single firewall-cmd call and reloads once. When nothing is
+        missing, firewalld is not touched at all.
+        """
+        current = self.get_state().open_specs()
+        missing = [p for p in dict.fromkeys(ports) if not self._port_covered(p, protocol, current)]
+        for p in ports:
+            if p not in missing:
+                logger.info("Port %s/%s already open", p, protocol)
+        if not missing:
+            return True
+
+        ok, msg = self._run_firewall_cmd("--permanent", *(f"--add-port={p}/{protocol}" for p in missing))
+        if not ok:
+            logger.error("Failed to add ports %s: %s", missing, msg)
+            return False
+        ok2, msg2 = self._run_firewall_cmd("--reload")
+        if not ok2:
+            logger.error("Failed to reload firewall: %s", msg2)
+            return False
+        for p in missing:
+            logger.info("Opened port %s/%s", p, protocol)
+        return True
 
+    def open_required_ports(self) -> bool:
+        """Open all required HA stack ports."""
         if not self.is_firewalld_running():
             logger.error("firewalld is not running. Start with: systemctl start firewalld")
             return False
+        return self.open_ports(self.required_ports())
 
-        all_ok = True
-        for port in required:
-            if self.add_port(port):
-                logger.info("Opened port %s", port)
-            else:
-                all_ok = False
-        return all_ok
-
-    def verify_ports_open(self, ports: Optional[list[int]] = None) -> dict[int, bool]:
-        """Verify which ports are in permanent firewall rules."""
+    def verify_ports_open(
+        self,
+        ports: Optional[list[int]] = None,
+        state: Optional[FirewallState] = None,
+    ) -> dict[int, bool]:
+        """Verify which ports are in permanent firewall rules (explicit ports or enabled services)."""
         if ports is None:
             ports = [self._db_port(), 8008, 2379, 2380, self.config.haproxy_port]
-        permanent = set(self.get_permanent_ports())
-        return {p: p in permanent for p in ports}
+        open_specs = (state or self.get_state()).open_specs()
+        return {p: self._port_covered(p, "tcp", open_specs) for p in ports}
 
 
 # -----------------------------------------------------------------------------
@@ -445,113 +1069,2726 @@ class SELinuxHelper:
 
 
 # -----------------------------------------------------------------------------
-# Main HA Setup Class
+# Fleet Execution
 # -----------------------------------------------------------------------------
-class PGHASetup:
-    """PostgreSQL HA Setup orchestrator."""
+@dataclass
+class FleetResult:
+    """Outcome of one step on one node."""
+
+    node: str
+    host: str
+    step: str
+    ok: bool
+    returncode: int
+    duration: float
+    output: str = ""
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "node": self.node,
+            "host": self.host,
+            "step": self.step,
+            "ok": self.ok,
+            "returncode": self.returncode,
+            "duration_s": round(self.duration, 3),
+        }
+
+
+class FleetTransport(ABC):
+    """Runs `pg_ha_setup.py step --step <name>` for one node."""
+
+    name = "base"
+
+    def __init__(self, config: HAConfig):
+        self.config = config
 
-    def __init__(self, config: Optional[HAConfig] = None, config_file: Optional[str] = None):
-        self.config = config or HAConfig()
-        if config_file:
-            self._load_yaml_config(config_file)
-        self.firewall = FirewallManager(self.config)
-        self.port_validator = PortValidator()
+    def step_args(self, node: str, step: str) -> list[str]:
+        args = ["--node", node, "step", "--step", step]
+        if self.config.dry_run:
+            args.append("--dry-run")
+        return args
 
-    def _db_port(self) -> int:
-        """Return effective PostgreSQL port (5432 or IntelliDB 5555)."""
-        try:
-            if getattr(self.config, "use_intellidb", False):
-                return int(getattr(self.config, "intellidb_port", 5555))
-        except Exception:
-            pass
-        return 5432
+    @abstractmethod
+    def command(self, node: str, host: str, step: str) -> list[str]:
+        """argv that runs the step for node."""
 
-    def _load_yaml_config(self, path: str) -> None:
-        """Load configuration from YAML file."""
-        if not yaml:
-            logger.warning("PyYAML not installed. Install with: pip install pyyaml")
-            return
-        path_obj = Path(path)
-        if not path_obj.exists():
-            raise FileNotFoundError(f"Configuration file not found: {path}")
+    def run(self, node: str, host: str, step: str, timeout: int) -> FleetResult:
+        cmd = self.command(node, host, step)
+        logger.debug("fleet[%s] %s: %s", self.name, node, " ".join(cmd))
+        t0 = time.monotonic()
         try:
-            with open(path, "r", encoding="utf-8") as f:
-                data = yaml.safe_load(f)
-            if not data:
-                return
-            for key, val in data.items():
-                if hasattr(self.config, key):
-                    setattr(self.config, key, val)
-            self._validate_config()
-            logger.info("Loaded config from %s", path)
-        except FileNotFoundError:
-            raise
-        except Exception as e:
-            logger.error("Failed to load YAML config: %s", e)
-            raise
-
-    def _validate_config(self) -> None:
-        """Validate configuration consistency."""
-        if not isinstance(self.config.etcd_nodes, list) or not isinstance(self.config.etcd_ips, list):
-            raise ValueError("etcd_nodes and etcd_ips must be YAML lists (e.g. [node1, node2, node3])")
-        if len(self.config.etcd_nodes) != len(self.config.etcd_ips):
-            raise ValueError(
-                "etcd_nodes and etcd_ips must have the same length. "
-                f"Got {len(self.config.etcd_nodes)} nodes and {len(self.config.etcd_ips)} IPs."
-            )
-        if self.config.current_node and self.config.current_node not in self.config.etcd_nodes:
-            logger.warning(
-                "current_node '%s' is not in etcd_nodes %s",
-                self.config.current_node,
-                self.config.etcd_nodes,
+            r = subprocess.run(
+                cmd,
+                stdin=subprocess.DEVNULL,
+                capture_output=True,
+                text=True,
+                timeout=timeout,
             )
-        if len(self.config.etcd_nodes) != 3:
-            logger.warning("etcd cluster should have 3 nodes for quorum. Got %d.", len(self.config.etcd_nodes))
+            rc, out = r.returncode, (r.stdout or "") + (r.stderr or "")
+        except subprocess.TimeoutExpired:
+            rc, out = 124, f"Timed out after {timeout}s"
+        except FileNotFoundError as e:
+            rc, out = 127, str(e)
+        return FleetResult(node, host, step, rc == 0, rc, time.monotonic() - t0, out)
+
+
+class SSHTransport(FleetTransport):
+    """Run steps on remote nodes over ssh (key-based, BatchMode)."""
+
+    name = "ssh"
+
+    def command(self, node: str, host: str, step: str) -> list[str]:
+        remote = ["python3", "pg_ha_setup.py", "--config", self.config.fleet_remote_config]
+        remote += self.step_args(node, step)
+        return [
+            "ssh",
+            "-o", "BatchMode=yes",
+            "-o", "ConnectTimeout=10",
+            f"{self.config.fleet_ssh_user}@{host}",
+            f"cd {shlex.quote(self.config.fleet_remote_dir)} && {shlex.join(remote)}",
+        ]
 
-    def _require_root(self) -> bool:
-        """Ensure running as root."""
-        if os.geteuid() != 0:
-            print(Colors.fail("This application must be run as root."))
-            logger.error("Not running as root")
+
+class LocalTransport(FleetTransport):
+    """Run every node's step as a local subprocess; a single-host stand-in for tests."""
+
+    name = "local"
+
+    def __init__(self, config: HAConfig, config_file: Optional[str]):
+        super().__init__(config)
+        self.config_file = config_file
+
+    def command(self, node: str, host: str, step: str) -> list[str]:
+        cmd = [sys.executable, os.path.abspath(__file__)]
+        if self.config_file:
+            cmd += ["--config", self.config_file]
+        return cmd + self.step_args(node, step)
+
+
+def wait_for_etcd_quorum(ips: list[str], timeout: float = 180.0, interval: float = 2.0) -> bool:
+    """Barrier: block until every etcd member reports healthy on :2379/health."""
+    deadline = time.monotonic() + timeout
+    pending = list(ips)
+    while True:
+        still = []
+        for ip in pending:
+            try:
+                with urllib.request.urlopen(f"http://{ip}:2379/health", timeout=2) as resp:
+                    body = json.loads(resp.read().decode() or "{}")
+                if str(body.get("health")).lower() != "true":
+                    still.append(ip)
+            except Exception:
+                still.append(ip)
+        pending = still
+        if not pending:
+            return True
+        if time.monotonic() >= deadline:
+            logger.error("etcd members not healthy after %ss: %s", timeout, pending)
             return False
-        return True
+        time.sleep(interval)
 
-    def _validate_rhel9(self) -> bool:
-        """Validate RHEL 9 (or compatible)."""
+
+# -----------------------------------------------------------------------------
+# Setup Step Scheduler
+# -----------------------------------------------------------------------------
+@dataclass
+class SetupStep:
+    """A node in the setup dependency graph."""
+
+    name: str
+    label: str
+    func: Callable[[], None]
+    deps: tuple[str, ...] = ()
+    exclusive: bool = False  # interactive steps run alone so prompts are not interleaved
+
+
+@dataclass
+class StepRecord:
+    name: str
+    status: str = "pending"  # pending | running | done | failed | skipped | resumed
+    start: float = 0.0
+    duration: float = 0.0
+    error: str = ""
+
+
+class StepScheduler:
+    """
+    Run setup steps as a DAG on a bounded thread pool.
+
+    A step starts as soon as all its dependencies are done; dependents of a
+    failed step are skipped while independent branches continue. Progress is
+    checkpointed to JSON so a failed run can resume from the failed step.
+    """
+
+    def __init__(
+        self,
+        steps: list[SetupStep],
+        max_workers: int = 3,
+        checkpoint_path: Optional[str] = None,
+    ):
+        self.steps = {s.name: s for s in steps}
+        for s in steps:
+            missing = [d for d in s.deps if d not in self.steps]
+            if missing:
+                raise ValueError(f"Step {s.name} depends on unknown step(s) {missing}")
+        self.order = self._topo_order(steps)
+        self.max_workers = max(1, max_workers)
+        self.checkpoint_path = checkpoint_path
+        self.records = {name: StepRecord(name) for name in self.order}
+        self._lock = threading.Lock()
+        self._t0 = 0.0
+
+    @staticmethod
+    def _topo_order(steps: list[SetupStep]) -> list[str]:
+        deps = {s.name: set(s.deps) for s in steps}
+        order: list[str] = []
+        while deps:
+            ready = [n for n, d in deps.items() if not d - set(order)]
+            if not ready:
+                raise ValueError(f"Dependency cycle among steps: {sorted(deps)}")
+            for n in ready:
+                order.append(n)
+                del deps[n]
+        return order
+
+    # -- checkpoint ---------------------------------------------------------
+
+    def load_checkpoint(self) -> Optional[dict[str, Any]]:
+        if not self.checkpoint_path:
+            return None
         try:
-            with open("/etc/os-release", "r", encoding="utf-8") as f:
-                content = f.read()
-            if "rhel" in content.lower() or "centos" in content.lower() or "rocky" in content.lower():
-                if "9" in content or "stream" in content.lower():
-                    return True
-            if "almalinux" in content.lower() and "9" in content:
-                return True
-            logger.warning("OS may not be RHEL 9 compatible. Proceed with caution.")
-            return True  # Allow on other EL9-like
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return data if isinstance(data, dict) and data.get("completed") is not None else None
+
+    def _save_checkpoint(self) -> None:
+        if not self.checkpoint_path:
+            return
+        data = {
+            "updated": datetime.now().isoformat(timespec="seconds"),
+            "completed": {
+                n: round(r.duration, 3) for n, r in self.records.items() if r.status in ("done", "resumed")
+            },
+            "failed": [n for n, r in self.records.items() if r.status == "failed"],
+        }
+        try:
+            os.makedirs(os.path.dirname(self.checkpoint_path), exist_ok=True)
+            tmp = f"{self.checkpoint_path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp, self.checkpoint_path)
+        except OSError as e:
+            logger.warning("Could not write checkpoint %s: %s", self.checkpoint_path, e)
+
+    def clear_checkpoint(self) -> None:
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            try:
+                os.unlink(self.checkpoint_path)
+            except OSError as e:
+                logger.warning("Could not remove checkpoint %s: %s", self.checkpoint_path, e)
+
+    # -- execution ----------------------------------------------------------
+
+    def _execute(self, name: str) -> None:
+        step = self.steps[name]
+        rec = self.records[name]
+        print(f"\n--- {step.label} (started) ---")
+        rec.start = time.monotonic() - self._t0
+        t = time.monotonic()
+        try:
+            step.func()
+            rec.status = "done"
         except Exception as e:
-            logger.error("Could not read os-release: %s", e)
-            return False
+            rec.status = "failed"
+            rec.error = str(e)
+            logger.debug("Setup step %s failed", name, exc_info=True)
+        rec.duration = time.monotonic() - t
+        with self._lock:
+            self._save_checkpoint()
+        if rec.status == "done":
+            print(Colors.success(f"{step.label} done ({rec.duration:.1f}s)"))
+        else:
+            print(Colors.fail(f"{step.label} failed after {rec.duration:.1f}s: {rec.error}"))
+
+    def run(self, resume: bool = False) -> bool:
+        """Run all steps; returns True when every step completed."""
+        if resume:
+            ckpt = self.load_checkpoint() or {}
+            for name, dur in (ckpt.get("completed") or {}).items():
+                if name in self.records:
+                    self.records[name].status = "resumed"
+                    self.records[name].duration = float(dur)
+        self._t0 = time.monotonic()
+        pending = [n for n in self.order if self.records[n].status == "pending"]
+        running: dict[Any, str] = {}
+        finished = ("done", "resumed")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                exclusive_running = any(self.steps[n].exclusive for n in running.values())
+                for name in list(pending):
+                    if exclusive_running:
+                        break
+                    dep_status = [self.records[d].status for d in self.steps[name].deps]
+                    if any(st in ("failed", "skipped") for st in dep_status):
+                        self.records[name].status = "skipped"
+                        pending.remove(name)
+                        print(Colors.warn(f"{self.steps[name].label} skipped (dependency failed)"))
+                        continue
+                    if not all(st in finished for st in dep_status):
+                        continue
+                    if self.steps[name].exclusive:
+                        # Wait for the pool to drain, then run alone
+                        if not running:
+                            pending.remove(name)
+                            self.records[name].status = "running"
+                            running[pool.submit(self._execute, name)] = name
+                        break
+                    if len(running) >= self.max_workers:
+                        break
+                    pending.remove(name)
+                    self.records[name].status = "running"
+                    running[pool.submit(self._execute, name)] = name
+                if not running:
+                    if pending:
+                        # Only reachable if nothing is runnable; never spin
+                        raise RuntimeError(f"Setup scheduler stalled with pending steps {pending}")
+                    continue
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for fut in done:
+                    running.pop(fut)
+        ok = all(r.status in finished for r in self.records.values())
+        if ok:
+            self.clear_checkpoint()
+        return ok
+
+    # -- reporting ----------------------------------------------------------
+
+    def critical_path(self) -> tuple[list[str], float]:
+        """Longest chain of dependent steps by measured duration (this run)."""
+        finish: dict[str, float] = {}
+        prev: dict[str, Optional[str]] = {}
+        for name in self.order:
+            rec = self.records[name]
+            dur = rec.duration if rec.status in ("done", "failed") else 0.0
+            best, best_dep = 0.0, None
+            for d in self.steps[name].deps:
+                if finish[d] > best:
+                    best, best_dep = finish[d], d
+            finish[name] = best + dur
+            prev[name] = best_dep
+        if not finish:
+            return [], 0.0
+        end = max(finish, key=lambda n: finish[n])
+        path = []
+        node: Optional[str] = end
+        while node:
+            path.append(node)
+            node = prev[node]
+        return list(reversed(path)), finish[end]
+
+    def report(self) -> None:
+        wall = time.monotonic() - self._t0
+        print(Colors.header("\nStep timings"))
+        print(f"  {'STEP':<28} {'STATUS':<8} {'START':>8} {'WALL':>8}")
+        for name in self.order:
+            rec = self.records[name]
+            start = f"{rec.start:7.1f}s" if rec.status in ("done", "failed") else "-"
+            dur = f"{rec.duration:7.1f}s" if rec.status != "skipped" else "-"
+            print(f"  {self.steps[name].label:<28} {rec.status:<8} {start:>8} {dur:>8}")
+        busy = sum(r.duration for r in self.records.values() if r.status in ("done", "failed"))
+        path, length = self.critical_path()
+        print(f"\n  Total wall time: {wall:.1f}s (sequential sum {busy:.1f}s)")
+        if path:
+            print(f"  Critical path ({length:.1f}s): " + " -> ".join(self.steps[n].label for n in path))
 
-    def _pkg_manager(self) -> str:
-        """Return package manager command: 'dnf' if available, else 'yum' (for customer sites where dnf is not working)."""
+
+# -----------------------------------------------------------------------------
+# Applied Config State
+# -----------------------------------------------------------------------------
+class AppliedConfigState:
+    """
+    Fingerprints of rendered configs and of the inputs each service last
+    (re)started with, stored as JSON under CONFIG_DIR.
+
+    A config file is rewritten only when its rendered content differs from
+    what is on disk; a service is restarted/reloaded only when the
+    fingerprint of its inputs differs from the one it was last applied with.
+
+    Steps running in parallel each hold their own instance, so save() merges
+    only this instance's updates into the file as it is on disk, under a
+    thread lock plus an flock on a sidecar lock file.
+    """
+
+    PATH = f"{CONFIG_DIR}/applied_state.json"
+    _lock = threading.Lock()
+
+    def __init__(self, path: str = PATH, dry_run: bool = False):
+        self.path = path
+        self.dry_run = dry_run
+        self.data = self._read()
+        self._dirty: dict[str, set[str]] = {"files": set(), "services": set()}
+
+    def _read(self) -> dict[str, Any]:
+        data: dict[str, Any] = {"files": {}, "services": {}}
         try:
-            r = subprocess.run(
-                ["dnf", "--version"],
-                capture_output=True,
-                text=True,
-                timeout=5,
-            )
-            if r.returncode == 0:
-                return "dnf"
-        except (FileNotFoundError, subprocess.TimeoutExpired):
+            with open(self.path, "r", encoding="utf-8") as f:
+                loaded = json.load(f)
+            if isinstance(loaded, dict):
+                data["files"] = dict(loaded.get("files") or {})
+                data["services"] = dict(loaded.get("services") or {})
+        except (OSError, ValueError):
             pass
-        return "yum"
+        return data
 
-    def _run_cmd(
+    @staticmethod
+    def fingerprint(*contents: str) -> str:
+        h = hashlib.sha256()
+        for c in contents:
+            h.update(c.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    @staticmethod
+    def _file_fingerprint(path: str) -> Optional[str]:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return AppliedConfigState.fingerprint(f.read())
+        except (OSError, UnicodeDecodeError):
+            return None
+
+    def write_if_changed(
         self,
-        cmd: list[str],
-        check: bool = True,
-        capture: bool = True,
+        path: str,
+        content: str,
+        mode: Optional[int] = None,
+        validate: Optional[Callable[[str], Optional[str]]] = None,
+    ) -> bool:
+        """
+        Write content to path unless the file already holds it. Returns True if written.
+
+        validate(tmp_path) may return an error message to reject the new content;
+        the existing file is then left untouched and ValueError is raised.
+        """
+        fp = self.fingerprint(content)
+        if self._file_fingerprint(path) == fp:
+            logger.debug("%s unchanged (sha256 %s)", path, fp[:12])
+            return False
+        if self.dry_run:
+            logger.info("[DRY-RUN] Would write %s (changed)", path)
+            return True
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(content)
+        if mode is not None:
+            os.chmod(tmp, mode)
+        if validate is not None:
+            error = validate(tmp)
+            if error:
+                os.unlink(tmp)
+                raise ValueError(error)
+        os.replace(tmp, path)
+        self.data["files"][path] = {"sha256": fp, "applied": datetime.now().isoformat(timespec="seconds")}
+        self._dirty["files"].add(path)
+        self.save()
+        logger.info("Wrote %s", path)
+        return True
+
+    def service_current(self, service: str, inputs_fp: str) -> bool:
+        return (self.data["services"].get(service) or {}).get("inputs") == inputs_fp
+
+    def record_service(self, service: str, inputs_fp: str) -> None:
+        self.data["services"][service] = {"inputs": inputs_fp, "applied": datetime.now().isoformat(timespec="seconds")}
+        self._dirty["services"].add(service)
+        self.save()
+
+    def save(self) -> None:
+        if self.dry_run:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with self._lock, open(f"{self.path}.lock", "a") as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                merged = self._read()
+                for section, keys in self._dirty.items():
+                    for key in keys:
+                        merged[section][key] = self.data[section][key]
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".applied_state.", suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "w", encoding="utf-8") as f:
+                        json.dump(merged, f, indent=2, sort_keys=True)
+                    os.chmod(tmp, 0o600)
+                    os.replace(tmp, self.path)
+                except BaseException:
+                    with contextlib.suppress(OSError):
+                        os.unlink(tmp)
+                    raise
+            self.data = merged
+            self._dirty = {"files": set(), "services": set()}
+        except OSError as e:
+            logger.warning("Could not save %s: %s", self.path, e)
+
+
+# -----------------------------------------------------------------------------
+# Package Inventory
+# -----------------------------------------------------------------------------
+class PackageInventory:
+    """Installed-package facts: one RPM database query plus etcd/Patroni version probes."""
+
+    ETCD_BIN = "/usr/local/bin/etcd"
+
+    def __init__(self) -> None:
+        self._installed: Optional[dict[str, str]] = None
+
+    def installed(self) -> dict[str, str]:
+        """name -> version-release for every installed RPM (single rpm -qa, cached)."""
+        if self._installed is None:
+            self._installed = {}
+            try:
+                r = subprocess.run(
+                    ["rpm", "-qa", "--qf", "%{NAME}\t%{VERSION}-%{RELEASE}\n"],
+                    capture_output=True,
+                    text=True,
+                    timeout=60,
+                )
+                for line in r.stdout.splitlines():
+                    name, _, evr = line.partition("\t")
+                    if name:
+                        self._installed[name] = evr
+            except (FileNotFoundError, subprocess.TimeoutExpired) as e:
+                logger.warning("Could not query RPM database: %s", e)
+        return self._installed
+
+    def refresh(self) -> None:
+        self._installed = None
+
+    @staticmethod
+    def rpm_name(path: str) -> str:
+        """Package name from an RPM file name (name-version-release.arch.rpm)."""
+        return Path(path).name.rsplit("-", 2)[0]
+
+    def missing_rpm_files(self, files: list[str]) -> list[str]:
+        installed = self.installed()
+        return [f for f in files if self.rpm_name(f) not in installed]
+
+    def missing_packages(self, names: list[str]) -> list[str]:
+        installed = self.installed()
+        missing = []
+        for name in names:
+            if name in installed:
+                continue
+            # Tarball/wheel installs satisfy these without an RPM
+            if name == "etcd" and self.etcd_version():
+                continue
+            if name == "patroni" and self.patroni_version():
+                continue
+            missing.append(name)
+        return missing
+
+    @classmethod
+    def etcd_version(cls, binary: Optional[str] = None) -> Optional[str]:
+        """Version of the installed etcd binary (or of the given one), e.g. '3.5.15'."""
+        if binary is None:
+            binary = shutil.which("etcd") or cls.ETCD_BIN
+        if not os.path.exists(binary):
+            return None
+        try:
+            r = subprocess.run([binary, "--version"], capture_output=True, text=True, timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        m = re.search(r"etcd Version:\s*v?(\S+)", r.stdout)
+        return m.group(1) if m else None
+
+    @staticmethod
+    def patroni_version() -> Optional[str]:
+        """Version of the pip-installed Patroni, read from package metadata without importing it."""
+        try:
+            from importlib import metadata
+            return metadata.version("patroni")
+        except Exception:
+            pass
+        binary = shutil.which("patroni")
+        if not binary:
+            return None
+        try:
+            r = subprocess.run([binary, "--version"], capture_output=True, text=True, timeout=30)
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        m = re.search(r"(\d+\.\d+\.\d+)", r.stdout)
+        return m.group(1) if m else None
+
+    @staticmethod
+    def tarball_version(path: Path) -> Optional[str]:
+        m = re.search(r"etcd-v(\d+\.\d+\.\d+)", path.name)
+        return m.group(1) if m else None
+
+    @staticmethod
+    def wheel_version(path: Path) -> Optional[str]:
+        parts = path.name.split("-")
+        return parts[1] if len(parts) > 2 else None
+
+
+# -----------------------------------------------------------------------------
+# etcd Binary Installer
+# -----------------------------------------------------------------------------
+class EtcdBinaryInstaller:
+    """
+    Install etcd/etcdctl from an offline release tarball.
+
+    Only the two binaries are streamed out of the archive (no full extraction
+    to /tmp); each is written to a temp file next to its target, fsynced and
+    renamed into place, so a running etcd never sees a half-written binary.
+    A small manifest records the tarball and member hashes so re-runs can
+    skip the install when the installed binaries already match.
+    """
+
+    MEMBERS = ("etcd", "etcdctl")
+    BIN_DIR = "/usr/local/bin"
+    MANIFEST = f"{CONFIG_DIR}/etcd_install.json"
+
+    def __init__(self, bin_dir: str = BIN_DIR, manifest_path: str = MANIFEST, dry_run: bool = False):
+        self.bin_dir = bin_dir
+        self.manifest_path = manifest_path
+        self.dry_run = dry_run
+
+    @staticmethod
+    def version_key(path: Path) -> tuple:
+        m = re.search(r"etcd-v(\d+)\.(\d+)\.(\d+)", path.name)
+        return (int(m.group(1)), int(m.group(2)), int(m.group(3))) if m else (0, 0, 0)
+
+    @classmethod
+    def find_tarball(cls, search_dirs: list[Path], require_v35: bool = False) -> Optional[Path]:
+        """
+        Newest etcd-v*-linux-amd64.tar.gz in search_dirs (first directory with a match wins).
+        3.5.x is preferred since Patroni needs its v2 API (removed in 3.6); with
+        require_v35 other versions are ignored.
+        """
+        for d in search_dirs:
+            if not d.is_dir():
+                continue
+            found = [p for p in d.glob("etcd-v*-linux-amd64.tar.gz") if p.is_file() and cls.version_key(p) != (0, 0, 0)]
+            v35 = [p for p in found if cls.version_key(p)[:2] == (3, 5)]
+            candidates = v35 if (v35 or require_v35) else found
+            if candidates:
+                return sorted(candidates, key=cls.version_key)[-1]
+        return None
+
+    @staticmethod
+    def _sha256_file(path: str) -> Optional[str]:
+        h = hashlib.sha256()
+        try:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+        except OSError:
+            return None
+        return h.hexdigest()
+
+    @staticmethod
+    def _tarball_id(tarball: Path) -> dict[str, Any]:
+        st = tarball.stat()
+        return {"name": tarball.name, "size": st.st_size, "mtime": int(st.st_mtime)}
+
+    def _iter_members(self, tarball: Path):
+        """Yield (name, fileobj) for the wanted binaries, streaming the gzip once."""
+        with tarfile.open(str(tarball), mode="r|gz") as tf:
+            for member in tf:
+                parts = member.name.strip("/").split("/")
+                # Release layout: etcd-vX.Y.Z-linux-amd64/<binary>
+                if len(parts) != 2 or parts[1] not in self.MEMBERS or not member.isfile():
+                    continue
+                src = tf.extractfile(member)
+                if src is not None:
+                    yield parts[1], src
+
+    def _member_hashes(self, tarball: Path) -> dict[str, str]:
+        hashes = {}
+        for name, src in self._iter_members(tarball):
+            h = hashlib.sha256()
+            for chunk in iter(lambda: src.read(1 << 20), b""):
+                h.update(chunk)
+            hashes[name] = h.hexdigest()
+        return hashes
+
+    def _load_manifest(self) -> dict[str, Any]:
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self, tarball: Path, hashes: dict[str, str]) -> None:
+        if self.dry_run:
+            return
+        data = {
+            "tarball": self._tarball_id(tarball),
+            "version": PackageInventory.tarball_version(tarball),
+            "members": hashes,
+            "installed": datetime.now().isoformat(timespec="seconds"),
+        }
+        try:
+            os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+            tmp = f"{self.manifest_path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.manifest_path)
+        except OSError as e:
+            logger.warning("Could not save %s: %s", self.manifest_path, e)
+
+    def is_current(self, tarball: Path) -> bool:
+        """True if the installed binaries are this tarball's version and byte-identical to its members."""
+        want = PackageInventory.tarball_version(tarball)
+        etcd_path = os.path.join(self.bin_dir, "etcd")
+        if not want or PackageInventory.etcd_version(etcd_path) != want:
+            return False
+        installed = {n: self._sha256_file(os.path.join(self.bin_dir, n)) for n in self.MEMBERS}
+        if None in installed.values():
+            return False
+        manifest = self._load_manifest()
+        if manifest.get("tarball") == self._tarball_id(tarball):
+            expected = manifest.get("members") or {}
+        else:
+            # No record for this tarball: hash its members in a streaming pass (nothing written to disk)
+            try:
+                expected = self._member_hashes(tarball)
+            except (OSError, EOFError, ValueError) as e:
+                logger.warning("Could not read %s: %s", tarball, e)
+                return False
+            if expected == installed:
+                self._save_manifest(tarball, expected)
+        return expected == installed
+
+    def install(self, tarball: Path, force: bool = False) -> bool:
+        """Install etcd/etcdctl from tarball. Returns False if skipped because already current."""
+        if not force and self.is_current(tarball):
+            logger.info("etcd binaries in %s already match %s", self.bin_dir, tarball.name)
+            return False
+        if self.dry_run:
+            logger.info("[DRY-RUN] Would install %s from %s", ", ".join(self.MEMBERS), tarball.name)
+            return True
+        os.makedirs(self.bin_dir, exist_ok=True)
+        hashes: dict[str, str] = {}
+        for name, src in self._iter_members(tarball):
+            target = os.path.join(self.bin_dir, name)
+            tmp = f"{target}.tmp.{os.getpid()}"
+            h = hashlib.sha256()
+            try:
+                with open(tmp, "wb") as out:
+                    for chunk in iter(lambda: src.read(1 << 20), b""):
+                        h.update(chunk)
+                        out.write(chunk)
+                    out.flush()
+                    os.fsync(out.fileno())
+                os.chmod(tmp, 0o755)
+                os.replace(tmp, target)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp)
+                raise
+            hashes[name] = h.hexdigest()
+            logger.info("Installed %s (sha256 %s)", target, hashes[name][:12])
+        missing = [n for n in self.MEMBERS if n not in hashes]
+        if missing:
+            raise RuntimeError(f"{tarball.name} has unexpected layout; missing: {', '.join(missing)}")
+        self._save_manifest(tarball, hashes)
+        return True
+
+
+# -----------------------------------------------------------------------------
+# Patroni REST Health
+# -----------------------------------------------------------------------------
+class HTTPConnectionPool:
+    """
+    One keep-alive HTTP/1.1 connection per (host, port), reused across requests.
+
+    Each connection is guarded by its own lock, so different hosts are queried
+    in parallel while requests to the same host serialize on one socket. A
+    request on a connection the server has closed is retried once on a fresh one.
+    """
+
+    def __init__(self, timeout: float = 2.0):
+        self.timeout = timeout
+        self._conns: dict[tuple[str, int], Any] = {}
+        self._locks: dict[tuple[str, int], threading.Lock] = {}
+        self._guard = threading.Lock()
+
+    def _lock_for(self, key: tuple[str, int]) -> threading.Lock:
+        with self._guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def request(self, host: str, port: int, path: str, method: str = "GET", body: Optional[bytes] = None) -> tuple[int, bytes]:
+        key = (host, port)
+        headers = {"Connection": "keep-alive", "Accept": "application/json"}
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+        with self._lock_for(key):
+            while True:
+                conn = self._conns.get(key)
+                fresh = conn is None
+                if fresh:
+                    conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+                    self._conns[key] = conn
+                try:
+                    conn.request(method, path, body=body, headers=headers)
+                    resp = conn.getresponse()
+                    data = resp.read()
+                except (OSError, http.client.HTTPException):
+                    conn.close()
+                    self._conns.pop(key, None)
+                    # A stale keep-alive socket fails on first use; retry once on a new one
+                    if fresh:
+                        raise
+                    continue
+                if resp.will_close:
+                    conn.close()
+                    self._conns.pop(key, None)
+                return resp.status, data
+
+    def get_json(self, host: str, port: int, path: str) -> tuple[int, Any]:
+        status, data = self.request(host, port, path)
+        try:
+            return status, json.loads(data.decode("utf-8")) if data else None
+        except ValueError:
+            return status, None
+
+    def close(self) -> None:
+        with self._guard:
+            for conn in self._conns.values():
+                conn.close()
+            self._conns.clear()
+
+
+@dataclass
+class MemberHealth:
+    """State of one Patroni member as reported by its REST API (and the /cluster view)."""
+
+    node: str
+    host: str
+    reachable: bool = False
+    role: str = ""
+    state: str = ""
+    timeline: Optional[int] = None
+    lag: Optional[int] = None  # bytes behind the leader; None for the leader or unknown
+    pending_restart: bool = False
+    healthy: bool = False  # GET /health returned 200 (PostgreSQL is running)
+    server_version: Optional[int] = None
+    rtt_ms: Optional[float] = None
+    error: str = ""
+
+    @property
+    def is_leader(self) -> bool:
+        return self.role in ("leader", "master", "primary", "standby_leader")
+
+    @staticmethod
+    def table_header(with_rtt: bool = True) -> str:
+        header = f"{'MEMBER':<12} {'HOST':<16} {'ROLE':<14} {'STATE':<10} {'TL':>3} {'LAG MB':>8} {'PENDING':<8} {'HEALTH':<6}"
+        return header + (f" {'RTT ms':>7}" if with_rtt else "")
+
+    def format_row(self, highlight: Any = (), with_rtt: bool = True) -> str:
+        """One table row; fields named in highlight (node, role, timeline, lag, health) are emphasized."""
+
+        def cell(name: str, text: str) -> str:
+            return f"{Colors.BOLD}{Colors.YELLOW}{text}{Colors.RESET}" if name in highlight else text
+
+        if not self.reachable:
+            return f"{cell('node', f'{self.node:<12}')} {self.host:<16} {Colors.fail('UNREACHABLE')}  {self.error}"
+        tl = str(self.timeline) if self.timeline is not None else "-"
+        lag = f"{self.lag / 1048576:.1f}" if self.lag is not None else "-"
+        health = "OK" if self.healthy else "DOWN"
+        row = (
+            f"{cell('node', f'{self.node:<12}')} {self.host:<16} {cell('role', f'{self.role:<14}')} {self.state:<10} "
+            f"{cell('timeline', f'{tl:>3}')} {cell('lag', f'{lag:>8}')} {'*' if self.pending_restart else '':<8} "
+            f"{cell('health', f'{health:<6}')}"
+        )
+        if with_rtt:
+            row += f" {self.rtt_ms:>7.1f}" if self.rtt_ms is not None else f" {'-':>7}"
+        return row
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "node": self.node,
+            "host": self.host,
+            "reachable": self.reachable,
+            "role": self.role,
+            "state": self.state,
+            "timeline": self.timeline,
+            "lag": self.lag,
+            "pending_restart": self.pending_restart,
+            "healthy": self.healthy,
+            "server_version": self.server_version,
+            "rtt_ms": round(self.rtt_ms, 2) if self.rtt_ms is not None else None,
+            "error": self.error,
+        }
+
+
+class PatroniHealthCollector:
+    """
+    Query /patroni and /health on every node's REST port concurrently and merge
+    in the /cluster view (leader role, timeline and lag for each member).
+    """
+
+    def __init__(self, nodes: list[tuple[str, str]], port: int = 8008, timeout: float = 2.0, pool: Optional[HTTPConnectionPool] = None):
+        self.nodes = nodes
+        self.port = port
+        self.pool = pool or HTTPConnectionPool(timeout=timeout)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(nodes)), thread_name_prefix="patroni-rest")
+
+    def _query_node(self, node: str, host: str, want_cluster: bool) -> tuple[MemberHealth, Optional[dict]]:
+        m = MemberHealth(node=node, host=host)
+        cluster = None
+        t0 = time.perf_counter()
+        try:
+            status, info = self.pool.get_json(host, self.port, "/patroni")
+            m.rtt_ms = (time.perf_counter() - t0) * 1000
+            m.reachable = True
+            if isinstance(info, dict):
+                m.role = str(info.get("role") or "")
+                m.state = str(info.get("state") or "")
+                m.timeline = info.get("timeline")
+                m.pending_restart = bool(info.get("pending_restart"))
+                m.server_version = info.get("server_version")
+            health_status, _ = self.pool.get_json(host, self.port, "/health")
+            m.healthy = health_status == 200
+            if want_cluster:
+                status, cluster = self.pool.get_json(host, self.port, "/cluster")
+                if status != 200 or not isinstance(cluster, dict):
+                    cluster = None
+        except (OSError, http.client.HTTPException) as e:
+            m.error = str(e) or type(e).__name__
+        return m, cluster
+
+    @staticmethod
+    def _merge_cluster(members: list[MemberHealth], cluster: dict) -> None:
+        by_name = {m.node: m for m in members}
+        by_host = {m.host: m for m in members}
+        for entry in cluster.get("members") or []:
+            m = by_name.get(entry.get("name")) or by_host.get(entry.get("host"))
+            if m is None:
+                continue
+            # /cluster distinguishes leader / sync_standby / replica
+            if entry.get("role"):
+                m.role = str(entry["role"])
+            if not m.state and entry.get("state"):
+                m.state = str(entry["state"])
+            if m.timeline is None and entry.get("timeline") is not None:
+                m.timeline = entry.get("timeline")
+            lag = entry.get("lag")
+            m.lag = lag if isinstance(lag, int) else None
+            m.pending_restart = m.pending_restart or bool(entry.get("pending_restart"))
+
+    def collect(self) -> list[MemberHealth]:
+        """One concurrent round; only the first node is asked for /cluster unless it is down."""
+        futures = [
+            self._executor.submit(self._query_node, node, host, i == 0)
+            for i, (node, host) in enumerate(self.nodes)
+        ]
+        results = [f.result() for f in futures]
+        members = [m for m, _ in results]
+        cluster = next((c for _, c in results if c), None)
+        if cluster is None:
+            for m in members[1:]:
+                if not m.reachable:
+                    continue
+                try:
+                    status, data = self.pool.get_json(m.host, self.port, "/cluster")
+                except (OSError, http.client.HTTPException):
+                    continue
+                if status == 200 and isinstance(data, dict):
+                    cluster = data
+                    break
+        if cluster is not None:
+            self._merge_cluster(members, cluster)
+        return members
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+        self.pool.close()
+
+
+class ClusterHealthWatch:
+    """
+    Poll a PatroniHealthCollector every interval and redraw only the rows that changed.
+
+    On a terminal, changed rows are rewritten in place with ANSI cursor movement;
+    otherwise (pipes, logs) only changed rows are printed, timestamped, and with
+    json_output one JSON line is emitted per poll that changed something. Role,
+    timeline and lag-state transitions are highlighted for a few polls and kept,
+    together with compact per-poll snapshots, in bounded deques.
+    """
+
+    HIGHLIGHT_POLLS = 3
+
+    def __init__(
+        self,
+        collector: PatroniHealthCollector,
+        interval: float = 2.0,
+        history: int = 300,
+        lag_alert_bytes: int = 1048576,
+        json_output: bool = False,
+        out: Any = None,
+    ):
+        self.collector = collector
+        self.interval = max(0.2, interval)
+        self.lag_alert_bytes = lag_alert_bytes
+        self.json_output = json_output
+        self.out = out or sys.stdout
+        self.tty = not json_output and hasattr(self.out, "isatty") and self.out.isatty()
+        # (timestamp, ((node, reachable, role, timeline, lag, healthy, pending_restart), ...))
+        self.history: deque[tuple[float, tuple[tuple, ...]]] = deque(maxlen=max(1, history))
+        self.events: deque[str] = deque(maxlen=max(1, history))
+        self._rows: list[str] = []
+        self._highlight: dict[str, dict[str, int]] = {}
+        self._last_plain: dict[str, str] = {}
+        self.polls = 0
+
+    def _lag_state(self, m: MemberHealth) -> str:
+        if m.lag is None:
+            return "-"
+        if m.lag == 0:
+            return "0"
+        return "over" if m.lag > self.lag_alert_bytes else "lagging"
+
+    def _transitions(self, prev: Optional[MemberHealth], cur: MemberHealth) -> dict[str, str]:
+        if prev is None:
+            return {}
+        changed = {}
+        if prev.reachable != cur.reachable:
+            changed["node"] = f"{'reachable' if cur.reachable else 'unreachable'}"
+        if prev.role != cur.role:
+            changed["role"] = f"role {prev.role or '-'} -> {cur.role or '-'}"
+        if prev.timeline != cur.timeline:
+            changed["timeline"] = f"timeline {prev.timeline} -> {cur.timeline}"
+        if self._lag_state(prev) != self._lag_state(cur):
+            changed["lag"] = f"lag {self._lag_state(prev)} -> {self._lag_state(cur)}"
+        if prev.healthy != cur.healthy:
+            changed["health"] = f"postgres {'running' if cur.healthy else 'down'}"
+        return changed
+
+    def _emit(self, text: str) -> None:
+        self.out.write(text)
+        self.out.flush()
+
+    def _draw(self, rows: list[str], status: str) -> None:
+        if not self._rows or len(rows) != len(self._rows):
+            self._emit(MemberHealth.table_header(with_rtt=False) + "\n" + "".join(r + "\n" for r in rows) + status + "\n")
+        else:
+            # Cursor sits below the status line; row i is len(rows) + 1 - i lines up
+            buf = []
+            for i, (old, new) in enumerate(zip(self._rows, rows)):
+                if old != new:
+                    up = len(rows) + 1 - i
+                    buf.append(f"\033[{up}A\r\033[2K{new}\033[{up}B\r")
+            buf.append(f"\033[1A\r\033[2K{status}\n")
+            self._emit("".join(buf))
+        self._rows = rows
+
+    def poll(self, previous: dict[str, MemberHealth]) -> dict[str, MemberHealth]:
+        members = self.collector.collect()
+        now = time.time()
+        stamp = datetime.fromtimestamp(now).strftime("%H:%M:%S")
+        self.polls += 1
+        self.history.append((now, tuple(
+            (m.node, m.reachable, m.role, m.timeline, m.lag, m.healthy, m.pending_restart) for m in members
+        )))
+        changed_nodes = []
+        for m in members:
+            hl = self._highlight.setdefault(m.node, {})
+            for f in list(hl):
+                hl[f] -= 1
+                if hl[f] <= 0:
+                    del hl[f]
+            transitions = self._transitions(previous.get(m.node), m)
+            for f, desc in transitions.items():
+                hl[f] = self.HIGHLIGHT_POLLS
+                self.events.append(f"{stamp} {m.node}: {desc}")
+            if transitions or m.node not in previous:
+                changed_nodes.append(m)
+
+        if self.json_output:
+            if changed_nodes:
+                self._emit(json.dumps({"time": now, "members": [m.to_dict() for m in members]}) + "\n")
+        elif self.tty:
+            rows = [m.format_row(set(self._highlight.get(m.node, {})), with_rtt=False) for m in members]
+            last = self.events[-1] if self.events else "no transitions"
+            self._draw(rows, f"{Colors.DIM}{stamp}  poll {self.polls} every {self.interval:g}s  last: {last}  (Ctrl+C to stop){Colors.RESET}")
+        else:
+            if self.polls == 1:
+                self._emit(MemberHealth.table_header(with_rtt=False) + "\n")
+            # Rows are compared as rendered, so a lag change within the same state still shows
+            rows = {m.node: m.format_row(with_rtt=False) for m in members}
+            for m in members:
+                if rows[m.node] != self._last_plain.get(m.node):
+                    self._emit(f"[{stamp}] {rows[m.node]}\n")
+            self._last_plain = rows
+        return {m.node: m for m in members}
+
+    def run(self, iterations: Optional[int] = None) -> None:
+        """Poll until Ctrl+C (or for a fixed number of iterations)."""
+        previous: dict[str, MemberHealth] = {}
+        next_at = time.monotonic()
+        try:
+            while iterations is None or self.polls < iterations:
+                previous = self.poll(previous)
+                next_at += self.interval
+                delay = next_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_at = time.monotonic()  # collection overran the interval; do not burst
+        except KeyboardInterrupt:
+            pass
+
+    def summary(self) -> str:
+        if not self.history:
+            return "No polls."
+        span = self.history[-1][0] - self.history[0][0]
+        lines = [f"{self.polls} polls ({len(self.history)} kept, {span:.0f}s); {len(self.events)} transitions"]
+        lines.extend(f"  {e}" for e in self.events)
+        return "\n".join(lines)
+
+
+# -----------------------------------------------------------------------------
+# Replication Lag Sampling
+# -----------------------------------------------------------------------------
+def percentile(values: list[float], p: float) -> float:
+    """Linear-interpolated percentile (p in 0..100) of values; NaN if empty."""
+    if not values:
+        return float("nan")
+    s = sorted(values)
+    k = (len(s) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(s) - 1)
+    return s[lo] + (s[hi] - s[lo]) * (k - lo)
+
+
+class LagRing:
+    """Fixed-capacity ring of (time, lag bytes, lag seconds) samples backed by array('d')."""
+
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self.ts = array("d", bytes(8 * self.capacity))
+        self.lag_bytes = array("d", bytes(8 * self.capacity))
+        self.lag_seconds = array("d", bytes(8 * self.capacity))
+        self.count = 0
+        self._next = 0
+
+    def append(self, ts: float, lag_bytes: float, lag_seconds: float) -> None:
+        i = self._next
+        self.ts[i] = ts
+        self.lag_bytes[i] = lag_bytes
+        self.lag_seconds[i] = lag_seconds
+        self._next = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def _indices(self):
+        start = (self._next - self.count) % self.capacity
+        for j in range(self.count):
+            yield (start + j) % self.capacity
+
+    def samples(self, since: float = 0.0) -> list[tuple[float, float, float]]:
+        """Samples in time order, optionally only those at or after since."""
+        return [
+            (self.ts[i], self.lag_bytes[i], self.lag_seconds[i])
+            for i in self._indices()
+            if self.ts[i] >= since
+        ]
+
+
+class LagSampler:
+    """
+    Per-replica replication lag over time.
+
+    Each sample takes lag bytes from the Patroni REST /cluster view and, when a
+    pg_stat_replication reader is supplied, replay lag in bytes and seconds from
+    the leader (preferred, as it is measured by the primary itself). Missing
+    values are stored as NaN and ignored by the statistics.
+    """
+
+    def __init__(
+        self,
+        collector: PatroniHealthCollector,
+        capacity: int = 3600,
+        replication_reader: Optional[Callable[[str], dict[str, tuple[float, float]]]] = None,
+    ):
+        self.collector = collector
+        self.capacity = capacity
+        self.replication_reader = replication_reader
+        self.rings: dict[str, LagRing] = {}
+
+    def sample(self) -> int:
+        """Take one sample of every replica. Returns the number of replicas recorded."""
+        now = time.time()
+        members = self.collector.collect()
+        leader = next((m for m in members if m.is_leader and m.reachable), None)
+        from_pg: dict[str, tuple[float, float]] = {}
+        if leader is not None and self.replication_reader is not None:
+            try:
+                from_pg = self.replication_reader(leader.host)
+            except Exception as e:
+                logger.debug("pg_stat_replication read failed: %s", e)
+        recorded = 0
+        for m in members:
+            if m.is_leader or not m.reachable:
+                continue
+            nbytes, nsecs = from_pg.get(m.node, (float("nan"), float("nan")))
+            if math.isnan(nbytes) and m.lag is not None:
+                nbytes = float(m.lag)
+            ring = self.rings.setdefault(m.node, LagRing(self.capacity))
+            ring.append(now, nbytes, nsecs)
+            recorded += 1
+        return recorded
+
+    def run(self, duration: float, interval: float = 1.0, progress: Optional[Callable[[int], None]] = None) -> int:
+        """Sample every interval seconds for duration seconds (Ctrl+C stops early). Returns sample rounds."""
+        rounds = 0
+        end = time.monotonic() + duration
+        next_at = time.monotonic()
+        try:
+            while time.monotonic() < end:
+                self.sample()
+                rounds += 1
+                if progress:
+                    progress(rounds)
+                next_at += interval
+                delay = min(next_at, end) - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        except KeyboardInterrupt:
+            pass
+        return rounds
+
+    def stats(self, window: Optional[float] = None) -> dict[str, dict[str, Any]]:
+        """Per replica: sample count and p50/p95/p99/max of lag bytes and seconds over the last window seconds."""
+        since = time.time() - window if window else 0.0
+        out: dict[str, dict[str, Any]] = {}
+        for node, ring in self.rings.items():
+            samples = ring.samples(since)
+            entry: dict[str, Any] = {"samples": len(samples)}
+            for key, idx in (("bytes", 1), ("seconds", 2)):
+                vals = [s[idx] for s in samples if not math.isnan(s[idx])]
+                entry[key] = {
+                    "p50": percentile(vals, 50),
+                    "p95": percentile(vals, 95),
+                    "p99": percentile(vals, 99),
+                    "max": max(vals) if vals else float("nan"),
+                } if vals else None
+            out[node] = entry
+        return out
+
+    def recommend_max_lag(self, headroom: float = 2.0, floor: int = 1048576) -> Optional[int]:
+        """
+        maximum_lag_on_failover suggestion: headroom x the worst replica's p99 lag
+        in bytes over everything sampled, rounded up to whole MiB and at least floor.
+        """
+        p99s = [e["bytes"]["p99"] for e in self.stats().values() if e["bytes"]]
+        if not p99s:
+            return None
+        mib = 1048576
+        return max(floor, int(math.ceil(max(p99s) * headroom / mib)) * mib)
+
+    def export_csv(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("timestamp,member,lag_bytes,lag_seconds\n")
+            for node, ring in sorted(self.rings.items()):
+                for ts, b, s in ring.samples():
+                    fb = "" if math.isnan(b) else f"{b:.0f}"
+                    fs = "" if math.isnan(s) else f"{s:.3f}"
+                    f.write(f"{datetime.fromtimestamp(ts).isoformat(timespec='milliseconds')},{node},{fb},{fs}\n")
+
+    def to_dict(self, windows: list[float]) -> dict[str, Any]:
+        def clean(v: Any) -> Any:
+            if isinstance(v, float):
+                return None if math.isnan(v) else round(v, 3)
+            if isinstance(v, dict):
+                return {k: clean(x) for k, x in v.items()}
+            return v
+
+        return {
+            "windows": {str(int(w)): clean(self.stats(w)) for w in windows},
+            "all": clean(self.stats()),
+            "recommended_maximum_lag_on_failover": self.recommend_max_lag(),
+            "series": {
+                node: [[round(ts, 3), clean(b), clean(s)] for ts, b, s in ring.samples()]
+                for node, ring in sorted(self.rings.items())
+            },
+        }
+
+    def export_json(self, path: str, windows: list[float]) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(windows), f, indent=2)
+
+
+# -----------------------------------------------------------------------------
+# HAProxy Runtime API
+# -----------------------------------------------------------------------------
+@dataclass
+class HAProxyServerStat:
+    """One `show stat` row (frontend, backend or server)."""
+
+    proxy: str
+    server: str
+    status: str
+    weight: Optional[int]
+    scur: Optional[int]
+    smax: Optional[int]
+    slim: Optional[int]
+    stot: Optional[int]
+    qcur: Optional[int]
+    check_status: str
+    last_change: Optional[int]
+    raw: dict[str, str] = field(repr=False, default_factory=dict)
+
+    @classmethod
+    def from_row(cls, row: dict[str, str]) -> "HAProxyServerStat":
+        def num(key: str) -> Optional[int]:
+            v = row.get(key, "")
+            return int(v) if v.lstrip("-").isdigit() else None
+
+        return cls(
+            proxy=row.get("pxname", ""),
+            server=row.get("svname", ""),
+            status=row.get("status", ""),
+            weight=num("weight"),
+            scur=num("scur"),
+            smax=num("smax"),
+            slim=num("slim"),
+            stot=num("stot"),
+            qcur=num("qcur"),
+            check_status=row.get("check_status", ""),
+            last_change=num("lastchg"),
+            raw=row,
+        )
+
+
+@dataclass
+class HAProxyServerState:
+    """One `show servers state` row."""
+
+    OP_STATES = {0: "STOPPED", 1: "STARTING", 2: "RUNNING", 3: "STOPPING"}
+    ADMIN_FLAGS = {0x01: "FMAINT", 0x02: "IMAINT", 0x04: "CMAINT", 0x08: "FDRAIN", 0x10: "IDRAIN", 0x20: "RMAINT", 0x40: "HMAINT"}
+
+    backend: str
+    server: str
+    address: str
+    port: Optional[int]
+    op_state: int
+    admin_state: int
+    weight: int
+    initial_weight: int
+    since_last_change: int
+
+    @property
+    def operational(self) -> str:
+        return self.OP_STATES.get(self.op_state, str(self.op_state))
+
+    @property
+    def admin(self) -> str:
+        """READY, or the admin flags set (e.g. FMAINT, FDRAIN)."""
+        flags = [name for bit, name in self.ADMIN_FLAGS.items() if self.admin_state & bit]
+        return ",".join(flags) or "READY"
+
+    @property
+    def in_maintenance(self) -> bool:
+        return bool(self.admin_state & 0x67)
+
+    @property
+    def draining(self) -> bool:
+        return bool(self.admin_state & 0x18)
+
+
+class HAProxyRuntimeClient:
+    """
+    Client for the HAProxy runtime API on the admin stats socket.
+
+    Reads (`show stat`, `show servers state`) are parsed in bulk; server state,
+    weight and maxconn changes apply immediately with no config rewrite, reload
+    or new HAProxy process. Changes are not persisted: a later reload restores
+    the haproxy.cfg values.
+    """
+
+    SOCKET = "/run/haproxy/admin.sock"
+    STATES = ("ready", "drain", "maint")
+
+    def __init__(self, socket_path: str = SOCKET, timeout: float = 2.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def command(self, cmd: str) -> str:
+        """Send one command line (non-interactive mode: HAProxy closes after replying) and return the reply."""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(self.timeout)
+            s.connect(self.socket_path)
+            s.sendall(cmd.encode("utf-8") + b"\n")
+            chunks = []
+            while True:
+                chunk = s.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        return b"".join(chunks).decode("utf-8", "replace")
+
+    def execute(self, *cmds: str) -> None:
+        """
+        Run one or more action commands in a single connection (joined with ';').
+        Actions reply with nothing on success, so any text is an error.
+        """
+        reply = self.command("; ".join(cmds)).strip()
+        if reply:
+            raise RuntimeError(f"HAProxy runtime API: {reply}")
+
+    def show_stat(self) -> list[dict[str, str]]:
+        """`show stat` as one dict per proxy/server row, keyed by the CSV header (pxname, svname, status, ...)."""
+        text = self.command("show stat")
+        lines = [line for line in text.splitlines() if line.strip()]
+        if not lines or not lines[0].startswith("#"):
+            return []
+        header = lines[0].lstrip("# ").rstrip(",").split(",")
+        return [dict(zip(header, line.split(","))) for line in lines[1:] if not line.startswith("#")]
+
+    def server_stats(self, backend: Optional[str] = None) -> list[HAProxyServerStat]:
+        """Typed `show stat` rows for servers only (no FRONTEND/BACKEND aggregates)."""
+        return [
+            HAProxyServerStat.from_row(row)
+            for row in self.show_stat()
+            if row.get("svname") not in ("FRONTEND", "BACKEND") and (backend is None or row.get("pxname") == backend)
+        ]
+
+    def servers_state(self, backend: Optional[str] = None) -> list[HAProxyServerState]:
+        """`show servers state` (format 1) as typed records."""
+        text = self.command(f"show servers state {backend}" if backend else "show servers state")
+        header: list[str] = []
+        out = []
+        for line in text.splitlines():
+            if line.startswith("#"):
+                header = line.lstrip("# ").split()
+                continue
+            parts = line.split()
+            if not header or len(parts) < len(header) - 4:  # trailing optional columns vary by version
+                continue
+            row = dict(zip(header, parts))
+            try:
+                out.append(HAProxyServerState(
+                    backend=row["be_name"],
+                    server=row["srv_name"],
+                    address=row.get("srv_addr", ""),
+                    port=int(row["srv_port"]) if row.get("srv_port", "").isdigit() else None,
+                    op_state=int(row["srv_op_state"]),
+                    admin_state=int(row["srv_admin_state"]),
+                    weight=int(row["srv_uweight"]),
+                    initial_weight=int(row["srv_iweight"]),
+                    since_last_change=int(row.get("srv_time_since_last_change", "0")),
+                ))
+            except (KeyError, ValueError):
+                logger.debug("Unparsed servers state line: %s", line)
+        return out
+
+    def set_state(self, backend: str, server: str, state: str) -> None:
+        if state not in self.STATES:
+            raise ValueError(f"state must be one of {', '.join(self.STATES)}")
+        self.execute(f"set server {backend}/{server} state {state}")
+
+    def drain(self, backend: str, server: str) -> None:
+        """Stop sending new connections; existing sessions continue."""
+        self.set_state(backend, server, "drain")
+
+    def maint(self, backend: str, server: str) -> None:
+        self.set_state(backend, server, "maint")
+
+    def ready(self, backend: str, server: str) -> None:
+        self.set_state(backend, server, "ready")
+
+    def set_health(self, backend: str, server: str, health: str) -> None:
+        """Force the check result (up, stopping, down) until the next check says otherwise."""
+        if health not in ("up", "stopping", "down"):
+            raise ValueError("health must be one of up, stopping, down")
+        self.execute(f"set server {backend}/{server} health {health}")
+
+    def shutdown_sessions(self, backend: str, server: str) -> None:
+        """Close every session still open on the server."""
+        self.execute(f"shutdown sessions server {backend}/{server}")
+
+    def set_weight(self, backend: str, server: str, weight: int) -> None:
+        if not 0 <= weight <= 256:
+            raise ValueError("weight must be 0-256")
+        self.execute(f"set weight {backend}/{server} {weight}")
+
+    def set_maxconn(self, backend: str, server: str, maxconn: int) -> None:
+        if maxconn < 0:
+            raise ValueError("maxconn must be >= 0")
+        self.execute(f"set maxconn server {backend}/{server} {maxconn}")
+
+
+# -----------------------------------------------------------------------------
+# Metrics Exporter
+# -----------------------------------------------------------------------------
+def _prom_escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _prom_labels(labels: dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_prom_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+class PromFamilies:
+    """Prometheus text exposition builder that keeps each metric family's samples together."""
+
+    def __init__(self) -> None:
+        self._families: dict[str, dict[str, Any]] = {}
+
+    def _family(self, name: str, mtype: str, help_text: str) -> dict[str, Any]:
+        fam = self._families.get(name)
+        if fam is None:
+            fam = self._families[name] = {"type": mtype, "help": help_text, "samples": []}
+        return fam
+
+    def add(self, name: str, value: Any, labels: Optional[dict[str, Any]] = None, mtype: str = "gauge", help_text: str = "") -> None:
+        if value is None:
+            return
+        if isinstance(value, bool):
+            value = int(value)
+        self._family(name, mtype, help_text)["samples"].append(f"{name}{_prom_labels(labels or {})} {value}")
+
+    def extend(self, other: "PromFamilies") -> None:
+        for name, fam in other._families.items():
+            mine = self._family(name, fam["type"], fam["help"])
+            mine["samples"].extend(fam["samples"])
+
+    def merge_text(self, text: str, extra_labels: dict[str, Any], prefix: str = "") -> None:
+        """Merge an upstream /metrics page, adding extra_labels to every sample (only families starting with prefix)."""
+        current = None
+        helps: dict[str, str] = {}
+        injected = ",".join(f'{k}="{_prom_escape(v)}"' for k, v in extra_labels.items())
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("#"):
+                parts = line.split(None, 3)
+                if len(parts) >= 3 and parts[1] == "HELP":
+                    helps[parts[2]] = parts[3] if len(parts) > 3 else ""
+                elif len(parts) >= 4 and parts[1] == "TYPE":
+                    current = parts[2] if parts[2].startswith(prefix) else None
+                    if current:
+                        self._family(current, parts[3], helps.get(current, ""))
+                continue
+            name_end = min((i for i in (line.find("{"), line.find(" ")) if i >= 0), default=-1)
+            if name_end < 0:
+                continue
+            name = line[:name_end]
+            if not name.startswith(prefix):
+                continue
+            family = current if current and name.startswith(current) else name
+            fam = self._family(family, "untyped", helps.get(family, ""))
+            if line[name_end] == "{":
+                rest = line[name_end + 1:]
+                sample = f"{name}{{{injected}{',' if not rest.startswith('}') else ''}{rest}"
+            else:
+                sample = f"{name}{{{injected}}}{line[name_end:]}"
+            fam["samples"].append(sample)
+
+    def render(self) -> str:
+        out = []
+        for name, fam in self._families.items():
+            if not fam["samples"]:
+                continue
+            if fam["help"]:
+                out.append(f"# HELP {name} {fam['help']}")
+            out.append(f"# TYPE {name} {fam['type']}")
+            out.extend(fam["samples"])
+        return "\n".join(out) + "\n"
+
+
+class MetricsExporter:
+    """
+    Prometheus exposition for the whole stack: Patroni REST (all members), etcd
+    /metrics (all members, relabeled with member=) and the local HAProxy
+    `show stat`. Upstream fan-out happens at most once per cache_seconds:
+    concurrent scrapes of a stale cache wait for the single in-flight refresh.
+    """
+
+    HAPROXY_FIELDS = {
+        "scur": ("pg_ha_haproxy_current_sessions", "gauge", "Current sessions"),
+        "smax": ("pg_ha_haproxy_max_sessions", "gauge", "Max sessions seen"),
+        "slim": ("pg_ha_haproxy_session_limit", "gauge", "Configured session limit"),
+        "stot": ("pg_ha_haproxy_sessions_total", "counter", "Total sessions"),
+        "qcur": ("pg_ha_haproxy_current_queue", "gauge", "Queued connections"),
+        "bin": ("pg_ha_haproxy_bytes_in_total", "counter", "Bytes in"),
+        "bout": ("pg_ha_haproxy_bytes_out_total", "counter", "Bytes out"),
+        "econ": ("pg_ha_haproxy_connection_errors_total", "counter", "Connection errors"),
+        "chkfail": ("pg_ha_haproxy_check_failures_total", "counter", "Failed health checks"),
+        "downtime": ("pg_ha_haproxy_downtime_seconds_total", "counter", "Total downtime"),
+        "check_duration": ("pg_ha_haproxy_check_duration_milliseconds", "gauge", "Last health check duration"),
+    }
+
+    def __init__(
+        self,
+        members: list[tuple[str, str]],
+        cache_seconds: float = 5.0,
+        haproxy: Optional[HAProxyRuntimeClient] = None,
+        timeout: float = 2.0,
+    ):
+        self.members = members
+        self.cache_seconds = cache_seconds
+        self.haproxy = haproxy or HAProxyRuntimeClient()
+        self.pool = HTTPConnectionPool(timeout=timeout)
+        self.collector = PatroniHealthCollector(members, pool=self.pool)
+        self._executor = ThreadPoolExecutor(max_workers=max(2, len(members) + 2), thread_name_prefix="metrics")
+        self._lock = threading.Lock()
+        self._cached: Optional[str] = None
+        self._cached_at = 0.0
+        self.refreshes = 0
+
+    def _patroni(self, fams: PromFamilies) -> None:
+        for m in self.collector.collect():
+            labels = {"member": m.node, "host": m.host}
+            fams.add("pg_ha_patroni_up", m.reachable, labels, help_text="Patroni REST API reachable")
+            if not m.reachable:
+                continue
+            fams.add("pg_ha_patroni_postgres_running", m.healthy, labels, help_text="GET /health returned 200")
+            fams.add("pg_ha_patroni_leader", m.is_leader, labels, help_text="Member is the leader")
+            fams.add("pg_ha_patroni_role", 1, dict(labels, role=m.role or "unknown"), help_text="Member role (value is always 1)")
+            fams.add("pg_ha_patroni_timeline", m.timeline, labels, help_text="PostgreSQL timeline")
+            fams.add("pg_ha_patroni_replication_lag_bytes", m.lag, labels, help_text="Replay lag behind the leader")
+            fams.add("pg_ha_patroni_pending_restart", m.pending_restart, labels, help_text="Restart needed to apply settings")
+            if m.rtt_ms is not None:
+                fams.add("pg_ha_patroni_rest_rtt_seconds", round(m.rtt_ms / 1000, 6), labels, help_text="REST round trip")
+
+    def _etcd(self, node: str, ip: str) -> tuple[str, str]:
+        status, body = self.pool.request(ip, 2379, "/metrics")
+        if status != 200:
+            raise RuntimeError(f"etcd {ip} /metrics returned {status}")
+        return node, body.decode("utf-8", "replace")
+
+    def _haproxy(self, fams: PromFamilies) -> None:
+        for row in self.haproxy.show_stat():
+            labels = {"proxy": row.get("pxname", ""), "server": row.get("svname", "")}
+            status = row.get("status", "")
+            fams.add("pg_ha_haproxy_up", status.startswith("UP") or status == "OPEN", labels,
+                     help_text="Frontend OPEN / backend or server UP")
+            for key, (name, mtype, help_text) in self.HAPROXY_FIELDS.items():
+                raw = row.get(key, "")
+                if raw.isdigit():
+                    fams.add(name, int(raw), labels, mtype=mtype, help_text=help_text)
+
+    def _refresh(self) -> str:
+        t0 = time.perf_counter()
+        parts = {"patroni": PromFamilies(), "haproxy": PromFamilies()}
+        futures = {
+            "patroni": self._executor.submit(self._patroni, parts["patroni"]),
+            "haproxy": self._executor.submit(self._haproxy, parts["haproxy"]),
+        }
+        etcd_futures = [self._executor.submit(self._etcd, node, ip) for node, ip in self.members]
+        fams = PromFamilies()
+        up: dict[str, bool] = {}
+        for name, fut in futures.items():
+            try:
+                fut.result()
+                fams.extend(parts[name])
+                up[name] = True
+            except Exception as e:
+                logger.debug("metrics source %s failed: %s", name, e)
+                up[name] = False
+        etcd_ok = 0
+        for fut in etcd_futures:
+            try:
+                node, text = fut.result()
+                fams.merge_text(text, {"member": node}, prefix="etcd_")
+                etcd_ok += 1
+            except Exception as e:
+                logger.debug("etcd metrics failed: %s", e)
+        up["etcd"] = etcd_ok > 0
+        for name, ok in up.items():
+            fams.add("pg_ha_exporter_source_up", ok, {"source": name}, help_text="Upstream source answered")
+        fams.add("pg_ha_exporter_etcd_members_scraped", etcd_ok, help_text="etcd members whose /metrics were merged")
+        fams.add("pg_ha_exporter_refresh_seconds", round(time.perf_counter() - t0, 6), help_text="Duration of the last upstream fan-out")
+        self.refreshes += 1
+        fams.add("pg_ha_exporter_refreshes_total", self.refreshes, mtype="counter", help_text="Upstream fan-outs since start")
+        return fams.render()
+
+    def render(self) -> str:
+        """Cached exposition text; refreshed by exactly one caller once older than cache_seconds."""
+        with self._lock:
+            if self._cached is None or time.monotonic() - self._cached_at >= self.cache_seconds:
+                self._cached = self._refresh()
+                self._cached_at = time.monotonic()
+            return self._cached
+
+    def serve(self, bind: str, port: int) -> None:
+        """Serve /metrics until interrupted."""
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self) -> None:
+                if self.path.split("?", 1)[0] == "/metrics":
+                    body = exporter.render().encode("utf-8")
+                    ctype = "text/plain; version=0.0.4; charset=utf-8"
+                    code = 200
+                else:
+                    body = b"pg_ha_setup exporter: see /metrics\n"
+                    ctype = "text/plain; charset=utf-8"
+                    code = 404 if self.path != "/" else 200
+                self.send_response(code)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt: str, *args: Any) -> None:
+                logger.debug("metrics %s - %s", self.client_address[0], fmt % args)
+
+        server = ThreadingHTTPServer((bind, port), Handler)
+        server.daemon_threads = True
+        logger.info("Serving metrics on http://%s:%d/metrics (cache %ss)", bind, port, self.cache_seconds)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            self._executor.shutdown(wait=False)
+            self.collector.close()
+
+
+# -----------------------------------------------------------------------------
+# Host Facts & Sizing
+# -----------------------------------------------------------------------------
+@dataclass
+class HostFacts:
+    """Hardware facts used to size HAProxy and PostgreSQL."""
+
+    cpus: int
+    mem_bytes: int
+    rotational: Optional[bool] = None  # storage under the data directory; None if unknown
+    cpu_list: tuple[int, ...] = ()  # CPUs this process may run on (sched_getaffinity); empty if unknown
+
+    @classmethod
+    def detect(cls, data_dir: Optional[str] = None) -> "HostFacts":
+        try:
+            cpu_list = tuple(sorted(os.sched_getaffinity(0)))
+            cpus = len(cpu_list)
+        except (AttributeError, OSError):
+            cpu_list = ()
+            cpus = os.cpu_count() or 1
+        mem = 0
+        try:
+            with open("/proc/meminfo", "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.startswith("MemTotal:"):
+                        mem = int(line.split()[1]) * 1024
+                        break
+        except (OSError, ValueError, IndexError):
+            pass
+        if not mem:
+            mem = 4 << 30
+            logger.warning("Could not read MemTotal from /proc/meminfo; assuming 4 GiB")
+        return cls(cpus=max(1, cpus), mem_bytes=mem, rotational=cls._rotational(data_dir or "/var/lib"), cpu_list=cpu_list)
+
+    @staticmethod
+    def _rotational(path: str) -> Optional[bool]:
+        """queue/rotational of the block device holding path (nearest existing parent)."""
+        p = Path(path)
+        while not p.exists() and p != p.parent:
+            p = p.parent
+        try:
+            dev = os.stat(p).st_dev
+            sys_dev = Path(f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}").resolve()
+        except OSError:
+            return None
+        # Partitions have no queue/ of their own; use the parent disk's. dm/md devices report their own.
+        for d in (sys_dev, sys_dev.parent):
+            flag = d / "queue" / "rotational"
+            try:
+                return flag.read_text().strip() == "1"
+            except OSError:
+                continue
+        return None
+
+    @property
+    def mem_gib(self) -> float:
+        return self.mem_bytes / (1 << 30)
+
+
+@dataclass
+class HAProxyProfile:
+    """
+    HAProxy limits derived from the host and PostgreSQL max_connections.
+
+    HAProxy shares the host with PostgreSQL, so it gets at most half the cores
+    (capped at 8 threads, pinned with cpu-map to the highest CPUs of this host's
+    affinity set rather than CPU 0 upwards) and about 5% of RAM for
+    connection buffers. Per-server maxconn stays below max_connections so
+    bursts queue in HAProxy (timeout queue) instead of being refused by
+    PostgreSQL with "too many clients". When pg_read can fall back to the
+    leader, the leader's budget is split: a fifth for the pg_read fallback
+    servers and the rest for pg_write.
+    """
+
+    nbthread: int
+    maxconn: int
+    server_maxconn: int
+    write_maxconn: int
+    bufsize: int
+    timeout_client: str
+    timeout_server: str
+    timeout_connect: str = "3s"
+    timeout_queue: str = "30s"
+    timeout_check: str = "2s"
+    inter: str = "2s"
+    fastinter: str = "500ms"
+    downinter: str = "5s"
+    cpus: tuple[int, ...] = ()  # cpu-map targets, one per thread; empty = no pinning
+    read_fallback_maxconn: int = 0  # per pg_read leader-fallback server; 0 = no fallback servers
+
+    # Superuser-reserved slots plus Patroni, replication and monitoring sessions
+    PG_RESERVED_CONNECTIONS = 10
+
+    @classmethod
+    def for_host(cls, facts: HostFacts, config: HAConfig) -> "HAProxyProfile":
+        nbthread = config.haproxy_nbthread or max(1, min(facts.cpus // 2, 8))
+        bufsize = config.haproxy_bufsize or (32768 if facts.mem_bytes >= 8 << 30 else 16384)
+        server_maxconn = config.haproxy_server_maxconn or max(10, config.pg_max_connections - cls.PG_RESERVED_CONNECTIONS)
+        read_port = config.read_replica_port and config.read_replica_port != config.haproxy_port
+        read_fallback_maxconn = max(1, server_maxconn // 5) if read_port and config.read_fallback_to_leader else 0
+        # Each proxied connection holds a request and a response buffer plus ~2 KiB of session state
+        per_conn = 2 * bufsize + 2048
+        by_memory = int(facts.mem_bytes * 0.05) // per_conn
+        maxconn = config.haproxy_maxconn or max(2000, min(by_memory, 100000))
+        # Pin only when there is one allowed CPU per thread; an explicit nbthread may exceed the set
+        cpus = facts.cpu_list[-nbthread:] if 1 < nbthread <= len(facts.cpu_list) else ()
+        return cls(
+            nbthread=nbthread,
+            maxconn=maxconn,
+            server_maxconn=server_maxconn,
+            write_maxconn=server_maxconn - read_fallback_maxconn,
+            bufsize=bufsize,
+            timeout_client=config.haproxy_timeout_client,
+            timeout_server=config.haproxy_timeout_server,
+            inter=config.haproxy_check_inter,
+            fastinter=config.haproxy_check_fastinter,
+            downinter=config.haproxy_check_downinter,
+            cpus=cpus,
+            read_fallback_maxconn=read_fallback_maxconn,
+        )
+
+    def global_lines(self) -> str:
+        lines = [f"    maxconn {self.maxconn}", f"    nbthread {self.nbthread}"]
+        if self.cpus:
+            lines.append(f"    cpu-map auto:1/1-{self.nbthread} {' '.join(str(c) for c in self.cpus)}")
+        lines.append(f"    tune.bufsize {self.bufsize}")
+        return "\n".join(lines)
+
+    def default_server(self, maxconn: Optional[int] = None) -> str:
+        return (
+            f"default-server inter {self.inter} fastinter {self.fastinter} downinter {self.downinter} "
+            f"fall 3 rise 2 maxconn {maxconn or self.server_maxconn} on-marked-down shutdown-sessions"
+        )
+
+
+class PostgresTuner:
+    """
+    PostgreSQL memory, WAL, planner and parallelism settings for a host and workload.
+
+    Profiles: oltp (many short transactions), olap (few large queries) and mixed.
+    Settings Patroni keeps cluster-wide in the DCS (max_worker_processes etc.)
+    are not emitted; parallel worker limits stay within the default
+    max_worker_processes of 8.
+    """
+
+    PROFILES = ("oltp", "olap", "mixed")
+    MIB = 1 << 20
+
+    def __init__(self, facts: HostFacts, profile: str = "mixed", max_connections: int = 200):
+        if profile not in self.PROFILES:
+            raise ValueError(f"pg_tuning_profile must be one of {', '.join(self.PROFILES)} (or 'off')")
+        self.facts = facts
+        self.profile = profile
+        self.max_connections = max(1, max_connections)
+
+    @staticmethod
+    def _mb(nbytes: float) -> str:
+        return f"{max(1, int(nbytes // (1 << 20)))}MB"
+
+    def parameters(self) -> dict[str, str]:
+        f = self.facts
+        mem = f.mem_bytes
+        cpus = f.cpus
+        olap = self.profile == "olap"
+
+        shared_buffers = mem // 4
+        effective_cache_size = mem * 3 // 4
+        maintenance_work_mem = min(mem // (8 if olap else 16), 2048 * self.MIB)
+
+        workers_per_gather = {"oltp": min(2, cpus // 4), "olap": cpus // 2, "mixed": cpus // 4}[self.profile]
+        workers_per_gather = max(0, min(workers_per_gather, 4))
+        max_parallel_workers = min(cpus, 8)
+        # Memory left after shared buffers, spread over connections x ~3 sort/hash nodes x parallel workers
+        per_query_nodes = 3 * max(1, workers_per_gather)
+        work_mem = (mem - shared_buffers) / (self.max_connections * per_query_nodes)
+        if olap:
+            # Few concurrent analytical queries with large sorts and hashes, but even if
+            # every connection runs one such node it must stay within half the free RAM
+            work_mem = min(work_mem * 4, (mem - shared_buffers) / (2 * self.max_connections))
+        work_mem = max(4 * self.MIB, work_mem)
+
+        small = mem < 4 << 30
+        ssd = f.rotational is not True  # unknown storage is treated as SSD (typical for VMs and SANs)
+        params = {
+            "shared_buffers": self._mb(shared_buffers),
+            "effective_cache_size": self._mb(effective_cache_size),
+            "work_mem": f"{int(work_mem // 1024)}kB",
+            "maintenance_work_mem": self._mb(maintenance_work_mem),
+            "wal_buffers": self._mb(min(shared_buffers // 32, 16 * self.MIB)),
+            "min_wal_size": "1GB" if small else ("4GB" if olap else "2GB"),
+            "max_wal_size": "4GB" if small else ("16GB" if olap else "8GB"),
+            "checkpoint_timeout": "30min" if olap else "15min",
+            "checkpoint_completion_target": "0.9",
+            "random_page_cost": "1.1" if ssd else "4",
+            "effective_io_concurrency": "200" if ssd else "2",
+            "default_statistics_target": "500" if olap else "100",
+            "max_parallel_workers_per_gather": str(workers_per_gather),
+            "max_parallel_workers": str(max_parallel_workers),
+            "max_parallel_maintenance_workers": str(max(1, min(4, cpus // 2))),
+        }
+        if shared_buffers >= 8 << 30:
+            params["huge_pages"] = "try"
+        return params
+
+
+# -----------------------------------------------------------------------------
+# Benchmark (pgbench)
+# -----------------------------------------------------------------------------
+def sql_literal(value: str) -> str:
+    """Quote value as an SQL string literal (standard_conforming_strings, the default since 9.1)."""
+    return "'" + value.replace("'", "''") + "'"
+
+
+def sql_ident(value: str) -> str:
+    """Quote value as an SQL identifier."""
+    return '"' + value.replace('"', '""') + '"'
+
+
+class PgBench:
+    """Thin pgbench driver: dataset init, timed runs with per-transaction logs, and result parsing."""
+
+    def __init__(self, binary: str, user: str, dbname: str, password: str = ""):
+        self.binary = binary
+        self.user = user
+        self.dbname = dbname
+        self.env = dict(os.environ, PGCONNECT_TIMEOUT="5")
+        if password:
+            self.env["PGPASSWORD"] = password
+
+    def _conn_args(self, host: str, port: int) -> list[str]:
+        return ["-h", host, "-p", str(port), "-U", self.user]
+
+    def init(self, host: str, port: int, scale: int, timeout: int = 3600) -> None:
+        cmd = [self.binary, "-i", "-q", "-s", str(scale)] + self._conn_args(host, port) + [self.dbname]
+        r = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout, env=self.env)
+        if r.returncode != 0:
+            raise RuntimeError(f"pgbench -i failed: {(r.stderr or r.stdout).strip()[-500:]}")
+
+    @staticmethod
+    def read_latencies(paths: list[Path]) -> array:
+        """Per-transaction latencies in ms from pgbench -l logs (third field is latency in µs)."""
+        out = array("d")
+        for p in paths:
+            with open(p, "r", encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) >= 3 and parts[2].isdigit():
+                        out.append(int(parts[2]) / 1000.0)
+        return out
+
+    def run(
+        self,
+        host: str,
+        port: int,
+        clients: int,
+        duration: int,
+        select_only: bool,
+        log_dir: Path,
+        tag: str,
+    ) -> dict[str, Any]:
+        """One timed run; returns tps, transaction count and latency percentiles (ms)."""
+        threads = max(1, min(clients, os.cpu_count() or 1))
+        prefix = log_dir / tag
+        cmd = [self.binary, "-n", "-c", str(clients), "-j", str(threads), "-T", str(duration),
+               "-l", f"--log-prefix={prefix}"]
+        if select_only:
+            cmd.append("-S")
+        cmd += self._conn_args(host, port) + [self.dbname]
+        r = subprocess.run(cmd, capture_output=True, text=True, timeout=duration + 120, env=self.env, cwd=str(log_dir))
+        logs = sorted(log_dir.glob(f"{tag}.*"))
+        try:
+            if r.returncode != 0:
+                raise RuntimeError((r.stderr or r.stdout).strip()[-500:] or f"pgbench exited {r.returncode}")
+            m = re.search(r"tps = ([\d.]+) \(without initial connection time\)", r.stdout) or re.search(r"tps = ([\d.]+)", r.stdout)
+            failed = re.search(r"number of failed transactions: (\d+)", r.stdout)
+            lat = self.read_latencies(logs)
+            values = sorted(lat)
+            return {
+                "tps": float(m.group(1)) if m else None,
+                "transactions": len(values),
+                "failed": int(failed.group(1)) if failed else 0,
+                "latency_ms": {
+                    "avg": round(sum(values) / len(values), 3) if values else None,
+                    "p50": round(percentile(values, 50), 3) if values else None,
+                    "p95": round(percentile(values, 95), 3) if values else None,
+                    "p99": round(percentile(values, 99), 3) if values else None,
+                    "max": round(values[-1], 3) if values else None,
+                },
+            }
+        finally:
+            for p in logs:
+                with contextlib.suppress(OSError):
+                    p.unlink()
+
+
+# -----------------------------------------------------------------------------
+# Failover Measurement
+# -----------------------------------------------------------------------------
+class WriteProbe:
+    """
+    Write loop through HAProxy that timestamps every attempt (time.monotonic()).
+
+    Uses psycopg2 with one persistent connection (reconnecting after any error)
+    when available, otherwise one psql process per write, which limits the
+    resolution to roughly the psql start-up time.
+    """
+
+    TABLE = "pg_ha_probe"
+
+    def __init__(self, host: str, port: int, user: str, password: str, dbname: str = "postgres",
+                 interval: float = 0.05, psql: str = "psql"):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.dbname = dbname
+        self.interval = interval
+        self.psql = psql
+        self.events: list[tuple[float, bool]] = []
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._conn: Any = None
+
+    @property
+    def driver(self) -> str:
+        return "psycopg2" if psycopg2 is not None else "psql"
+
+    def _sql(self) -> str:
+        return (f"INSERT INTO {self.TABLE} (id, at) VALUES (1, now()) "
+                "ON CONFLICT (id) DO UPDATE SET at = excluded.at")
+
+    def _write_psycopg2(self) -> bool:
+        try:
+            if self._conn is None:
+                self._conn = psycopg2.connect(
+                    host=self.host, port=self.port, user=self.user, password=self.password,
+                    dbname=self.dbname, connect_timeout=2, options="-c statement_timeout=1000",
+                )
+                self._conn.autocommit = True
+            with self._conn.cursor() as cur:
+                cur.execute(self._sql())
+            return True
+        except Exception:
+            if self._conn is not None:
+                with contextlib.suppress(Exception):
+                    self._conn.close()
+                self._conn = None
+            return False
+
+    def _write_psql(self) -> bool:
+        env = dict(os.environ, PGCONNECT_TIMEOUT="2", PGOPTIONS="-c statement_timeout=1000")
+        if self.password:
+            env["PGPASSWORD"] = self.password
+        try:
+            r = subprocess.run(
+                [self.psql, "-h", self.host, "-p", str(self.port), "-U", self.user, "-d", self.dbname,
+                 "-XAtq", "-v", "ON_ERROR_STOP=1", "-c", self._sql()],
+                capture_output=True, timeout=5, env=env,
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            return False
+        return r.returncode == 0
+
+    def write_once(self) -> bool:
+        return self._write_psycopg2() if psycopg2 is not None else self._write_psql()
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            t = time.monotonic()
+            ok = self.write_once()
+            self.events.append((time.monotonic() if ok else t, ok))
+            self._stop.wait(max(0.0, self.interval - (time.monotonic() - t)))
+
+    def start(self) -> None:
+        self.events = []
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="write-probe", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        if self._conn is not None:
+            with contextlib.suppress(Exception):
+                self._conn.close()
+            self._conn = None
+
+
+class ChangeWatcher:
+    """Poll a value every interval on a thread and record (time.monotonic(), value) whenever it changes."""
+
+    def __init__(self, read: Callable[[], Any], interval: float = 0.1, name: str = "watcher"):
+        self.read = read
+        self.interval = interval
+        self.name = name
+        self.changes: list[tuple[float, Any]] = []
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _loop(self) -> None:
+        last: Any = object()
+        while not self._stop.is_set():
+            try:
+                value = self.read()
+            except Exception:
+                value = None
+            if value is not None and value != last:
+                self.changes.append((time.monotonic(), value))
+                last = value
+            self._stop.wait(self.interval)
+
+    def start(self) -> None:
+        self.changes = []
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def first_change_after(self, t: float, initial: Any) -> Optional[tuple[float, Any]]:
+        return self.first_match_after(t, lambda v: v != initial)
+
+    def first_match_after(self, t: float, predicate: Callable[[Any], bool]) -> Optional[tuple[float, Any]]:
+        """First recorded (time, value) at or after t whose value satisfies predicate."""
+        return next(((ts, v) for ts, v in self.changes if ts >= t and predicate(v)), None)
+
+
+@dataclass
+class FailoverTrial:
+    """Timeline of one failover, in ms relative to the trigger (None if not observed)."""
+
+    trial: int
+    old_leader: str
+    candidate: str
+    new_leader: Optional[str] = None
+    last_write_ok_ms: Optional[float] = None
+    leader_change_ms: Optional[float] = None
+    haproxy_flip_ms: Optional[float] = None
+    first_write_ok_ms: Optional[float] = None
+    downtime_ms: Optional[float] = None
+    failed_writes: int = 0
+    error: str = ""
+
+    def to_dict(self) -> dict[str, Any]:
+        def r(v: Optional[float]) -> Optional[float]:
+            return round(v, 1) if v is not None else None
+
+        return {
+            "trial": self.trial,
+            "old_leader": self.old_leader,
+            "candidate": self.candidate,
+            "new_leader": self.new_leader,
+            "last_write_ok_ms": r(self.last_write_ok_ms),
+            "leader_change_ms": r(self.leader_change_ms),
+            "haproxy_flip_ms": r(self.haproxy_flip_ms),
+            "first_write_ok_ms": r(self.first_write_ok_ms),
+            "downtime_ms": r(self.downtime_ms),
+            "failed_writes": self.failed_writes,
+            "error": self.error,
+        }
+
+    @staticmethod
+    def analyze(trial: "FailoverTrial", t0: float, events: list[tuple[float, bool]]) -> None:
+        """
+        Fill write timings from probe events: downtime is the largest gap between
+        consecutive successful writes from the last one before the trigger on, so
+        writes that stall (up to the statement/connect timeout) count as well as
+        writes that fail. Nothing is set when no write succeeds after the trigger.
+        """
+        def ms(t: float) -> float:
+            return (t - t0) * 1000
+
+        before = [t for t, ok in events if ok and t < t0]
+        after = [t for t, ok in events if ok and t >= t0]
+        if not after:
+            if before:
+                trial.last_write_ok_ms = ms(before[-1])
+            trial.failed_writes = sum(1 for t, ok in events if t >= t0 and not ok)
+            return
+        points = before[-1:] + after
+        if not before:
+            points.insert(0, t0)
+        start, end = max(zip(points, points[1:]), key=lambda gap: gap[1] - gap[0])
+        if before or start != t0:
+            trial.last_write_ok_ms = ms(start)
+        trial.first_write_ok_ms = ms(end)
+        trial.downtime_ms = (end - start) * 1000
+        trial.failed_writes = sum(1 for t, ok in events if start <= t < end and not ok)
+
+
+# -----------------------------------------------------------------------------
+# Base Backups
+# -----------------------------------------------------------------------------
+class BackupProgress:
+    """
+    Throughput and ETA from pg_basebackup -P lines ("123/4567 kB (2%), 0/1 tablespace").
+
+    The rate is an exponentially weighted average of per-line rates, so a short
+    stall or burst moves the ETA gradually instead of making it jump.
+    """
+
+    LINE_RE = re.compile(r"(\d+)/(\d+) kB \((\d+)%\)")
+
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self.done_kb = 0
+        self.total_kb = 0
+        self.rate_kb_s: Optional[float] = None
+        self._last: Optional[tuple[float, int]] = None
+
+    def feed(self, line: str, now: Optional[float] = None) -> bool:
+        """Parse one progress line; returns False if it is not one."""
+        m = self.LINE_RE.search(line)
+        if not m:
+            return False
+        now = time.monotonic() if now is None else now
+        done, total = int(m.group(1)), int(m.group(2))
+        if self._last is not None and now > self._last[0]:
+            rate = max(0, done - self._last[1]) / (now - self._last[0])
+            self.rate_kb_s = rate if self.rate_kb_s is None else self.alpha * rate + (1 - self.alpha) * self.rate_kb_s
+        self._last = (now, done)
+        self.done_kb, self.total_kb = done, total
+        return True
+
+    @property
+    def percent(self) -> float:
+        return min(100.0, 100.0 * self.done_kb / self.total_kb) if self.total_kb else 0.0
+
+    @property
+    def eta_seconds(self) -> Optional[float]:
+        if not self.rate_kb_s:
+            return None
+        return max(0, self.total_kb - self.done_kb) / self.rate_kb_s
+
+    def format(self) -> str:
+        gb = 1024 * 1024
+        rate = f"{self.rate_kb_s / 1024:7.1f} MB/s" if self.rate_kb_s is not None else "      - MB/s"
+        eta = self.eta_seconds
+        eta_text = str(timedelta(seconds=int(eta))) if eta is not None else "-"
+        return (f"{self.done_kb / gb:8.2f} / {self.total_kb / gb:.2f} GB ({self.percent:5.1f}%)  "
+                f"{rate}  ETA {eta_text}")
+
+
+class PgBaseBackup:
+    """
+    pg_basebackup driver: builds the command line and streams -P progress.
+
+    Compression is a PostgreSQL 17 --compress spec: "server-zstd" compresses on the
+    source server (less network, no client CPU), "zstd" on this host; zstd runs with
+    `workers` threads unless the spec sets them. gzip is single-threaded either way.
+    """
+
+    def __init__(self, binary: str, host: str, port: int, user: str, password: str = "", run_as: str = "postgres"):
+        self.binary = binary
+        self.host = host
+        self.port = port
+        self.user = user
+        self.run_as = run_as
+        self.env = dict(os.environ, PGCONNECT_TIMEOUT="10")
+        if password:
+            self.env["PGPASSWORD"] = password
+
+    @staticmethod
+    def plain_compression(spec: str) -> str:
+        """Client-side compression spec as its server-side equivalent; -Fp only accepts the latter."""
+        spec = (spec or "").strip()
+        method, _, detail = spec.partition(":")
+        if not method or method == "none" or method.startswith("server-"):
+            return spec
+        if method.isdigit():  # legacy --compress=LEVEL means client-side gzip
+            return f"server-gzip:level={method}"
+        return f"server-{method.removeprefix('client-')}" + (f":{detail}" if detail else "")
+
+    @staticmethod
+    def compress_spec(spec: str, workers: int = 0) -> str:
+        """Add workers=N to a zstd spec that has no detail for it; "" or "none" means uncompressed.
+
+        Client-side zstd defaults to half this host's CPUs. server-zstd runs on the backup
+        source, whose CPUs are also serving queries, so it gets workers only when configured.
+        """
+        spec = (spec or "").strip()
+        if not spec or spec == "none":
+            return ""
+        method = spec.split(":", 1)[0]
+        if method.endswith("zstd") and "workers=" not in spec:
+            if not workers:
+                if method.startswith("server-"):
+                    return spec
+                workers = max(1, min(8, (os.cpu_count() or 2) // 2))
+            spec += ("," if ":" in spec else ":") + f"workers={workers}"
+        return spec
+
+    def command(
+        self,
+        target: str,
+        fmt: str = "tar",
+        compress: str = "",
+        max_rate: str = "",
+        incremental: Optional[str] = None,
+        label: str = "pg_ha_setup",
+        manifest_checksums: str = "",
+    ) -> list[str]:
+        cmd = [
+            self.binary,
+            "-h", self.host, "-p", str(self.port), "-U", self.user, "-w",
+            "-D", target,
+            "-F", "t" if fmt == "tar" else "p",
+            "-X", "stream", "-c", "fast", "-P", "-l", label,
+        ]
+        if compress:
+            cmd += ["--compress", compress]
+        if max_rate:
+            cmd += ["--max-rate", max_rate]
+        if incremental:
+            cmd += ["--incremental", incremental]
+        if manifest_checksums:
+            cmd += ["--manifest-checksums", manifest_checksums]
+        if self.run_as and hasattr(os, "geteuid") and os.geteuid() == 0:
+            cmd = ["sudo", "--preserve-env=PGPASSWORD", "-u", self.run_as] + cmd
+        return cmd
+
+    def run(self, cmd: list[str], on_progress: Optional[Callable[[BackupProgress], None]] = None) -> tuple[int, str]:
+        """
+        Run to completion (no timeout: large backups take hours). Progress lines end
+        in CR on a terminal and LF otherwise; both are handled. Returns the exit code
+        and the last non-progress output lines.
+        """
+        progress = BackupProgress()
+        tail: deque[str] = deque(maxlen=20)
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL, env=self.env)
+        assert proc.stderr is not None
+        buf = b""
+        while True:
+            chunk = proc.stderr.read1(65536) if hasattr(proc.stderr, "read1") else proc.stderr.read(4096)
+            if not chunk:
+                break
+            buf += chunk
+            *lines, buf = re.split(rb"[\r\n]", buf)
+            for raw in lines:
+                line = raw.decode("utf-8", "replace").strip()
+                if not line:
+                    continue
+                if progress.feed(line):
+                    if on_progress:
+                        on_progress(progress)
+                else:
+                    tail.append(line)
+        if buf.strip():
+            tail.append(buf.decode("utf-8", "replace").strip())
+        return proc.wait(), "\n".join(tail)
+
+    @staticmethod
+    def size_of(path: str) -> int:
+        total = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                with contextlib.suppress(OSError):
+                    total += os.path.getsize(os.path.join(root, name))
+        return total
+
+
+class BackupCatalog:
+    """
+    Index of the backups under backup_dir (catalog.json): type, parent, LSN range,
+    size and duration per backup, so incremental chains can be extended, pruned
+    and combined. Written atomically (temp file + rename).
+    """
+
+    FILE = "catalog.json"
+
+    def __init__(self, backup_dir: str):
+        self.path = os.path.join(backup_dir, self.FILE)
+        self.backups: list[dict[str, Any]] = []
+        with contextlib.suppress(FileNotFoundError):
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.backups = json.load(f).get("backups", [])
+
+    def save(self) -> None:
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"backups": self.backups}, f, indent=2)
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def manifest_info(backup_path: str) -> dict[str, Any]:
+        """Timeline and WAL LSN range from a PostgreSQL backup_manifest."""
+        with open(os.path.join(backup_path, "backup_manifest"), "r", encoding="utf-8") as f:
+            ranges = json.load(f).get("WAL-Ranges") or []
+        if not ranges:
+            return {}
+        return {
+            "timeline": ranges[-1].get("Timeline"),
+            "start_lsn": ranges[0].get("Start-LSN"),
+            "end_lsn": ranges[-1].get("End-LSN"),
+        }
+
+    def add(self, entry: dict[str, Any]) -> None:
+        self.backups.append(entry)
+        self.save()
+
+    def get(self, backup_id: str) -> Optional[dict[str, Any]]:
+        return next((b for b in self.backups if b["id"] == backup_id), None)
+
+    def latest(self) -> Optional[dict[str, Any]]:
+        return max(self.backups, key=lambda b: b["id"]) if self.backups else None
+
+    def chain(self, backup_id: str) -> list[dict[str, Any]]:
+        """Backups needed to restore backup_id, full backup first. Raises ValueError if one is missing."""
+        out = []
+        entry = self.get(backup_id)
+        while entry is not None:
+            out.append(entry)
+            if not entry.get("parent"):
+                return out[::-1]
+            parent = self.get(entry["parent"])
+            if parent is None or not os.path.isdir(parent["path"]):
+                raise ValueError(f"backup {entry['id']} needs missing parent {entry['parent']}")
+            entry = parent
+        raise ValueError(f"unknown backup {backup_id}")
+
+    def expired(self, keep_full: int) -> list[dict[str, Any]]:
+        """Backups whose chain starts before the newest keep_full full backups (0 keeps everything)."""
+        fulls = sorted((b for b in self.backups if b["type"] == "full"), key=lambda b: b["id"])
+        if keep_full <= 0 or len(fulls) <= keep_full:
+            return []
+        oldest_kept = fulls[-keep_full]["id"]
+        return [b for b in self.backups if b["id"] < oldest_kept]
+
+    def remove(self, ids: set[str]) -> None:
+        self.backups = [b for b in self.backups if b["id"] not in ids]
+        self.save()
+
+
+def _crc32c_table() -> list[int]:
+    table = []
+    for n in range(256):
+        c = n
+        for _ in range(8):
+            c = (c >> 1) ^ 0x82F63B78 if c & 1 else c >> 1
+        table.append(c)
+    return table
+
+
+_CRC32C_TABLE = _crc32c_table()
+
+
+def crc32c(data: bytes, crc: int = 0) -> int:
+    """CRC-32C (Castagnoli), the backup_manifest default. Pure Python, so slow: prefer SHA256 manifests."""
+    table = _CRC32C_TABLE
+    crc ^= 0xFFFFFFFF
+    for b in data:
+        crc = table[(crc ^ b) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+class ManifestChecksum:
+    """Incremental checksum matching a backup_manifest "Checksum-Algorithm"."""
+
+    def __init__(self, algorithm: str):
+        self.algorithm = (algorithm or "NONE").upper()
+        self._crc = 0
+        self._hash = hashlib.new(self.algorithm.lower()) if self.algorithm.startswith("SHA") else None
+
+    def update(self, data: bytes) -> None:
+        if self._hash is not None:
+            self._hash.update(data)
+        elif self.algorithm == "CRC32C":
+            self._crc = crc32c(data, self._crc)
+
+    def hexdigest(self) -> Optional[str]:
+        if self._hash is not None:
+            return self._hash.hexdigest()
+        if self.algorithm == "CRC32C":
+            # PostgreSQL writes the uint32 in host (little-endian) byte order
+            return self._crc.to_bytes(4, "little").hex()
+        return None
+
+
+class BackupVerifier:
+    """
+    Check one backup against its backup_manifest.
+
+    Plain backups go through pg_verifybackup (file checksums plus WAL). Tar backups,
+    which pg_verifybackup in PostgreSQL 17 cannot read, are streamed member by member
+    (gzip natively, zstd / lz4 through their command-line decompressors) and each file's
+    size and checksum is compared with the manifest. tasks() splits the work per
+    archive so several backups and archives can share one bounded worker pool.
+    """
+
+    IGNORE = ("backup_info.json", "verification.json")
+    CHUNK = 1 << 20
+
+    def __init__(self, path: str, pg_verifybackup: Optional[str] = None):
+        self.path = path
+        self.pg_verifybackup = pg_verifybackup
+        with open(os.path.join(path, "backup_manifest"), "rb") as f:
+            self.raw_manifest = f.read()
+        self.manifest = json.loads(self.raw_manifest.decode("utf-8"))
+        self.files = {e["Path"]: e for e in self.manifest.get("Files", [])}
+
+    def manifest_errors(self) -> list[str]:
+        """The manifest's own SHA256 covers every byte before its last line."""
+        expected = self.manifest.get("Manifest-Checksum")
+        idx = self.raw_manifest.rfind(b'"Manifest-Checksum"')
+        if not expected or idx < 0:
+            return ["backup_manifest has no Manifest-Checksum"]
+        if hashlib.sha256(self.raw_manifest[:idx]).hexdigest() != expected:
+            return ["backup_manifest checksum mismatch"]
+        return []
+
+    def archives(self) -> list[Path]:
+        """base.tar* and tablespace <oid>.tar* (WAL in pg_wal.tar* is not in the manifest's file list)."""
+        return sorted(p for p in Path(self.path).glob("*.tar*") if not p.name.startswith("pg_wal."))
+
+    def tasks(self) -> list[tuple[str, Callable[[], dict[str, Any]]]]:
+        archives = self.archives()
+        if not archives:
+            return [(f"{self.path}", self._run_pg_verifybackup)]
+        return [(f"{p}", functools.partial(self._verify_archive, p)) for p in archives]
+
+    def _run_pg_verifybackup(self) -> dict[str, Any]:
+        if not self.pg_verifybackup or not os.path.exists(self.pg_verifybackup):
+            return self._verify_plain_files()
+        cmd = [self.pg_verifybackup, "-q"]
+        for name in self.IGNORE:
+            cmd += ["-i", name]
+        r = subprocess.run(cmd + [self.path], capture_output=True, text=True)
+        errors = [line for line in (r.stdout + r.stderr).splitlines() if line.strip()]
+        if r.returncode != 0 and not errors:
+            errors = [f"pg_verifybackup exited {r.returncode}"]
+        return {
+            "method": "pg_verifybackup",
+            "files": len(self.files),
+            "bytes": sum(e.get("Size", 0) for e in self.files.values()),
+            "errors": errors,
+            "seen": set(self.files),
+        }
+
+    def _verify_plain_files(self) -> dict[str, Any]:
+        errors: list[str] = []
+        total = 0
+        for rel, entry in self.files.items():
+            try:
+                with open(os.path.join(self.path, rel), "rb") as f:
+                    total += self._check(rel, f, entry, errors)
+            except OSError as e:
+                errors.append(f"{rel}: {e.strerror}")
+        return {"method": "manifest", "files": len(self.files), "bytes": total, "errors": errors, "seen": set(self.files)}
+
+    def _check(self, rel: str, f: Any, entry: dict[str, Any], errors: list[str]) -> int:
+        checksum = ManifestChecksum(entry.get("Checksum-Algorithm", "NONE"))
+        size = 0
+        while True:
+            chunk = f.read(self.CHUNK)
+            if not chunk:
+                break
+            size += len(chunk)
+            checksum.update(chunk)
+        if size != entry.get("Size"):
+            errors.append(f"{rel}: size {size}, manifest {entry.get('Size')}")
+        else:
+            digest = checksum.hexdigest()
+            if digest is not None and digest != entry.get("Checksum"):
+                errors.append(f"{rel}: {checksum.algorithm} checksum mismatch")
+        return size
+
+    def _verify_archive(self, archive: Path) -> dict[str, Any]:
+        name = archive.name
+        prefix = "" if name.startswith("base.") else f"pg_tblspc/{name.split('.', 1)[0]}/"
+        decompress = {".zst": "zstd", ".lz4": "lz4"}.get(archive.suffix)
+        errors: list[str] = []
+        seen: set[str] = set()
+        total = 0
+        proc = None
+        try:
+            if decompress:
+                proc = subprocess.Popen([decompress, "-dc", str(archive)], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                tar = tarfile.open(fileobj=proc.stdout, mode="r|")
+            else:
+                tar = tarfile.open(str(archive), "r|gz" if archive.suffix == ".gz" else "r|")
+            with tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    rel = prefix + member.name
+                    entry = self.files.get(rel)
+                    if entry is None:
+                        errors.append(f"{rel}: in {name} but not in the manifest")
+                        continue
+                    seen.add(rel)
+                    f = tar.extractfile(member)
+                    if f is not None:
+                        total += self._check(rel, f, entry, errors)
+        except (OSError, tarfile.TarError) as e:
+            errors.append(f"{name}: {e}")
+        finally:
+            if proc is not None:
+                proc.kill()
+                proc.wait()
+        return {"method": "tar-stream", "files": len(seen), "bytes": total, "errors": errors, "seen": seen}
+
+    def missing(self, seen: set[str]) -> list[str]:
+        return [f"{rel}: in the manifest but not in the backup" for rel in self.files if rel not in seen]
+
+
+# -----------------------------------------------------------------------------
+# Main HA Setup Class
+# -----------------------------------------------------------------------------
+class PGHASetup:
+    """PostgreSQL HA Setup orchestrator."""
+
+    # Steps runnable per node (`step` command / fleet mode): (step, method, scope).
+    # scope "all" runs on every node at once; "first" only on etcd_nodes[0].
+    FLEET_STEPS = [
+        ("open_firewall_ports", "_open_ports_interactive", "all"),
+        ("install_packages", "install_packages", "all"),
+        ("configure_etcd", "configure_etcd", "all"),
+        ("install_postgresql17", "install_postgresql17", "all"),
+        ("configure_patroni", "configure_patroni", "all"),
+        ("configure_haproxy", "configure_haproxy", "first"),
+        ("configure_selinux", "configure_selinux", "all"),
+        ("initialize_cluster", "initialize_cluster", "all"),
+    ]
+    # Barriers that must pass on the whole fleet before a step starts anywhere
+    FLEET_BARRIERS = {"initialize_cluster": "etcd_quorum"}
+
+    def __init__(self, config: Optional[HAConfig] = None, config_file: Optional[str] = None):
+        self.config = config or HAConfig()
+        self.config_file = config_file
+        # False for `step` (fleet) runs: values that would be prompted for must come from config
+        self.interactive = True
+        if config_file:
+            self._load_yaml_config(config_file)
+        self.firewall = FirewallManager(self.config)
+        self.port_validator = PortValidator()
+
+    def _db_port(self) -> int:
+        """Return effective PostgreSQL port (5432 or IntelliDB 5555)."""
+        try:
+            if getattr(self.config, "use_intellidb", False):
+                return int(getattr(self.config, "intellidb_port", 5555))
+        except Exception:
+            pass
+        return 5432
+
+    def _load_yaml_config(self, path: str) -> None:
+        """Load configuration from YAML file."""
+        if not yaml:
+            logger.warning("PyYAML not installed. Install with: pip install pyyaml")
+            return
+        path_obj = Path(path)
+        if not path_obj.exists():
+            raise FileNotFoundError(f"Configuration file not found: {path}")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = yaml.safe_load(f)
+            if not data:
+                return
+            for key, val in data.items():
+                if hasattr(self.config, key):
+                    setattr(self.config, key, val)
+            self._validate_config()
+            logger.info("Loaded config from %s", path)
+        except FileNotFoundError:
+            raise
+        except Exception as e:
+            logger.error("Failed to load YAML config: %s", e)
+            raise
+
+    def _validate_config(self) -> None:
+        """Validate configuration consistency."""
+        if not isinstance(self.config.etcd_nodes, list) or not isinstance(self.config.etcd_ips, list):
+            raise ValueError("etcd_nodes and etcd_ips must be YAML lists (e.g. [node1, node2, node3])")
+        if len(self.config.etcd_nodes) != len(self.config.etcd_ips):
+            raise ValueError(
+                "etcd_nodes and etcd_ips must have the same length. "
+                f"Got {len(self.config.etcd_nodes)} nodes and {len(self.config.etcd_ips)} IPs."
+            )
+        if self.config.current_node and self.config.current_node not in self.config.etcd_nodes:
+            logger.warning(
+                "current_node '%s' is not in etcd_nodes %s",
+                self.config.current_node,
+                self.config.etcd_nodes,
+            )
+        if len(self.config.etcd_nodes) != 3:
+            logger.warning("etcd cluster should have 3 nodes for quorum. Got %d.", len(self.config.etcd_nodes))
+
+    def _require_root(self) -> bool:
+        """Ensure running as root."""
+        if os.geteuid() != 0:
+            print(Colors.fail("This application must be run as root."))
+            logger.error("Not running as root")
+            return False
+        return True
+
+    def _validate_rhel9(self) -> bool:
+        """Validate RHEL 9 (or compatible)."""
+        try:
+            with open("/etc/os-release", "r", encoding="utf-8") as f:
+                content = f.read()
+            if "rhel" in content.lower() or "centos" in content.lower() or "rocky" in content.lower():
+                if "9" in content or "stream" in content.lower():
+                    return True
+            if "almalinux" in content.lower() and "9" in content:
+                return True
+            logger.warning("OS may not be RHEL 9 compatible. Proceed with caution.")
+            return True  # Allow on other EL9-like
+        except Exception as e:
+            logger.error("Could not read os-release: %s", e)
+            return False
+
+    def _pkg_manager(self) -> str:
+        """Return package manager command: 'dnf' if available, else 'yum' (for customer sites where dnf is not working)."""
+        try:
+            r = subprocess.run(
+                ["dnf", "--version"],
+                capture_output=True,
+                text=True,
+                timeout=5,
+            )
+            if r.returncode == 0:
+                return "dnf"
+        except (FileNotFoundError, subprocess.TimeoutExpired):
+            pass
+        return "yum"
+
+    def _run_cmd(
+        self,
+        cmd: list[str],
+        check: bool = True,
+        capture: bool = True,
         timeout: int = 60,
     ) -> subprocess.CompletedProcess:
         """Run command with optional dry-run."""
@@ -573,6 +3810,59 @@ class PGHASetup:
             logger.error("Command timed out: %s", " ".join(cmd))
             raise
 
+    def _stream_cmd(self, cmd: list[str], tag: str, timeout: int = 300) -> int:
+        """Run command, echoing each output line live with a [tag] prefix. Returns exit code."""
+        if self.config.dry_run:
+            tagged_print(tag, f"[DRY-RUN] Would run: {' '.join(cmd)}")
+            return 0
+        logger.debug("[%s] running: %s", tag, " ".join(cmd))
+        try:
+            proc = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                stdin=subprocess.DEVNULL,
+                text=True,
+                bufsize=1,
+            )
+        except FileNotFoundError as e:
+            tagged_print(tag, str(e))
+            return 127
+        timer = threading.Timer(timeout, proc.kill)
+        timer.start()
+        try:
+            assert proc.stdout is not None
+            for line in proc.stdout:
+                line = line.rstrip()
+                if line:
+                    tagged_print(tag, line)
+                    logger.debug("[%s] %s", tag, line)
+            rc = proc.wait()
+        finally:
+            timer.cancel()
+        if rc < 0:
+            tagged_print(tag, f"Killed after {timeout}s timeout")
+        return rc
+
+    def _psql(self, host: str, sql: str, dbname: str = "postgres", timeout: int = 10) -> list[list[str]]:
+        """Run a read-only query as the superuser; returns rows of tab-separated fields."""
+        db_port, bin_dir, _, superuser_name = self._patroni_layout()
+        psql = os.path.join(bin_dir, "psql")
+        env = dict(os.environ, PGCONNECT_TIMEOUT="3")
+        if self.config.postgres_password:
+            env["PGPASSWORD"] = self.config.postgres_password
+        r = subprocess.run(
+            [psql if os.path.exists(psql) else "psql", "-h", host, "-p", str(db_port), "-U", superuser_name,
+             "-d", dbname, "-XAtq", "-F", "\t", "-v", "ON_ERROR_STOP=1", "-c", sql],
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+            env=env,
+        )
+        if r.returncode != 0:
+            raise RuntimeError((r.stderr or r.stdout).strip() or f"psql exited {r.returncode}")
+        return [line.split("\t") for line in r.stdout.splitlines() if line]
+
     # -------------------------------------------------------------------------
     # Menu Handlers
     # -------------------------------------------------------------------------
@@ -650,24 +3940,25 @@ class PGHASetup:
             print(Colors.fail("firewalld is not running."))
             print("Start with: systemctl start firewalld && systemctl enable firewalld")
             return
-        db_port = self._db_port()
-        ports = [db_port, 8008, 2379, 2380, self.config.haproxy_port]
-        if self.config.read_replica_port and self.config.read_replica_port not in ports:
-            ports.append(self.config.read_replica_port)
+        ports = self.firewall.required_ports()
         print(f"Opening ports: {ports}")
         if self.firewall.open_required_ports():
-            print(Colors.success("All ports opened and firewall reloaded."))
+            print(Colors.success("All required ports are open (firewall reloaded only if rules changed)."))
         else:
             print(Colors.fail("Some ports could not be opened. Check logs."))
 
     def _verify_ports_interactive(self) -> None:
         """Verify which ports are open."""
         ports = [self._db_port(), 8008, 2379, 2380, self.config.haproxy_port]
-        result = self.firewall.verify_ports_open(ports)
+        state = self.firewall.get_state()
+        result = self.firewall.verify_ports_open(ports, state=state)
         print()
+        print(f"  Zone: {state.zone or 'unknown'} (read via {state.source})")
         for port, open_ in result.items():
             status = Colors.success("OPEN") if open_ else Colors.fail("CLOSED")
             print(f"  Port {port}: {status}")
+        for rule in state.rich_rules:
+            print(f"  Rich rule: {rule}")
 
     def _close_port_interactive(self) -> None:
         """Close a specific port."""
@@ -703,24 +3994,64 @@ class PGHASetup:
         print(Colors.header("Active listening services (ss -tulnp):"))
         print(output or "No output (ss not available)")
 
-    def _validate_node_connectivity(self) -> None:
-        """Validate TCP connectivity between cluster nodes."""
-        print()
-        print(Colors.header("Validate Connectivity Between Nodes"))
-        print("-" * 50)
-        nodes = list(zip(self.config.etcd_nodes, self.config.etcd_ips))
+    def _connectivity_matrix(self) -> list[ProbeResult]:
+        """Probe every (node, port) pair concurrently."""
         ports_to_check = [
             (2379, "etcd client"),
             (2380, "etcd peer"),
             (self._db_port(), "PostgreSQL / IntelliDB"),
             (8008, "Patroni REST"),
         ]
-        for node_name, ip in nodes:
-            print(f"\nFrom this host to {node_name} ({ip}):")
-            for port, desc in ports_to_check:
-                ok = self.port_validator.validate_connectivity(ip, port)
-                status = Colors.success("OK") if ok else Colors.fail("FAIL")
-                print(f"  {desc} ({port}): {status}")
+        targets = [
+            (node_name, ip, port, desc)
+            for node_name, ip in zip(self.config.etcd_nodes, self.config.etcd_ips)
+            for port, desc in ports_to_check
+        ]
+        return ConnectivityProbe().probe(targets)
+
+    def _validate_node_connectivity(self) -> None:
+        """Validate TCP connectivity between cluster nodes."""
+        print()
+        print(Colors.header("Validate Connectivity Between Nodes"))
+        print("-" * 50)
+        t0 = time.perf_counter()
+        results = self._connectivity_matrix()
+        elapsed = time.perf_counter() - t0
+        current = None
+        for r in results:
+            if r.node != current:
+                current = r.node
+                print(f"\nFrom this host to {r.node} ({r.host}):")
+            if r.ok:
+                status = Colors.success("OK")
+                rtt = f"rtt min/avg/max {r.rtt_min:.2f}/{r.rtt_avg:.2f}/{r.rtt_max:.2f} ms"
+                if r.lost:
+                    rtt += Colors.warn(f"  ({r.lost}/{r.attempts} attempts lost)")
+                print(f"  {r.description} ({r.port}): {status}  {rtt}")
+            else:
+                print(f"  {r.description} ({r.port}): {Colors.fail('FAIL')}  ({r.error or 'unreachable'})")
+        print(f"\nChecked {len(results)} targets in {elapsed:.2f}s")
+
+    def run_connectivity_check(self, json_output: bool = False) -> int:
+        """Non-interactive connectivity matrix. Returns exit code (0 = all reachable)."""
+        results = self._connectivity_matrix()
+        if json_output:
+            print(json.dumps({"source": socket.gethostname(), "results": [r.to_dict() for r in results]}, indent=2))
+        else:
+            self._print_connectivity_table(results)
+        return 0 if all(r.ok for r in results) else 1
+
+    @staticmethod
+    def _print_connectivity_table(results: list[ProbeResult]) -> None:
+        print(f"{'NODE':<12} {'HOST':<16} {'PORT':>5}  {'STATUS':<6} {'MIN ms':>8} {'AVG ms':>8} {'MAX ms':>8}  LOST")
+        for r in results:
+            if r.ok:
+                print(
+                    f"{r.node:<12} {r.host:<16} {r.port:>5}  {'OK':<6} "
+                    f"{r.rtt_min:>8.2f} {r.rtt_avg:>8.2f} {r.rtt_max:>8.2f}  {r.lost}/{r.attempts}"
+                )
+            else:
+                print(f"{r.node:<12} {r.host:<16} {r.port:>5}  {'FAIL':<6} {r.error or 'unreachable'}")
 
     def _show_bind_guidance(self) -> None:
         """Show guidance for binding services to specific interface."""
@@ -785,9 +4116,9 @@ Firewall: Use --add-source for restricted access
             status = Colors.success("OK") if ok else Colors.fail("FAIL")
             print(f"  {name}: {status}")
 
-    @retry(max_attempts=2, delay=5.0, exceptions=(subprocess.CalledProcessError,))
+    @retry(max_attempts=2, delay=5.0, exceptions=(RuntimeError,))  # a retry re-checks and installs only what is still missing
     def install_packages(self) -> None:
-        """Install required packages."""
+        """Install required packages that are not already installed."""
         if not self._require_root():
             return
         print(Colors.header("\n=== Installing Required Packages ===\n"))
@@ -799,6 +4130,10 @@ Firewall: Use --add-source for restricted access
         #
         # It does NOT attempt to download anything from the public internet,
         # making it safe for offline/air-gapped environments.
+        #
+        # One RPM database query (plus etcd/Patroni version probes) decides
+        # what is missing; nothing is run when everything is installed.
+        inventory = PackageInventory()
 
         # 1) Prefer RPMs staged in current directory or ./rpms/ (Docker download output)
         rpm_files = sorted(str(p) for p in Path(".").glob("*.rpm"))
@@ -806,15 +4141,7 @@ Firewall: Use --add-source for restricted access
         if rpms_dir.is_dir():
             rpm_files.extend(sorted(str(p) for p in rpms_dir.glob("*.rpm")))
         rpm_files = list(dict.fromkeys(rpm_files))  # keep order, no duplicates
-        if rpm_files:
-            print(Colors.info("Installing local RPMs from current directory and ./rpms/:"))
-            for f in rpm_files:
-                print(f"  - {f}")
-            pkg = self._pkg_manager()
-            try:
-                self._run_cmd([pkg, "install", "-y"] + rpm_files, timeout=300, check=False)
-            except Exception as e:
-                print(Colors.warn(f"Local RPM install failed (continuing to repo-based install): {e}"))
+        missing_files = inventory.missing_rpm_files(rpm_files)
 
         # 2) Fallback to package names from configured local/internal repos
         rpms_dir = Path("rpms").resolve()
@@ -832,76 +4159,135 @@ Firewall: Use --add-source for restricted access
             packages.append("etcd")
         if not have_patroni_wheels:
             packages.append("patroni")
-        pkg = self._pkg_manager()
-        cmd = [pkg, "install", "-y"] + packages
-        try:
-            self._run_cmd(cmd, timeout=300)
-            print(Colors.success("Packages installed."))
-        except Exception as e:
-            print(Colors.fail(f"Installation failed: {e}"))
-            print(
-                Colors.warn(
-                    "Ensure all required RPMs are present in local/yum repos or in ./rpms/; "
-                    "this setup does not download packages from the internet."
-                )
+        # Local RPMs about to be installed cover their package names
+        staged = {PackageInventory.rpm_name(f) for f in missing_files}
+        missing_packages = [p for p in inventory.missing_packages(packages) if p not in staged]
+
+        # 3) Offline etcd tarball: prefer 3.5.x (has v2 API required by Patroni); etcd 3.6+ removed v2.
+        etcd_installer = EtcdBinaryInstaller(dry_run=self.config.dry_run)
+        tarball = EtcdBinaryInstaller.find_tarball([rpms_dir])
+        if tarball is not None and etcd_installer.is_current(tarball):
+            print(Colors.success(f"etcd {PackageInventory.tarball_version(tarball)} already installed"))
+            tarball = None
+
+        # 4) Offline Patroni wheels
+        wheels_dir = rpms_dir / "patroni-wheels"
+        patroni_wheel = None
+        if rpms_dir.is_dir() and wheels_dir.is_dir():
+            wheels = sorted(wheels_dir.glob("patroni-*.whl"))
+            if wheels:
+                patroni_wheel = wheels[-1]
+                installed_patroni = inventory.patroni_version()
+                if installed_patroni and installed_patroni == PackageInventory.wheel_version(patroni_wheel):
+                    print(Colors.success(f"Patroni {installed_patroni} already installed"))
+                    patroni_wheel = None
+
+        if not (missing_files or missing_packages or tarball or patroni_wheel):
+            print(Colors.success("All required packages are already installed; nothing to do."))
+            return
+
+        # The three stages are independent; run them concurrently with
+        # tagged, line-streamed output and report all failures at the end.
+        def rpm_stage() -> None:
+            nonlocal missing_packages
+            pkg = self._pkg_manager()
+            if missing_files:
+                tagged_print("rpm", "Installing local RPMs: " + " ".join(missing_files))
+                if self._stream_cmd([pkg, "install", "-y"] + missing_files, "rpm", timeout=300) != 0:
+                    tagged_print("rpm", "Local RPM install failed (continuing to repo-based install)")
+                if missing_packages:
+                    inventory.refresh()
+                    missing_packages = inventory.missing_packages(missing_packages)
+            if missing_packages:
+                tagged_print("rpm", "Installing from repositories: " + ", ".join(missing_packages))
+                if self._stream_cmd([pkg, "install", "-y"] + missing_packages, "rpm", timeout=300) != 0:
+                    raise RuntimeError(
+                        "repository install failed; ensure all required RPMs are present in "
+                        "local/yum repos or in ./rpms/ (this setup does not download from the internet)"
+                    )
+
+        def etcd_stage() -> None:
+            assert tarball is not None
+            tagged_print("etcd", f"Installing etcd from {tarball.name}")
+            etcd_installer.install(tarball, force=True)
+            tagged_print("etcd", f"etcd binaries installed to {etcd_installer.bin_dir}")
+
+        def patroni_stage() -> None:
+            tagged_print("patroni", "Installing Patroni from rpms/patroni-wheels")
+            rc = self._stream_cmd(
+                ["pip3", "install", "--no-index", f"--find-links={wheels_dir}", "patroni"],
+                "patroni",
+                timeout=120,
             )
+            if rc != 0:
+                raise RuntimeError(
+                    "pip install failed; run: pip3 install --no-index --find-links=./rpms/patroni-wheels patroni"
+                )
 
-        # 3) Offline: install etcd from rpms/ tarball if present.
-        # Prefer 3.5.x (has v2 API required by Patroni); etcd 3.6+ removed v2.
-        if rpms_dir.is_dir():
-            etcd_tarballs = sorted(rpms_dir.glob("etcd-v*-linux-amd64.tar.gz"))
-            if etcd_tarballs and not self.config.dry_run:
-                def _etcd_version_key(p: Path) -> tuple:
-                    name = p.stem.replace(".tar", "")
-                    m = re.search(r"etcd-v(\d+)\.(\d+)\.(\d+)", name)
-                    return (int(m.group(1)), int(m.group(2)), int(m.group(3))) if m else (0, 0, 0)
-                v35 = [p for p in etcd_tarballs if _etcd_version_key(p)[1] == 5]
-                tarball = sorted(v35, key=_etcd_version_key)[-1] if v35 else etcd_tarballs[-1]
-                print(Colors.info(f"Installing etcd from {tarball.name}"))
-                try:
-                    self._run_cmd(["tar", "xzf", str(tarball), "-C", "/tmp"], timeout=30)
-                    extracted = list(Path("/tmp").glob("etcd-v*-linux-amd64"))
-                    if extracted:
-                        d = extracted[0]
-                        bin_dir_path = Path("/usr/local/bin")
-                        if not bin_dir_path.exists():
-                            os.makedirs(bin_dir_path, exist_ok=True)
-                        for name in ["etcd", "etcdctl"]:
-                            exe = d / name
-                            if exe.exists():
-                                self._run_cmd(["cp", str(exe), "/usr/local/bin/"])
-                                self._run_cmd(["chmod", "755", f"/usr/local/bin/{name}"])
-                        shutil.rmtree(str(d), ignore_errors=True)
-                        print(Colors.success("etcd binaries installed to /usr/local/bin"))
-                    else:
-                        print(Colors.warn("etcd tarball had unexpected layout"))
-                except Exception as e:
-                    logger.warning("etcd tarball install failed: %s", e)
-                    print(Colors.warn("etcd tarball install failed; install manually (see rpms/README-OFFLINE.md)"))
-
-            # 4) Offline: install Patroni from rpms/patroni-wheels if present
-            wheels_dir = rpms_dir / "patroni-wheels"
-            if wheels_dir.is_dir() and list(wheels_dir.glob("patroni-*.whl")):
-                print(Colors.info("Installing Patroni from rpms/patroni-wheels"))
-                try:
-                    self._run_cmd([
-                        "pip3", "install", "--no-index",
-                        f"--find-links={wheels_dir}",
-                        "patroni",
-                    ], timeout=120, check=False)
-                    print(Colors.success("Patroni installed from wheels"))
-                except Exception as e:
-                    logger.warning("Patroni wheels install failed: %s", e)
-                    print(Colors.warn("Patroni wheels install failed; run: pip3 install --no-index --find-links=./rpms/patroni-wheels patroni"))
+        stages: list[tuple[str, Callable[[], None]]] = []
+        if missing_files or missing_packages:
+            stages.append(("rpm", rpm_stage))
+        if tarball is not None and not self.config.dry_run:
+            stages.append(("etcd", etcd_stage))
+        if patroni_wheel is not None:
+            stages.append(("patroni", patroni_stage))
 
-    def configure_etcd(self) -> None:
-        """Configure etcd cluster."""
-        if not self._require_root():
-            return
-        print(Colors.header("\n=== Configuring etcd Cluster ===\n"))
-        os.makedirs(ETCD_CONFIG_DIR, exist_ok=True)
-        os.makedirs("/var/lib/etcd", exist_ok=True)
+        def timed(fn: Callable[[], None]) -> tuple[float, str]:
+            t0 = time.monotonic()
+            try:
+                fn()
+                return time.monotonic() - t0, ""
+            except Exception as e:
+                logger.debug("install stage failed", exc_info=True)
+                return time.monotonic() - t0, str(e)
+
+        with ThreadPoolExecutor(max_workers=max(1, len(stages))) as pool:
+            futures = [(name, pool.submit(timed, fn)) for name, fn in stages]
+            outcomes = [(name, *f.result()) for name, f in futures]
+
+        print()
+        failures = []
+        for name, duration, error in outcomes:
+            if error:
+                failures.append(f"{name}: {error}")
+                print(Colors.fail(f"{name:<8} failed after {duration:.1f}s - {error}"))
+            else:
+                print(Colors.success(f"{name:<8} done in {duration:.1f}s"))
+        if failures:
+            raise RuntimeError("Package installation incomplete: " + "; ".join(failures))
+        print(Colors.success("Packages installed."))
+
+    ETCD_ENV_FILE = "/etc/etcd/etcd.conf"
+    ETCD_UNIT = "/etc/systemd/system/etcd.service"
+    ETCD_UNIT_CONTENT = """[Unit]
+Description=etcd - distributed key-value store for Patroni DCS
+After=network.target
+
+[Service]
+Type=notify
+EnvironmentFile=-/etc/etcd/etcd.conf
+ExecStart=/usr/local/bin/etcd
+Restart=on-failure
+RestartSec=10s
+LimitNOFILE=65536
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+    def _service_active(self, service: str) -> bool:
+        try:
+            r = subprocess.run(
+                ["systemctl", "is-active", service],
+                capture_output=True,
+                text=True,
+                timeout=5,
+            )
+            return r.stdout.strip() == "active"
+        except Exception:
+            return False
 
+    def _render_etcd_conf(self) -> str:
         initial_cluster = ",".join(
             f"{n}=http://{ip}:2380"
             for n, ip in zip(self.config.etcd_nodes, self.config.etcd_ips)
@@ -910,7 +4296,7 @@ Firewall: Use --add-source for restricted access
         # etcd environment for Patroni DCS on this node.
         # Per customer requirement we set BOTH the initial and runtime advertise URLs,
         # all derived from current_node_ip (no hard-coded IPs).
-        etcd_env = f"""# etcd for Patroni DCS
+        return f"""# etcd for Patroni DCS
 ETCD_NAME={self.config.current_node}
 ETCD_DATA_DIR="/var/lib/etcd"
 ETCD_LISTEN_CLIENT_URLS="http://{self.config.current_node_ip}:2379"
@@ -923,71 +4309,77 @@ ETCD_INITIAL_CLUSTER_TOKEN="pg-ha-etcd"
 ETCD_INITIAL_CLUSTER_STATE="new"
 """
 
-        env_file = "/etc/etcd/etcd.conf"
-        if not self.config.dry_run:
-            with open(env_file, "w") as f:
-                f.write(etcd_env)
-        logger.info("Wrote %s", env_file)
-
-        # systemd: use override if etcd.service exists (from RPM), else create full unit (tarball install)
-        etcd_unit = "/etc/systemd/system/etcd.service"
-        if not self.config.dry_run:
-            if not os.path.exists(etcd_unit):
-                unit_content = """[Unit]
-Description=etcd - distributed key-value store for Patroni DCS
-After=network.target
+    def configure_etcd(self) -> None:
+        """Configure etcd cluster (rewrites files / restarts etcd only when inputs changed)."""
+        if not self._require_root():
+            return
+        print(Colors.header("\n=== Configuring etcd Cluster ===\n"))
+        os.makedirs(ETCD_CONFIG_DIR, exist_ok=True)
+        os.makedirs("/var/lib/etcd", exist_ok=True)
 
-[Service]
-Type=notify
-EnvironmentFile=-/etc/etcd/etcd.conf
-ExecStart=/usr/local/bin/etcd
-Restart=on-failure
-RestartSec=10s
-LimitNOFILE=65536
+        state = AppliedConfigState(dry_run=self.config.dry_run)
+        env_file = self.ETCD_ENV_FILE
+        etcd_env = self._render_etcd_conf()
+        env_changed = state.write_if_changed(env_file, etcd_env)
 
-[Install]
-WantedBy=multi-user.target
-"""
-                with open(etcd_unit, "w") as f:
-                    f.write(unit_content)
-                logger.info("Created %s (etcd from tarball)", etcd_unit)
-            else:
-                override_dir = "/etc/systemd/system/etcd.service.d"
+        # systemd: our full unit for tarball installs (or when the unit is ours),
+        # otherwise an override pointing an existing unit at the env file.
+        etcd_unit = self.ETCD_UNIT
+        ours = AppliedConfigState._file_fingerprint(etcd_unit) in (
+            None, AppliedConfigState.fingerprint(self.ETCD_UNIT_CONTENT)
+        )
+        if ours:
+            unit_path, unit_content = etcd_unit, self.ETCD_UNIT_CONTENT
+        else:
+            override_dir = "/etc/systemd/system/etcd.service.d"
+            if not self.config.dry_run:
                 os.makedirs(override_dir, exist_ok=True)
-                override_content = f"""[Service]
+            unit_path = f"{override_dir}/environment.conf"
+            unit_content = f"""[Service]
 EnvironmentFile={env_file}
 """
-                override_file = f"{override_dir}/environment.conf"
-                with open(override_file, "w") as f:
-                    f.write(override_content)
-            # Reload and manage etcd service; handle failures gracefully
+        unit_changed = state.write_if_changed(unit_path, unit_content)
+
+        if self.config.dry_run:
+            changed = "changed" if env_changed or unit_changed else "unchanged"
+            print(Colors.success(f"etcd configuration rendered ({changed}; dry-run)."))
+            return
+
+        inputs_fp = AppliedConfigState.fingerprint(etcd_env, unit_content)
+        active = self._service_active("etcd")
+        if active and state.service_current("etcd", inputs_fp):
+            print(Colors.success("etcd configuration unchanged and service running; nothing to do."))
+            return
+
+        # Reload and manage etcd service; handle failures gracefully
+        if unit_changed:
             self._run_cmd(["systemctl", "daemon-reload"], check=False)
-            self._run_cmd(["systemctl", "enable", "etcd"], check=False)
-            result = self._run_cmd(["systemctl", "start", "etcd"], check=False)
-            if result.returncode != 0:
-                print(Colors.fail("Failed to start etcd service (systemctl start etcd)."))
-                if result.stderr:
-                    print(result.stderr.strip())
-                print(
-                    Colors.warn(
-                        "Check etcd status with:\n"
-                        "  systemctl status etcd -l\n"
-                        "  journalctl -u etcd -n 50"
-                    )
+        self._run_cmd(["systemctl", "enable", "etcd"], check=False)
+        action = "restart" if active else "start"
+        result = self._run_cmd(["systemctl", action, "etcd"], check=False)
+        if result.returncode != 0:
+            print(Colors.fail(f"Failed to {action} etcd service (systemctl {action} etcd)."))
+            if result.stderr:
+                print(result.stderr.strip())
+            print(
+                Colors.warn(
+                    "Check etcd status with:\n"
+                    "  systemctl status etcd -l\n"
+                    "  journalctl -u etcd -n 50"
                 )
-                print(
-                    Colors.info(
-                        "If you downgraded from etcd 3.6 to 3.5 (for Patroni v2 API), clear the data dir on all nodes:\n"
-                        "  sudo systemctl stop etcd\n"
-                        "  sudo rm -rf /var/lib/etcd/*\n"
-                        "  sudo systemctl start etcd\n"
-                        "Or run menu option 19 (Fix etcd for Patroni)."
-                    )
+            )
+            print(
+                Colors.info(
+                    "If you downgraded from etcd 3.6 to 3.5 (for Patroni v2 API), clear the data dir on all nodes:\n"
+                    "  sudo systemctl stop etcd\n"
+                    "  sudo rm -rf /var/lib/etcd/*\n"
+                    "  sudo systemctl start etcd\n"
+                    "Or run menu option 18 (Fix etcd for Patroni)."
                 )
-            else:
-                print(Colors.success("etcd configured and service started. Repeat on all 3 nodes."))
+            )
         else:
-            print(Colors.success("etcd configuration written (dry-run)."))
+            state.record_service("etcd", inputs_fp)
+            print(Colors.success(f"etcd configured and service {action}ed. Repeat on all 3 nodes."))
 
     def fix_etcd_for_patroni(self) -> None:
         """Fix etcd for Patroni: clear data (3.6->3.5 downgrade), install 3.5.x if needed, start etcd."""
@@ -1047,38 +4439,19 @@ EnvironmentFile={env_file}
         else:
             print(Colors.warn("Skipped clearing data. If etcd was 3.6, it may still fail to start."))
 
-        # Prefer 3.5.x tarball and install if found
-        def _etcd_version_key(p: Path) -> tuple:
-            m = re.search(r"etcd-v(\d+)\.(\d+)\.(\d+)", p.name)
-            return (int(m.group(1)), int(m.group(2)), int(m.group(3))) if m else (0, 0, 0)
-
-        for search_dir in [Path("rpms"), Path(".")]:
-            if not search_dir.is_dir():
-                continue
-            tarballs_35 = [p for p in search_dir.glob("etcd-v3.5*.tar.gz") if p.is_file()]
-            if not tarballs_35:
-                continue
-            tarball = sorted(tarballs_35, key=_etcd_version_key)[-1]
-            print(Colors.info(f"Installing etcd from {tarball}"))
+        # Prefer 3.5.x tarball and install if found (skipped when the binaries already match)
+        tarball = EtcdBinaryInstaller.find_tarball([Path("rpms"), Path(".")], require_v35=True)
+        if tarball is None:
+            print(Colors.warn("No etcd 3.5.x tarball found in rpms/ or .; using existing binary."))
+        else:
             try:
-                self._run_cmd(["tar", "xzf", str(tarball), "-C", "/tmp"], timeout=30)
-                extracted = list(Path("/tmp").glob("etcd-v*-linux-amd64"))
-                if extracted:
-                    d = extracted[0]
-                    for name in ["etcd", "etcdctl"]:
-                        exe = d / name
-                        if exe.exists():
-                            self._run_cmd(["cp", str(exe), "/usr/local/bin/"])
-                            self._run_cmd(["chmod", "755", f"/usr/local/bin/{name}"])
-                    shutil.rmtree(str(d), ignore_errors=True)
-                    print(Colors.success("etcd 3.5.x binaries installed to /usr/local/bin"))
-                break
+                if EtcdBinaryInstaller(dry_run=self.config.dry_run).install(tarball):
+                    print(Colors.success(f"etcd 3.5.x binaries installed to /usr/local/bin from {tarball}"))
+                else:
+                    print(Colors.success(f"etcd binaries already match {tarball.name}"))
             except Exception as e:
                 logger.warning("etcd tarball install failed: %s", e)
                 print(Colors.warn(f"etcd install failed: {e}. Place etcd-v3.5.15-linux-amd64.tar.gz in rpms/ and retry."))
-            break
-        else:
-            print(Colors.warn("No etcd 3.5.x tarball found in rpms/ or .; using existing binary."))
 
         # Start etcd
         self._run_cmd(["systemctl", "daemon-reload"], check=False)
@@ -1132,7 +4505,9 @@ EnvironmentFile={env_file}
         print(Colors.success("Replication config guidance displayed."))
 
     def _prompt_password(self, prompt: str, default: str = "") -> str:
-        """Prompt for password with masking."""
+        """Prompt for password with masking. Non-interactive runs fail instead of using a default."""
+        if not self.interactive and not self.config.dry_run:
+            raise ValueError(f"{prompt} is not set in the config and cannot be prompted for in a non-interactive step")
         if default and not self.config.dry_run:
             try:
                 p = getpass.getpass(prompt=f"{prompt} [hidden]: ")
@@ -1141,51 +4516,27 @@ EnvironmentFile={env_file}
                 return default
         return default or "CHANGE_ME"
 
-    def configure_patroni(self) -> None:
-        """Install and configure Patroni."""
-        if not self._require_root():
-            return
-        print(Colors.header("\n=== Configuring Patroni ===\n"))
-
-        # Allow selecting IntelliDB Enterprise mode interactively if not set via YAML
-        if not self.config.use_intellidb:
-            try:
-                choice = input(
-                    "Use IntelliDB Enterprise mode (existing PostgreSQL 17 on port 5555, user 'intellidb')? [y/N]: "
-                ).strip().lower()
-            except EOFError:
-                choice = "n"
-            if choice == "y":
-                self.config.use_intellidb = True
-                print(Colors.info("IntelliDB Enterprise mode enabled for Patroni and HAProxy."))
-
-        os.makedirs(PATRONI_CONFIG_DIR, exist_ok=True)
-
-        if not self.config.replication_password:
-            self.config.replication_password = self._prompt_password("Replication user password", "CHANGE_ME")
-        if not self.config.postgres_password:
-            # For IntelliDB mode, default to the known IntelliDB password
-            default_pw = self.config.intellidb_password if self.config.use_intellidb else "CHANGE_ME"
-            prompt = "IntelliDB superuser password" if self.config.use_intellidb else "PostgreSQL superuser password"
-            self.config.postgres_password = self._prompt_password(prompt, default_pw)
+    def _patroni_layout(self) -> tuple[int, str, str, str]:
+        """(db_port, bin_dir, data_dir, superuser_name) for standard PostgreSQL vs IntelliDB mode."""
+        if self.config.use_intellidb:
+            return (
+                self.config.intellidb_port,
+                self.config.intellidb_bin_dir,
+                self.config.intellidb_data_dir,
+                self.config.intellidb_user,
+            )
+        return 5432, "/usr/pgsql-17/bin", POSTGRESQL_DATA_DIR, SUPERUSER
 
+    def _render_patroni_yml(self, tuned: Optional[dict[str, str]] = None) -> str:
         etcd_hosts = ",".join(f"http://{ip}:2379" for ip in self.config.etcd_ips)
         repl_pass = self.config.replication_password or "CHANGE_ME"
         super_pass = self.config.postgres_password or "CHANGE_ME"
+        db_port, bin_dir, data_dir, superuser_name = self._patroni_layout()
+        # Incremental backups need WAL summaries on whichever member they are taken from
+        extra_parameters = '    summarize_wal: "on"\n' if self.config.backup_mode == "incremental" else ""
+        replica_methods = self._render_replica_methods(bin_dir)
 
-        # Standard PostgreSQL vs IntelliDB mode
-        if self.config.use_intellidb:
-            db_port = self.config.intellidb_port
-            bin_dir = self.config.intellidb_bin_dir
-            data_dir = self.config.intellidb_data_dir
-            superuser_name = self.config.intellidb_user
-        else:
-            db_port = 5432
-            bin_dir = "/usr/pgsql-17/bin"
-            data_dir = POSTGRESQL_DATA_DIR
-            superuser_name = SUPERUSER
-
-        patroni_yml = f"""# Patroni configuration for {self.config.cluster_name}
+        return f"""# Patroni configuration for {self.config.cluster_name}
 scope: {self.config.cluster_name}
 name: {self.config.current_node}
 
@@ -1201,7 +4552,7 @@ bootstrap:
     ttl: 30
     loop_wait: 10
     retry_timeout: 10
-    maximum_lag_on_failover: 1048576
+    maximum_lag_on_failover: {self.config.maximum_lag_on_failover}
     postgresql:
       use_pg_rewind: true
       use_slots: true
@@ -1229,7 +4580,7 @@ postgresql:
   data_dir: {data_dir}
   bin_dir: {bin_dir}
   pgpass: /tmp/pgpass
-  authentication:
+{replica_methods}  authentication:
     replication:
       username: {REPLICATION_USER}
       password: {repl_pass}
@@ -1237,43 +4588,58 @@ postgresql:
       username: {superuser_name}
       password: {super_pass}
   parameters:
-    max_connections: "200"
-    shared_buffers: "256MB"
+    max_connections: "{self.config.pg_max_connections}"
+{self._render_tuned_parameters(tuned if tuned is not None else self._tuned_parameters(data_dir))}
     dynamic_shared_memory_type: "posix"
     wal_level: replica
     max_wal_senders: "10"
     max_replication_slots: "10"
     hot_standby: "on"
+{extra_parameters}"""
+
+    def _render_replica_methods(self, bin_dir: str) -> str:
+        """
+        With replica_seed_from_backup, new replicas are restored from the newest local
+        backup (seed-replica) and then stream from the leader; Patroni moves on to
+        basebackup from the leader when the command fails.
+        """
+        if not self.config.replica_seed_from_backup:
+            return ""
+        command = " ".join(shlex.quote(a) for a in [
+            "/usr/bin/python3", SEED_SCRIPT, "seed-replica",
+            "--backup-dir", self.config.replica_seed_backup_dir or self.config.backup_dir,
+            "--max-age-hours", str(self.config.replica_seed_max_age_hours),
+            "--bin-dir", bin_dir,
+        ])
+        return f"""  create_replica_methods:
+    - localbackup
+    - basebackup
+  localbackup:
+    command: {command}
+    keep_data: false
 """
 
-        cfg_path = f"{PATRONI_CONFIG_DIR}/patroni.yml"
-        if not self.config.dry_run:
-            with open(cfg_path, "w") as f:
-                f.write(patroni_yml)
-            try:
-                os.chmod(cfg_path, 0o600)
-            except OSError as e:
-                logger.warning("Could not restrict patroni.yml permissions: %s", e)
-            # Own the config file by the user that runs Patroni (postgres or intellidb)
-            # so the service can read it when started by systemd as that user.
-            try:
-                import pwd
-                pw = pwd.getpwnam(superuser_name)
-                os.chown(cfg_path, pw.pw_uid, pw.pw_gid)
-            except (ImportError, KeyError, OSError) as e:
-                logger.warning("Could not chown patroni.yml to %s: %s", superuser_name, e)
+    def _tuned_parameters(self, data_dir: str, facts: Optional[HostFacts] = None) -> dict[str, str]:
+        profile = (self.config.pg_tuning_profile or "off").lower()
+        if profile == "off":
+            return {"shared_buffers": "256MB"}
+        facts = facts or HostFacts.detect(data_dir)
+        return PostgresTuner(facts, profile, self.config.pg_max_connections).parameters()
 
-            # Create patroni.service if missing (runs as IntelliDB user or postgres)
-            patroni_unit = "/etc/systemd/system/patroni.service"
-            patroni_bin = shutil.which("patroni") or "/usr/local/bin/patroni"
-            if not os.path.exists(patroni_unit) and not self.config.dry_run:
-                unit_content = f"""[Unit]
+    @staticmethod
+    def _render_tuned_parameters(tuned: dict[str, str]) -> str:
+        return "\n".join(f'    {k}: "{v}"' for k, v in tuned.items())
+
+    def _render_patroni_unit(self, cfg_path: str, superuser_name: str) -> str:
+        patroni_bin = shutil.which("patroni") or "/usr/local/bin/patroni"
+        return f"""[Unit]
 Description=Patroni PostgreSQL HA Cluster Manager
 After=network.target etcd.service
 
 [Service]
 Type=simple
 ExecStart={patroni_bin} -c {cfg_path}
+ExecReload=/bin/kill -s HUP $MAINPID
 Restart=on-failure
 RestartSec=10s
 User={superuser_name}
@@ -1283,37 +4649,138 @@ TimeoutSec=30
 [Install]
 WantedBy=multi-user.target
 """
+
+    def configure_patroni(self) -> None:
+        """Install and configure Patroni (rewrites patroni.yml / reloads only when it changed)."""
+        if not self._require_root():
+            return
+        print(Colors.header("\n=== Configuring Patroni ===\n"))
+
+        # Allow selecting IntelliDB Enterprise mode interactively if not set via YAML
+        if not self.config.use_intellidb and self.interactive:
+            try:
+                choice = input(
+                    "Use IntelliDB Enterprise mode (existing PostgreSQL 17 on port 5555, user 'intellidb')? [y/N]: "
+                ).strip().lower()
+            except EOFError:
+                choice = "n"
+            if choice == "y":
+                self.config.use_intellidb = True
+                print(Colors.info("IntelliDB Enterprise mode enabled for Patroni and HAProxy."))
+
+        os.makedirs(PATRONI_CONFIG_DIR, exist_ok=True)
+
+        if not self.config.replication_password:
+            self.config.replication_password = self._prompt_password("Replication user password", "CHANGE_ME")
+        if not self.config.postgres_password:
+            # For IntelliDB mode, default to the known IntelliDB password
+            default_pw = self.config.intellidb_password if self.config.use_intellidb else "CHANGE_ME"
+            prompt = "IntelliDB superuser password" if self.config.use_intellidb else "PostgreSQL superuser password"
+            self.config.postgres_password = self._prompt_password(prompt, default_pw)
+
+        _, _, data_dir, superuser_name = self._patroni_layout()
+        if (self.config.pg_tuning_profile or "off").lower() != "off":
+            facts = HostFacts.detect(data_dir)
+            storage = {True: "rotational", False: "SSD"}.get(facts.rotational, "unknown storage")
+            tuned = self._tuned_parameters(data_dir, facts)
+            print(Colors.info(
+                f"PostgreSQL tuned for {self.config.pg_tuning_profile} on {facts.cpus} CPUs, "
+                f"{facts.mem_gib:.1f} GiB RAM, {storage}: "
+                + ", ".join(f"{k}={tuned[k]}" for k in ("shared_buffers", "effective_cache_size", "work_mem", "max_wal_size"))
+            ))
+        else:
+            tuned = self._tuned_parameters(data_dir)
+        patroni_yml = self._render_patroni_yml(tuned)
+        cfg_path = f"{PATRONI_CONFIG_DIR}/patroni.yml"
+        state = AppliedConfigState(dry_run=self.config.dry_run)
+        if self.config.replica_seed_from_backup:
+            # Patroni (running as the database user) executes this copy for localbackup
+            os.makedirs(CONFIG_DIR, exist_ok=True)
+            state.write_if_changed(SEED_SCRIPT, Path(__file__).read_text(encoding="utf-8"), mode=0o755)
+            print(Colors.info(
+                f"New replicas are seeded from backups in {self.config.replica_seed_backup_dir or self.config.backup_dir} "
+                f"(newer than {self.config.replica_seed_max_age_hours}h), else pg_basebackup from the leader."
+            ))
+        changed = state.write_if_changed(cfg_path, patroni_yml, mode=0o600)
+        if changed and not self.config.dry_run:
+            # Own the config file by the user that runs Patroni (postgres or intellidb)
+            # so the service can read it when started by systemd as that user.
+            try:
+                import pwd
+                pw = pwd.getpwnam(superuser_name)
+                os.chown(cfg_path, pw.pw_uid, pw.pw_gid)
+            except (ImportError, KeyError, OSError) as e:
+                logger.warning("Could not chown patroni.yml to %s: %s", superuser_name, e)
+
+        if not self.config.dry_run:
+            # Create patroni.service if missing (runs as IntelliDB user or postgres)
+            patroni_unit = "/etc/systemd/system/patroni.service"
+            if not os.path.exists(patroni_unit):
                 with open(patroni_unit, "w") as f:
-                    f.write(unit_content)
+                    f.write(self._render_patroni_unit(cfg_path, superuser_name))
                 logger.info("Created %s (User=%s)", patroni_unit, superuser_name)
                 self._run_cmd(["systemctl", "daemon-reload"], check=False)
                 self._run_cmd(["systemctl", "enable", "patroni"], check=False)
                 print(Colors.success(f"Patroni systemd unit created at {patroni_unit} (User={superuser_name})."))
-        print(Colors.success(f"Patroni config written to {cfg_path}"))
-        print(Colors.warn("Review pg_hba CIDR - 0.0.0.0/0 is permissive. Restrict in production."))
 
-    def configure_haproxy(self) -> None:
-        """Configure HAProxy for read/write routing."""
-        if not self._require_root():
-            return
-        print(Colors.header("\n=== Configuring HAProxy ===\n"))
-        print(
-            Colors.info(
-                "Tip: In a 3-node deployment with no separate HAProxy VM, "
-                "run menu option 8 (Configure HAProxy) on exactly one node "
-                "(for example node1) and skip option 8 on the other two nodes. "
-                "Applications should then connect only to that node's "
-                "haproxy_bind:haproxy_port."
-            )
-        )
+            # A running Patroni picks up patroni.yml changes on SIGHUP; no restart needed
+            inputs_fp = AppliedConfigState.fingerprint(patroni_yml)
+            if self._service_active("patroni") and not state.service_current("patroni", inputs_fp):
+                r = self._run_cmd(["systemctl", "reload", "patroni"], check=False)
+                if r.returncode != 0:
+                    r = self._run_cmd(["systemctl", "kill", "-s", "HUP", "--kill-who=main", "patroni"], check=False)
+                if r.returncode == 0:
+                    state.record_service("patroni", inputs_fp)
+                    print(Colors.success("Running Patroni reloaded with the new configuration."))
+                else:
+                    print(Colors.warn("Could not reload Patroni; run: systemctl reload patroni"))
+
+        if changed:
+            print(Colors.success(f"Patroni config written to {cfg_path}"))
+        else:
+            print(Colors.success(f"Patroni config {cfg_path} unchanged; not rewritten."))
+        print(Colors.warn("Review pg_hba CIDR - 0.0.0.0/0 is permissive. Restrict in production."))
 
+    def _render_haproxy_cfg(self, facts: Optional[HostFacts] = None) -> str:
         db_port = self.config.intellidb_port if self.config.use_intellidb else 5432
+        profile = HAProxyProfile.for_host(facts or HostFacts.detect(), self.config)
+        members = list(zip(self.config.etcd_nodes, self.config.etcd_ips))
         backends = "\n".join(
             f"    server {n} {ip}:{db_port} check port 8008"
-            for n, ip in zip(self.config.etcd_nodes, self.config.etcd_ips)
+            for n, ip in members
         )
 
-        haproxy_cfg = f"""# HAProxy for PostgreSQL HA - {self.config.cluster_name}
+        read_section = ""
+        if self.config.read_replica_port and self.config.read_replica_port != self.config.haproxy_port:
+            # Patroni /replica answers 200 only on running replicas (and, with ?lag=, only within that lag)
+            check = "/replica"
+            if self.config.read_replica_max_lag:
+                check += f"?lag={self.config.read_replica_max_lag}"
+            read_servers = "\n".join(
+                f"    server {n} {ip}:{db_port} check port 8008"
+                for n, ip in members
+            )
+            if profile.read_fallback_maxconn:
+                # Backup servers mirror pg_write's leader check; used only when no replica is healthy.
+                # Their maxconn plus pg_write's stays within the leader's server_maxconn.
+                read_servers += "\n" + "\n".join(
+                    f"    server {n}_leader {ip}:{db_port} backup track pg_write/{n} maxconn {profile.read_fallback_maxconn}"
+                    for n, ip in members
+                )
+            read_section = f"""
+frontend pg_read_frontend
+    bind {self.config.haproxy_bind}:{self.config.read_replica_port}
+    default_backend pg_read
+
+backend pg_read
+    balance leastconn
+    option httpchk GET {check}
+    http-check expect status 200
+    {profile.default_server()}
+{read_servers}
+"""
+
+        return f"""# HAProxy for PostgreSQL HA - {self.config.cluster_name}
 global
     log /dev/log local0
     log /dev/log local1 notice
@@ -1323,15 +4790,27 @@ global
     user haproxy
     group haproxy
     daemon
+{profile.global_lines()}
 
 defaults
     log     global
     mode    tcp
     option  tcplog
     option  dontlognull
-    timeout connect 5000
-    timeout client  50000
-    timeout server  50000
+    # Long-lived database sessions: generous idle timeouts, dead peers found by TCP keepalive
+    option  clitcpka
+    option  srvtcpka
+    clitcpka-idle  30s
+    clitcpka-intvl 10s
+    clitcpka-cnt   3
+    srvtcpka-idle  30s
+    srvtcpka-intvl 10s
+    srvtcpka-cnt   3
+    timeout connect {profile.timeout_connect}
+    timeout client  {profile.timeout_client}
+    timeout server  {profile.timeout_server}
+    timeout queue   {profile.timeout_queue}
+    timeout check   {profile.timeout_check}
 
 frontend pg_frontend
     bind {self.config.haproxy_bind}:{self.config.haproxy_port}
@@ -1340,10 +4819,43 @@ frontend pg_frontend
 backend pg_write
     option httpchk
     http-check expect status 200
-    default-server inter 3s fall 3 rise 2 on-marked-down shutdown-sessions
+    {profile.default_server(profile.write_maxconn)}
 {backends}
-"""
+{read_section}"""
+
+    @staticmethod
+    def _validate_haproxy_cfg(path: str) -> Optional[str]:
+        """Run haproxy -c on path; returns an error message or None."""
+        try:
+            r = subprocess.run(
+                ["haproxy", "-c", "-f", path],
+                capture_output=True,
+                text=True,
+                timeout=5,
+            )
+        except FileNotFoundError:
+            return "haproxy binary not found (install packages first)"
+        if r.returncode != 0:
+            return r.stderr or r.stdout or "Unknown error"
+        return None
+
+    def configure_haproxy(self) -> None:
+        """Configure HAProxy for read/write routing (validates and reloads only on change)."""
+        if not self._require_root():
+            return
+        print(Colors.header("\n=== Configuring HAProxy ===\n"))
+        print(
+            Colors.info(
+                "Tip: In a 3-node deployment with no separate HAProxy VM, "
+                "run menu option 8 (Configure HAProxy) on exactly one node "
+                "(for example node1) and skip option 8 on the other two nodes. "
+                "Applications should then connect only to that node's "
+                "haproxy_bind:haproxy_port."
+            )
+        )
 
+        haproxy_cfg = self._render_haproxy_cfg()
+        state = AppliedConfigState(dry_run=self.config.dry_run)
         if not self.config.dry_run:
             haproxy_dir = os.path.dirname(HAPROXY_CONFIG)
             try:
@@ -1353,22 +4865,29 @@ backend pg_write
                 logger.error("Failed to create HAProxy config directory %s: %s", haproxy_dir, e)
                 return
 
-            with open(HAPROXY_CONFIG, "w") as f:
-                f.write(haproxy_cfg)
-            # Validate config before reload to avoid taking down HAProxy
-            r = subprocess.run(
-                ["haproxy", "-c", "-f", HAPROXY_CONFIG],
-                capture_output=True,
-                text=True,
-                timeout=5,
-            )
-            if r.returncode != 0:
-                print(Colors.fail("HAProxy config validation failed:"))
-                print(r.stderr or r.stdout or "Unknown error")
-                logger.error("HAProxy config invalid: %s", r.stderr or r.stdout)
-                return
-            self._run_cmd(["systemctl", "reload", "haproxy"], check=False)
+        # Validate config before it replaces the live one, to avoid taking down HAProxy
+        try:
+            changed = state.write_if_changed(HAPROXY_CONFIG, haproxy_cfg, validate=self._validate_haproxy_cfg)
+        except ValueError as e:
+            print(Colors.fail("HAProxy config validation failed:"))
+            print(e)
+            logger.error("HAProxy config invalid: %s", e)
+            return
+
+        if not self.config.dry_run:
+            inputs_fp = AppliedConfigState.fingerprint(haproxy_cfg)
+            if state.service_current("haproxy", inputs_fp) and self._service_active("haproxy"):
+                print(Colors.success("HAProxy config unchanged; no reload needed."))
+            else:
+                r = self._run_cmd(["systemctl", "reload", "haproxy"], check=False)
+                if r.returncode == 0:
+                    state.record_service("haproxy", inputs_fp)
+                elif not changed:
+                    logger.warning("systemctl reload haproxy failed: %s", (r.stderr or "").strip())
         print(Colors.success(f"HAProxy configured at {self.config.haproxy_bind}:{self.config.haproxy_port}"))
+        if self.config.read_replica_port and self.config.read_replica_port != self.config.haproxy_port:
+            fallback = "leader fallback" if self.config.read_fallback_to_leader else "no leader fallback"
+            print(Colors.info(f"Read-only traffic: {self.config.haproxy_bind}:{self.config.read_replica_port} (replicas, leastconn, {fallback})"))
 
     def configure_selinux(self) -> None:
         """Configure SELinux policies."""
@@ -1397,26 +4916,865 @@ backend pg_write
             self._run_cmd(["systemctl", "start", "patroni"], check=False)
         print(Colors.success("Patroni start attempted."))
 
+    def _patroni_members(self) -> list[tuple[str, str]]:
+        return list(zip(self.config.etcd_nodes, self.config.etcd_ips))
+
+    def collect_cluster_health(self) -> list[MemberHealth]:
+        """One concurrent REST round over all Patroni members."""
+        collector = PatroniHealthCollector(self._patroni_members())
+        try:
+            return collector.collect()
+        finally:
+            collector.close()
+
+    @staticmethod
+    def _print_health_table(members: list[MemberHealth]) -> None:
+        print(MemberHealth.table_header())
+        for m in members:
+            print(m.format_row())
+
+    def _patronictl_list(self) -> int:
+        r = subprocess.run(
+            ["patronictl", "-c", f"{PATRONI_CONFIG_DIR}/patroni.yml", "list"],
+            capture_output=True,
+            text=True,
+            timeout=10,
+        )
+        print(r.stdout or r.stderr or "No output")
+        return r.returncode
+
     def check_cluster_health(self) -> None:
-        """Check cluster health."""
+        """Check cluster health via the Patroni REST API (patronictl if REST is unreachable)."""
         print(Colors.header("\n=== Cluster Health Check ===\n"))
         try:
-            r = subprocess.run(
-                ["patronictl", "-c", f"{PATRONI_CONFIG_DIR}/patroni.yml", "list"],
-                capture_output=True,
-                text=True,
-                timeout=10,
-            )
-            print(r.stdout or r.stderr or "No output")
-            if r.returncode == 0:
+            members = self.collect_cluster_health()
+            if any(m.reachable for m in members):
+                self._print_health_table(members)
+                print()
+                leaders = [m for m in members if m.is_leader]
+                if len(leaders) == 1 and all(m.reachable and m.healthy for m in members):
+                    print(Colors.success(f"Cluster healthy; leader is {leaders[0].node}."))
+                elif not leaders:
+                    print(Colors.warn("No leader reported."))
+                else:
+                    print(Colors.warn("One or more members are unreachable or not running."))
+                if any(m.pending_restart for m in members):
+                    print(Colors.warn("Members marked * have a pending restart (patronictl restart)."))
+                return
+            print(Colors.warn("Patroni REST API unreachable on all members; falling back to patronictl."))
+            if self._patronictl_list() == 0:
                 print(Colors.success("Cluster status retrieved."))
             else:
                 print(Colors.warn("patronictl may not be available or cluster not ready."))
         except Exception as e:
             print(Colors.fail(f"Health check failed: {e}"))
 
+    def watch_cluster_health(self, interval: float, json_output: bool = False) -> None:
+        """Poll member health every interval seconds until Ctrl+C, redrawing only changed rows."""
+        collector = PatroniHealthCollector(self._patroni_members())
+        watch = ClusterHealthWatch(
+            collector,
+            interval=interval,
+            history=self.config.health_watch_history,
+            lag_alert_bytes=self.config.maximum_lag_on_failover,
+            json_output=json_output,
+        )
+        try:
+            watch.run()
+        finally:
+            collector.close()
+        if not json_output:
+            print()
+            print(watch.summary())
+
+    def _check_cluster_health_interactive(self) -> None:
+        self.check_cluster_health()
+        try:
+            interval = input("\nWatch interval in seconds (Enter to return): ").strip()
+        except EOFError:
+            return
+        if not interval:
+            return
+        try:
+            seconds = float(interval)
+        except ValueError:
+            print(Colors.warn(f"Not a number: {interval}"))
+            return
+        print()
+        self.watch_cluster_health(seconds)
+
+    def run_health_check(self, json_output: bool = False) -> int:
+        """Non-interactive health snapshot. Returns exit code (0 = one leader, all members running)."""
+        members = self.collect_cluster_health()
+        leaders = [m for m in members if m.is_leader]
+        ok = len(leaders) == 1 and all(m.reachable and m.healthy for m in members)
+        if json_output:
+            print(json.dumps({
+                "cluster": self.config.cluster_name,
+                "leader": leaders[0].node if len(leaders) == 1 else None,
+                "healthy": ok,
+                "members": [m.to_dict() for m in members],
+            }, indent=2))
+        elif any(m.reachable for m in members):
+            self._print_health_table(members)
+        else:
+            print(Colors.warn("Patroni REST API unreachable on all members; falling back to patronictl."))
+            try:
+                return 1 if self._patronictl_list() != 0 else 0
+            except (OSError, subprocess.TimeoutExpired) as e:
+                print(Colors.fail(f"patronictl failed: {e}"))
+                return 1
+        return 0 if ok else 1
+
+    def _read_pg_stat_replication(self, host: str) -> dict[str, tuple[float, float]]:
+        """application_name -> (replay lag bytes, replay lag seconds) as seen by the primary at host."""
+        rows = self._psql(host, (
+            "SELECT application_name, pg_wal_lsn_diff(pg_current_wal_lsn(), replay_lsn), "
+            "CASE WHEN replay_lag IS NULL AND replay_lsn = pg_current_wal_lsn() THEN 0 "
+            "ELSE EXTRACT(EPOCH FROM replay_lag) END "
+            "FROM pg_stat_replication"
+        ))
+        out = {}
+        for row in rows:
+            if len(row) < 3:
+                continue
+            out[row[0]] = (
+                float(row[1]) if row[1] else float("nan"),
+                float(row[2]) if row[2] else float("nan"),
+            )
+        return out
+
+    def _lag_sampler(self) -> tuple[LagSampler, PatroniHealthCollector]:
+        collector = PatroniHealthCollector(self._patroni_members())
+        sampler = LagSampler(
+            collector,
+            capacity=self.config.lag_sample_capacity,
+            replication_reader=self._read_pg_stat_replication,
+        )
+        return sampler, collector
+
+    def _print_lag_report(self, sampler: LagSampler) -> None:
+        def fmt(v: float, scale: float, spec: str) -> str:
+            return "-" if math.isnan(v) else format(v / scale, spec)
+
+        windows = list(self.config.lag_report_windows) + [0]
+        print(f"{'MEMBER':<12} {'WINDOW':>7} {'N':>6} {'P50 MB':>8} {'P95 MB':>8} {'P99 MB':>8} {'MAX MB':>8} "
+              f"{'P50 s':>7} {'P95 s':>7} {'P99 s':>7} {'MAX s':>7}")
+        for w in windows:
+            for node, e in sorted(sampler.stats(w or None).items()):
+                b = e["bytes"] or {}
+                s = e["seconds"] or {}
+                nan = float("nan")
+                label = f"{w}s" if w else "all"
+                print(
+                    f"{node:<12} {label:>7} {e['samples']:>6} "
+                    + " ".join(fmt(b.get(k, nan), 1048576, ".2f").rjust(8) for k in ("p50", "p95", "p99", "max"))
+                    + " "
+                    + " ".join(fmt(s.get(k, nan), 1, ".2f").rjust(7) for k in ("p50", "p95", "p99", "max"))
+                )
+        rec = sampler.recommend_max_lag()
+        print()
+        print(f"Current maximum_lag_on_failover: {self.config.maximum_lag_on_failover} bytes")
+        if rec is not None:
+            print(f"Suggested (2x worst p99, rounded up to MiB): {rec} bytes ({rec // 1048576} MiB)")
+
+    def _export_lag(self, sampler: LagSampler, path: str) -> None:
+        if path.lower().endswith(".csv"):
+            sampler.export_csv(path)
+        else:
+            sampler.export_json(path, list(self.config.lag_report_windows))
+        logger.info("Lag series written to %s", path)
+
+    def run_lag_sampler(self, duration: float, interval: float = 1.0, output: Optional[str] = None, json_output: bool = False) -> int:
+        """Non-interactive lag sampling; exit code 1 if no replica could be sampled."""
+        sampler, collector = self._lag_sampler()
+        try:
+            sampler.run(duration, interval)
+        finally:
+            collector.close()
+        if output:
+            self._export_lag(sampler, output)
+        if json_output:
+            print(json.dumps(sampler.to_dict(list(self.config.lag_report_windows)), indent=2))
+        else:
+            self._print_lag_report(sampler)
+        return 0 if sampler.rings else 1
+
+    def lag_sampler_menu(self) -> None:
+        """Sample replication lag for a while, report percentiles and optionally apply a new failover threshold."""
+        print(Colors.header("\n=== Replication Lag Sampler ===\n"))
+        try:
+            duration = float(input("Duration in seconds [300]: ").strip() or "300")
+            interval = float(input("Interval in seconds [1]: ").strip() or "1")
+        except ValueError:
+            print(Colors.warn("Not a number."))
+            return
+        sampler, collector = self._lag_sampler()
+        print(Colors.info(f"Sampling for {duration:g}s every {interval:g}s (Ctrl+C to stop early)..."))
+        try:
+            sampler.run(duration, interval, progress=lambda n: print(f"\r  {n} samples", end="", flush=True))
+            print()
+            if not sampler.rings:
+                print(Colors.warn("No replicas could be sampled (Patroni REST unreachable or no replicas)."))
+                return
+            self._print_lag_report(sampler)
+            path = input("\nExport to file (.csv or .json, Enter to skip): ").strip()
+            if path:
+                self._export_lag(sampler, path)
+            rec = sampler.recommend_max_lag()
+            if rec is None or rec == self.config.maximum_lag_on_failover:
+                return
+            if input(f"Apply maximum_lag_on_failover={rec} to the running cluster? [y/N]: ").strip().lower() != "y":
+                return
+            leader = next((m for m in collector.collect() if m.is_leader and m.reachable), None)
+            if leader is None:
+                print(Colors.fail("No reachable leader."))
+                return
+            if self.config.dry_run:
+                print(Colors.info(f"[DRY-RUN] Would PATCH http://{leader.host}:8008/config"))
+                return
+            body = json.dumps({"maximum_lag_on_failover": rec}).encode("utf-8")
+            status, data = collector.pool.request(leader.host, 8008, "/config", method="PATCH", body=body)
+            if status == 200:
+                self.config.maximum_lag_on_failover = rec
+                print(Colors.success(f"Cluster config updated. Set maximum_lag_on_failover: {rec} in your YAML to keep it."))
+            else:
+                print(Colors.fail(f"PATCH /config returned {status}: {data.decode('utf-8', 'replace')[:200]}"))
+        finally:
+            collector.close()
+
+    def serve_metrics(self) -> int:
+        """Run the Prometheus exporter in the foreground (Ctrl+C / SIGTERM to stop)."""
+        exporter = MetricsExporter(self._patroni_members(), cache_seconds=self.config.metrics_cache_seconds)
+        try:
+            exporter.serve(self.config.metrics_bind, self.config.metrics_port)
+        except OSError as e:
+            print(Colors.fail(f"Cannot listen on {self.config.metrics_bind}:{self.config.metrics_port}: {e}"))
+            return 1
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    def _print_haproxy_servers(self, client: HAProxyRuntimeClient) -> list[HAProxyServerState]:
+        states = client.servers_state()
+        stats = {(s.proxy, s.server): s for s in client.server_stats()}
+        print(f"{'BACKEND/SERVER':<24} {'ADDRESS':<22} {'STATUS':<10} {'ADMIN':<12} {'WEIGHT':>6} {'CUR':>5} {'MAXCONN':>7} {'QUEUE':>5}")
+        for st in states:
+            stat = stats.get((st.backend, st.server))
+            addr = f"{st.address}:{st.port}" if st.port else st.address
+            status = stat.status if stat else st.operational
+            cur = stat.scur if stat and stat.scur is not None else "-"
+            maxconn = stat.slim if stat and stat.slim is not None else "-"
+            queue = stat.qcur if stat and stat.qcur is not None else "-"
+            weight = f"{st.weight}" if st.weight == st.initial_weight else f"{st.weight}/{st.initial_weight}"
+            print(f"{st.backend + '/' + st.server:<24} {addr:<22} {status:<10} {st.admin:<12} {weight:>6} {cur!s:>5} {maxconn!s:>7} {queue!s:>5}")
+        return states
+
+    def haproxy_runtime_menu(self) -> None:
+        """Inspect and change HAProxy backend servers through the runtime API (no reload)."""
+        client = HAProxyRuntimeClient()
+        while True:
+            print()
+            print(Colors.header("=== HAProxy Runtime (no reload) ==="))
+            print()
+            try:
+                states = self._print_haproxy_servers(client)
+            except OSError as e:
+                print(Colors.fail(f"Cannot reach {client.socket_path}: {e} (is HAProxy running on this node?)"))
+                return
+            print()
+            print("  1. Drain server (finish existing sessions, no new ones)")
+            print("  2. Put server in maintenance")
+            print("  3. Set server ready")
+            print("  4. Set weight")
+            print("  5. Set server maxconn")
+            print("  6. Refresh")
+            print("  7. Back to main menu")
+            print()
+            try:
+                choice = input("Select option [1-7]: ").strip() or "7"
+            except EOFError:
+                choice = "7"
+            if choice == "7":
+                break
+            if choice == "6":
+                continue
+            if choice not in ("1", "2", "3", "4", "5"):
+                print(Colors.warn("Invalid option"))
+                continue
+            target = input("Server (backend/server, or server name): ").strip()
+            matches = [s for s in states if target in (f"{s.backend}/{s.server}", s.server)]
+            if not matches:
+                print(Colors.warn(f"No such server: {target}"))
+                continue
+            try:
+                for s in matches:
+                    if choice in ("1", "2", "3"):
+                        state = {"1": "drain", "2": "maint", "3": "ready"}[choice]
+                        client.set_state(s.backend, s.server, state)
+                        print(Colors.success(f"{s.backend}/{s.server} -> {state}"))
+                    elif choice == "4":
+                        weight = int(input(f"Weight for {s.backend}/{s.server} (0-256) [{s.initial_weight}]: ").strip() or s.initial_weight)
+                        client.set_weight(s.backend, s.server, weight)
+                        print(Colors.success(f"{s.backend}/{s.server} weight {weight}"))
+                    else:
+                        maxconn = int(input(f"maxconn for {s.backend}/{s.server} (0 = unlimited): ").strip())
+                        client.set_maxconn(s.backend, s.server, maxconn)
+                        print(Colors.success(f"{s.backend}/{s.server} maxconn {maxconn}"))
+            except (ValueError, RuntimeError, OSError) as e:
+                print(Colors.fail(str(e)))
+            print(Colors.info("Runtime changes last until HAProxy is reloaded or restarted."))
+
+    def _haproxy_host(self) -> str:
+        if self.config.haproxy_host:
+            return self.config.haproxy_host
+        if self.config.haproxy_bind not in ("", "0.0.0.0", "::", "*"):
+            return self.config.haproxy_bind
+        return self.config.current_node_ip
+
+    def _cluster_leader(self) -> Optional[MemberHealth]:
+        return next((m for m in self.collect_cluster_health() if m.is_leader and m.reachable), None)
+
+    def _load_previous_benchmark(self, scale: int) -> Optional[dict[str, Any]]:
+        """Most recent stored result with the same dataset scale."""
+        results_dir = Path(self.config.bench_results_dir)
+        for path in sorted(results_dir.glob("bench_*.json"), reverse=True):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if data.get("scale") == scale:
+                return data
+        return None
+
+    @staticmethod
+    def _compare_benchmarks(cur: dict[str, Any], prev: Optional[dict[str, Any]]) -> dict[str, Any]:
+        """Proxy overhead within this run, and TPS / p95 changes against prev (regression: TPS -10% or p95 +20%)."""
+
+        def key(r: dict[str, Any]) -> tuple:
+            return (r["workload"], r["target"], r["clients"])
+
+        def pct(new: Optional[float], old: Optional[float]) -> Optional[float]:
+            return round((new - old) / old * 100, 1) if new is not None and old else None
+
+        runs = {key(r): r for r in cur["runs"] if r.get("tps") is not None}
+        overhead = []
+        for (workload, target, clients), r in runs.items():
+            direct = runs.get((workload, "direct", clients))
+            if target == "direct" or direct is None:
+                continue
+            p50, dp50 = r["latency_ms"]["p50"], direct["latency_ms"]["p50"]
+            overhead.append({
+                "workload": workload, "target": target, "clients": clients,
+                "tps_pct": pct(r["tps"], direct["tps"]),
+                "p50_added_ms": round(p50 - dp50, 3) if p50 is not None and dp50 is not None else None,
+            })
+        changes = []
+        if prev:
+            old_runs = {key(r): r for r in prev.get("runs", []) if r.get("tps") is not None}
+            for k, r in runs.items():
+                old = old_runs.get(k)
+                if old is None:
+                    continue
+                tps_pct = pct(r["tps"], old["tps"])
+                p95_pct = pct(r["latency_ms"]["p95"], old["latency_ms"]["p95"])
+                changes.append({
+                    "workload": k[0], "target": k[1], "clients": k[2],
+                    "tps_pct": tps_pct, "p95_pct": p95_pct,
+                    "regression": (tps_pct is not None and tps_pct < -10) or (p95_pct is not None and p95_pct > 20),
+                })
+        return {"previous": prev.get("id") if prev else None, "proxy_overhead": overhead, "vs_previous": changes}
+
+    @staticmethod
+    def _print_benchmark(result: dict[str, Any], comparison: dict[str, Any]) -> None:
+        print(f"{'WORKLOAD':<10} {'TARGET':<8} {'CLIENTS':>7} {'TPS':>10} {'AVG ms':>8} {'P50 ms':>8} {'P95 ms':>8} {'P99 ms':>8}")
+        for r in result["runs"]:
+            if r.get("error"):
+                print(f"{r['workload']:<10} {r['target']:<8} {r['clients']:>7} {Colors.fail(r['error'][:60])}")
+                continue
+            lat = r["latency_ms"]
+            cells = " ".join(f"{lat[k]:>8.2f}" if lat[k] is not None else f"{'-':>8}" for k in ("avg", "p50", "p95", "p99"))
+            tps = f"{r['tps']:>10.1f}" if r["tps"] is not None else f"{'-':>10}"
+            print(f"{r['workload']:<10} {r['target']:<8} {r['clients']:>7} {tps} {cells}")
+        if comparison["proxy_overhead"]:
+            print("\nProxy overhead vs direct to leader:")
+            for o in comparison["proxy_overhead"]:
+                print(f"  {o['workload']:<10} {o['target']:<8} c={o['clients']:<4} TPS {o['tps_pct']:+.1f}%  p50 {o['p50_added_ms']:+.2f} ms"
+                      if o["tps_pct"] is not None and o["p50_added_ms"] is not None else
+                      f"  {o['workload']:<10} {o['target']:<8} c={o['clients']:<4} n/a")
+        if comparison["previous"]:
+            print(f"\nCompared with {comparison['previous']}:")
+            for c in comparison["vs_previous"]:
+                line = (f"  {c['workload']:<10} {c['target']:<8} c={c['clients']:<4} "
+                        f"TPS {c['tps_pct'] if c['tps_pct'] is not None else 0:+.1f}%  "
+                        f"p95 {c['p95_pct'] if c['p95_pct'] is not None else 0:+.1f}%")
+                print(Colors.warn(line + "  REGRESSION") if c["regression"] else line)
+        else:
+            print()
+            print(Colors.info("No earlier run at this scale to compare with."))
+
+    def run_benchmark(
+        self,
+        scale: Optional[int] = None,
+        duration: Optional[int] = None,
+        clients: Optional[list[int]] = None,
+        json_output: bool = False,
+    ) -> int:
+        """
+        pgbench read-write and select-only runs at each client count, directly
+        against the leader, through HAProxy, and (select-only) through the read
+        port. Results are stored as JSON and compared with the previous run.
+        """
+        scale = scale or self.config.bench_scale
+        duration = int(duration or self.config.bench_duration)
+        clients = clients or list(self.config.bench_clients)
+        leader = self._cluster_leader()
+        if leader is None:
+            print(Colors.fail("No reachable leader (Patroni REST)."))
+            return 1
+        db_port, bin_dir, _, superuser_name = self._patroni_layout()
+        binary = os.path.join(bin_dir, "pgbench")
+        if not os.path.exists(binary):
+            binary = shutil.which("pgbench") or binary
+        dbname = self.config.bench_dbname
+        bench = PgBench(binary, superuser_name, dbname, self.config.postgres_password)
+        if self.config.dry_run:
+            print(Colors.info(f"[DRY-RUN] Would run pgbench scale {scale}, {duration}s per run, clients {clients} against {leader.host}"))
+            return 0
+
+        say = (lambda msg: logger.info("%s", msg)) if json_output else (lambda msg: print(Colors.info(msg)))
+        if not self._psql(leader.host, f"SELECT 1 FROM pg_database WHERE datname = {sql_literal(dbname)}"):
+            self._psql(leader.host, f"CREATE DATABASE {sql_ident(dbname)}")
+        try:
+            current_scale = int(self._psql(leader.host, "SELECT count(*) FROM pgbench_branches", dbname=dbname)[0][0])
+        except (RuntimeError, IndexError, ValueError):
+            current_scale = 0
+        if current_scale != scale:
+            say(f"Initializing pgbench dataset (scale {scale}, ~{scale * 16} MB) on {leader.node}...")
+            bench.init(leader.host, db_port, scale)
+
+        haproxy_host = self._haproxy_host()
+        targets = [("direct", leader.host, db_port), ("haproxy", haproxy_host, self.config.haproxy_port)]
+        read_port = self.config.read_replica_port
+        has_read = bool(read_port) and read_port != self.config.haproxy_port
+        runs = []
+        with tempfile.TemporaryDirectory(prefix="pgbench-") as tmp:
+            for workload, select_only in (("rw", False), ("ro", True)):
+                workload_targets = targets + ([("read", haproxy_host, read_port)] if select_only and has_read else [])
+                for n in clients:
+                    for target, host, port in workload_targets:
+                        say(f"{workload} via {target} ({host}:{port}), {n} clients, {duration}s")
+                        entry: dict[str, Any] = {"workload": workload, "target": target, "clients": n, "host": host, "port": port}
+                        try:
+                            entry.update(bench.run(host, port, n, duration, select_only, Path(tmp), f"{workload}_{target}_{n}"))
+                        except (RuntimeError, OSError, subprocess.TimeoutExpired) as e:
+                            entry["error"] = str(e)
+                        runs.append(entry)
+
+        now = datetime.now()
+        facts = HostFacts.detect()
+        result = {
+            "id": now.strftime("%Y%m%d_%H%M%S"),
+            "time": now.isoformat(timespec="seconds"),
+            "cluster": self.config.cluster_name,
+            "leader": leader.node,
+            "scale": scale,
+            "duration": duration,
+            "host": {"cpus": facts.cpus, "mem_bytes": facts.mem_bytes},
+            # Fingerprints of the live configs, to tie a regression to a config change
+            "config": {
+                "haproxy_cfg": AppliedConfigState._file_fingerprint(HAPROXY_CONFIG),
+                "patroni_yml": AppliedConfigState._file_fingerprint(f"{PATRONI_CONFIG_DIR}/patroni.yml"),
+            },
+            "runs": runs,
+        }
+        comparison = self._compare_benchmarks(result, self._load_previous_benchmark(scale))
+        result["comparison"] = comparison
+        os.makedirs(self.config.bench_results_dir, exist_ok=True)
+        path = os.path.join(self.config.bench_results_dir, f"bench_{result['id']}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        if json_output:
+            print(json.dumps(result, indent=2))
+        else:
+            print()
+            self._print_benchmark(result, comparison)
+            print()
+            print(Colors.success(f"Results saved to {path}"))
+        ok = all(not r.get("error") for r in runs)
+        return 0 if ok and not any(c["regression"] for c in comparison["vs_previous"]) else 1
+
+    def benchmark_menu(self) -> None:
+        print(Colors.header("\n=== Benchmark (pgbench) ===\n"))
+        try:
+            scale = int(input(f"Scale factor [{self.config.bench_scale}]: ").strip() or self.config.bench_scale)
+            duration = int(input(f"Seconds per run [{self.config.bench_duration}]: ").strip() or self.config.bench_duration)
+            raw = input(f"Client counts [{','.join(map(str, self.config.bench_clients))}]: ").strip()
+            clients = [int(x) for x in raw.split(",") if x.strip()] if raw else None
+        except ValueError:
+            print(Colors.warn("Not a number."))
+            return
+        n_clients = len(clients or self.config.bench_clients)
+        print(Colors.info(f"About {n_clients * 5 * duration // 60 + 1} minutes (2 workloads x {n_clients} client counts x 2-3 targets)."))
+        self.run_benchmark(scale, duration, clients)
+
+    def _rest_leader(self, pool: HTTPConnectionPool) -> Optional[str]:
+        """
+        Leader name from the first member whose /cluster answers; None when no member
+        answers or the cluster has no leader (e.g. mid-switchover), so watchers skip the gap.
+        """
+        for _, ip in self._patroni_members():
+            try:
+                status, data = pool.get_json(ip, 8008, "/cluster")
+            except (OSError, http.client.HTTPException):
+                continue
+            if status == 200 and isinstance(data, dict):
+                for m in data.get("members") or []:
+                    if m.get("role") in ("leader", "master", "primary", "standby_leader"):
+                        return str(m.get("name"))
+                return None
+        return None
+
+    def _haproxy_write_servers(self, client: HAProxyRuntimeClient) -> tuple[str, ...]:
+        return tuple(sorted(
+            r.server for r in client.server_stats("pg_write") if r.status.startswith("UP")
+        ))
+
+    def _wait_failover_ready(self, timeout: float = 180.0) -> Optional[tuple[MemberHealth, MemberHealth]]:
+        """Wait for a leader and a running replica; returns (leader, least-lagging replica)."""
+        deadline = time.monotonic() + timeout
+        while True:
+            members = self.collect_cluster_health()
+            leader = next((m for m in members if m.is_leader and m.reachable), None)
+            replicas = [m for m in members if not m.is_leader and m.reachable and m.healthy
+                        and m.state in ("running", "streaming")]
+            if leader is not None and replicas:
+                return leader, min(replicas, key=lambda m: m.lag or 0)
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(2)
+
+    def run_failover_benchmark(self, trials: int = 3, json_output: bool = False) -> int:
+        """
+        Measured failovers: a write probe runs through HAProxy while Patroni fails
+        over to the least-lagging replica; each trial records the last write
+        before the outage, the REST leader change, the HAProxy pg_write flip and
+        the first write after, and the downtime distribution is reported.
+        """
+        say = (lambda msg: logger.info("%s", msg)) if json_output else (lambda msg: print(msg))
+        ready = self._wait_failover_ready(timeout=30)
+        if ready is None:
+            print(Colors.fail("Need a reachable leader and at least one running replica."))
+            return 1
+        db_port, bin_dir, _, superuser_name = self._patroni_layout()
+        if self.config.dry_run:
+            print(Colors.info(f"[DRY-RUN] Would run {trials} measured failover(s), probing writes via "
+                              f"{self._haproxy_host()}:{self.config.haproxy_port}"))
+            return 0
+        self._psql(ready[0].host, f"CREATE TABLE IF NOT EXISTS {WriteProbe.TABLE} (id int PRIMARY KEY, at timestamptz)")
+        psql = os.path.join(bin_dir, "psql")
+        probe = WriteProbe(
+            self._haproxy_host(), self.config.haproxy_port, superuser_name, self.config.postgres_password,
+            psql=psql if os.path.exists(psql) else "psql",
+        )
+        say(f"Write probe: {probe.driver} via {probe.host}:{probe.port} every {probe.interval * 1000:.0f} ms")
+        pool = HTTPConnectionPool(timeout=0.5)
+        leader_watch = ChangeWatcher(lambda: self._rest_leader(pool), name="leader-watch")
+        haproxy = HAProxyRuntimeClient()
+        hap_watch = None
+        if os.path.exists(haproxy.socket_path):
+            hap_watch = ChangeWatcher(lambda: self._haproxy_write_servers(haproxy), name="haproxy-watch")
+        else:
+            say(Colors.warn(f"{haproxy.socket_path} not found: HAProxy flip times are not recorded (run on the HAProxy node)"))
+
+        results: list[FailoverTrial] = []
+        try:
+            for i in range(1, trials + 1):
+                ready = ready if i == 1 else self._wait_failover_ready()
+                if ready is None:
+                    say(Colors.fail("Cluster did not become ready for the next trial; stopping."))
+                    break
+                leader, candidate = ready
+                trial = FailoverTrial(trial=i, old_leader=leader.node, candidate=candidate.node)
+                say(f"Trial {i}/{trials}: {leader.node} -> {candidate.node}")
+                probe.start()
+                leader_watch.start()
+                if hap_watch:
+                    hap_watch.start()
+                time.sleep(2)  # steady state before the trigger
+                old = leader.node
+
+                def new_leader(v: Any) -> bool:
+                    return bool(v) and v != old
+
+                def flipped(up: Any) -> bool:
+                    # The UP set first empties (old leader DOWN); the flip is a new server coming UP
+                    return any(s != old for s in up)
+
+                t0 = time.monotonic()
+                r = self._run_cmd([
+                    "patronictl", "-c", f"{PATRONI_CONFIG_DIR}/patroni.yml",
+                    "failover", self.config.cluster_name, "--candidate", candidate.node, "--force",
+                ], timeout=30, check=False)
+                if r.returncode != 0:
+                    trial.error = (r.stderr or r.stdout or "patronictl failover failed").strip()[-200:]
+                deadline = t0 + 60
+                while time.monotonic() < deadline and not trial.error:
+                    changed = leader_watch.first_match_after(t0, new_leader)
+                    # A write that completes after the new leader appeared went to the new leader
+                    if changed and any(ok and t > changed[0] for t, ok in probe.events):
+                        break
+                    time.sleep(0.1)
+                time.sleep(0.5)
+                probe.stop()
+                leader_watch.stop()
+                if hap_watch:
+                    hap_watch.stop()
+                FailoverTrial.analyze(trial, t0, probe.events)
+                change = leader_watch.first_match_after(t0, new_leader)
+                if change:
+                    trial.leader_change_ms = (change[0] - t0) * 1000
+                    trial.new_leader = change[1]
+                if hap_watch:
+                    flip = hap_watch.first_match_after(t0, flipped)
+                    if flip:
+                        trial.haproxy_flip_ms = (flip[0] - t0) * 1000
+                if trial.first_write_ok_ms is None and not trial.error:
+                    trial.error = "writes did not recover within 60s"
+                results.append(trial)
+                say(f"  downtime {trial.downtime_ms:.0f} ms" if trial.downtime_ms is not None else f"  {trial.error}")
+                if i < trials:
+                    time.sleep(self.config.failover_trial_pause)
+        except KeyboardInterrupt:
+            say("Interrupted.")
+        finally:
+            probe.stop()
+            leader_watch.stop()
+            if hap_watch:
+                hap_watch.stop()
+            pool.close()
+
+        downtimes = [t.downtime_ms for t in results if t.downtime_ms is not None]
+        summary = {
+            "trials": len(results),
+            "measured": len(downtimes),
+            "min_ms": round(min(downtimes), 1) if downtimes else None,
+            "p50_ms": round(percentile(downtimes, 50), 1) if downtimes else None,
+            "p95_ms": round(percentile(downtimes, 95), 1) if downtimes else None,
+            "max_ms": round(max(downtimes), 1) if downtimes else None,
+            "mean_ms": round(sum(downtimes) / len(downtimes), 1) if downtimes else None,
+        }
+        now = datetime.now()
+        report = {
+            "id": now.strftime("%Y%m%d_%H%M%S"),
+            "time": now.isoformat(timespec="seconds"),
+            "cluster": self.config.cluster_name,
+            "probe": {"driver": probe.driver, "target": f"{probe.host}:{probe.port}", "interval_ms": probe.interval * 1000},
+            "summary": summary,
+            "trials": [t.to_dict() for t in results],
+        }
+        os.makedirs(self.config.bench_results_dir, exist_ok=True)
+        path = os.path.join(self.config.bench_results_dir, f"failover_{report['id']}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        if json_output:
+            print(json.dumps(report, indent=2))
+        else:
+            def fmt(v: Optional[float]) -> str:
+                return f"{v:.0f}" if v is not None else "-"
+
+            print()
+            print(f"{'TRIAL':>5} {'FROM':<10} {'TO':<10} {'LAST OK':>8} {'LEADER':>8} {'HAPROXY':>8} {'FIRST OK':>9} {'DOWNTIME':>9} {'FAILED':>6}")
+            for t in results:
+                print(f"{t.trial:>5} {t.old_leader:<10} {(t.new_leader or '-'):<10} {fmt(t.last_write_ok_ms):>8} "
+                      f"{fmt(t.leader_change_ms):>8} {fmt(t.haproxy_flip_ms):>8} {fmt(t.first_write_ok_ms):>9} "
+                      f"{fmt(t.downtime_ms):>9} {t.failed_writes:>6}" + (f"  {t.error}" if t.error else ""))
+            print("(times in ms relative to the failover trigger)")
+            if downtimes:
+                print(f"\nDowntime over {len(downtimes)} trial(s): min {summary['min_ms']:.0f} / p50 {summary['p50_ms']:.0f} / "
+                      f"p95 {summary['p95_ms']:.0f} / max {summary['max_ms']:.0f} ms (mean {summary['mean_ms']:.0f})")
+            print(Colors.success(f"Results saved to {path}"))
+        return 0 if results and len(downtimes) == len(results) else 1
+
+    def rank_switchover_candidates(self, members: list[MemberHealth]) -> list[MemberHealth]:
+        """
+        Running replicas on the leader's timeline first, then by lag (unknown last).
+        Unreachable or unhealthy members are never candidates.
+        """
+        leader = next((m for m in members if m.is_leader and m.reachable), None)
+        timeline = leader.timeline if leader else None
+        replicas = [
+            m for m in members
+            if not m.is_leader and m.reachable and m.healthy and m.state in ("running", "streaming")
+        ]
+        return sorted(replicas, key=lambda m: (
+            m.timeline != timeline,
+            m.lag if m.lag is not None else float("inf"),
+            m.node,
+        ))
+
+    def planned_switchover(self, candidate: Optional[str] = None, json_output: bool = False) -> int:
+        """
+        Lag-aware planned switchover:
+        1. rank replicas by timeline and lag from Patroni REST and pick the best (or candidate);
+        2. wait until its lag is <= switchover_max_lag (no change is made if it never catches up);
+        3. drain the leader in HAProxy pg_write, wait up to switchover_drain_timeout for
+           sessions to finish, then close the rest;
+        4. POST /switchover to the leader and watch /cluster for the new leader;
+        5. force the new leader's HAProxy health up (no waiting for `rise` checks) and
+           hand the old leader back to its health checks.
+        Returns 0 on success.
+        """
+        say = (lambda msg: logger.info("%s", msg)) if json_output else (lambda msg: print(msg))
+        collector = PatroniHealthCollector(self._patroni_members(), timeout=1.0)
+        report: dict[str, Any] = {"cluster": self.config.cluster_name, "ok": False}
+        try:
+            members = collector.collect()
+            leader = next((m for m in members if m.is_leader and m.reachable), None)
+            if leader is None:
+                print(Colors.fail("No reachable leader in Patroni REST; nothing to switch over from."))
+                return 1
+            ranked = self.rank_switchover_candidates(members)
+            if not json_output:
+                print(f"Leader: {leader.node} (timeline {leader.timeline})")
+                print("Candidates (best first):")
+                print(MemberHealth.table_header())
+                for m in ranked:
+                    print(m.format_row())
+            if candidate:
+                target = next((m for m in ranked if m.node == candidate), None)
+                if target is None:
+                    print(Colors.fail(f"{candidate} is not a running, reachable replica."))
+                    return 1
+            elif ranked:
+                target = ranked[0]
+            else:
+                print(Colors.fail("No running replica to switch over to."))
+                return 1
+            report.update(leader=leader.node, candidate=target.node, initial_lag=target.lag)
+            if self.config.dry_run:
+                print(Colors.info(f"[DRY-RUN] Would switch over {leader.node} -> {target.node} once its lag is "
+                                  f"<= {self.config.switchover_max_lag} bytes"))
+                return 0
+
+            # 2. Catch-up: nothing has been touched yet, so giving up here is harmless
+            max_lag = self.config.switchover_max_lag
+            deadline = time.monotonic() + self.config.switchover_catchup_timeout
+            lag = target.lag
+            while lag is None or lag > max_lag:
+                if time.monotonic() >= deadline:
+                    print(Colors.fail(f"{target.node} still {lag if lag is not None else 'unknown'} bytes behind after "
+                                      f"{self.config.switchover_catchup_timeout}s (switchover_max_lag {max_lag}); aborted."))
+                    report["error"] = "candidate did not catch up"
+                    if json_output:
+                        print(json.dumps(report, indent=2))
+                    return 1
+                time.sleep(0.2)
+                lag = next((m.lag for m in collector.collect() if m.node == target.node and m.reachable), None)
+            report["lag_at_switchover"] = lag
+            say(f"{target.node} is {lag} bytes behind (<= {max_lag}); switching over.")
+
+            # 3. Drain the leader's write sessions through the runtime API (no reload)
+            haproxy = HAProxyRuntimeClient()
+            use_haproxy = os.path.exists(haproxy.socket_path)
+            t_start = time.monotonic()
+            if use_haproxy:
+                haproxy.drain("pg_write", leader.node)
+                drain_deadline = t_start + self.config.switchover_drain_timeout
+                while time.monotonic() < drain_deadline:
+                    row = next((r for r in haproxy.server_stats("pg_write") if r.server == leader.node), None)
+                    if row is None or not row.scur:
+                        break
+                    time.sleep(0.05)
+                haproxy.shutdown_sessions("pg_write", leader.node)
+                report["drain_ms"] = round((time.monotonic() - t_start) * 1000, 1)
+                say(f"Drained {leader.node} in pg_write ({report['drain_ms']:.0f} ms).")
+            else:
+                say(Colors.warn(f"{haproxy.socket_path} not found: HAProxy is not drained (run on the HAProxy node)."))
+
+            # 4. Switchover through the leader's REST API while /cluster is watched for the change
+            watch_pool = HTTPConnectionPool(timeout=0.5)
+            watcher = ChangeWatcher(lambda: self._rest_leader(watch_pool), interval=0.05, name="leader-watch")
+            watcher.start()
+            post_pool = HTTPConnectionPool(timeout=self.config.switchover_catchup_timeout)
+            result: dict[str, Any] = {}
+
+            def post() -> None:
+                body = json.dumps({"leader": leader.node, "candidate": target.node}).encode("utf-8")
+                try:
+                    result["status"], data = post_pool.request(leader.host, 8008, "/switchover", method="POST", body=body)
+                    result["text"] = data.decode("utf-8", "replace").strip()
+                except (OSError, http.client.HTTPException) as e:
+                    result["status"], result["text"] = 0, str(e)
+
+            t_switch = time.monotonic()
+            poster = threading.Thread(target=post, name="switchover", daemon=True)
+            poster.start()
+            change = None
+            deadline = t_switch + self.config.switchover_catchup_timeout
+            while time.monotonic() < deadline:
+                change = watcher.first_match_after(t_switch, lambda v: v == target.node)
+                if change:
+                    break
+                if not poster.is_alive() and result.get("status") != 200:
+                    break
+                time.sleep(0.02)
+            watcher.stop()
+            watch_pool.close()
+
+            if not change:
+                poster.join(timeout=1)
+                error = result.get("text") or "leader did not change"
+                report["error"] = f"switchover failed: {error}"
+                if use_haproxy:
+                    haproxy.ready("pg_write", leader.node)
+                print(Colors.fail(f"Switchover failed ({result.get('status', '-')}): {error}"))
+                if use_haproxy:
+                    print(Colors.info(f"{leader.node} is back in pg_write."))
+                if json_output:
+                    print(json.dumps(report, indent=2))
+                return 1
+            report["leader_change_ms"] = round((change[0] - t_switch) * 1000, 1)
+
+            # 5. Route writes to the new leader now instead of after `rise` checks
+            if use_haproxy:
+                haproxy.set_health("pg_write", target.node, "up")
+                haproxy.set_health("pg_write", leader.node, "down")
+                haproxy.ready("pg_write", leader.node)
+            report["write_unavailable_ms"] = round((time.monotonic() - t_start) * 1000, 1)
+            report["ok"] = True
+            poster.join(timeout=5)
+            post_pool.close()
+        finally:
+            collector.close()
+
+        if json_output:
+            print(json.dumps(report, indent=2))
+        else:
+            print(Colors.success(
+                f"Switched over {report['leader']} -> {report['candidate']}: leader change "
+                f"{report['leader_change_ms']:.0f} ms, writes unavailable ~{report['write_unavailable_ms']:.0f} ms"
+                + ("" if use_haproxy else " (HAProxy not drained; add its rise/fastinter time)")
+            ))
+        return 0
+
+    def planned_switchover_menu(self) -> None:
+        if not self._require_root():
+            return
+        print(Colors.header("\n=== Planned Switchover (lag-aware) ===\n"))
+        try:
+            candidate = input("Candidate node (Enter for the least-lagging replica): ").strip()
+            confirm = input("Type 'yes' to switch over: ").strip().lower()
+        except EOFError:
+            return
+        if confirm != "yes":
+            print("Aborted.")
+            return
+        self.planned_switchover(candidate or None)
+
     def simulate_failover(self) -> None:
-        """Simulate failover."""
+        """Simulate failover (optionally measured: see run_failover_benchmark)."""
         if not self._require_root():
             return
         print(Colors.header("\n=== Simulate Failover ===\n"))
@@ -1428,6 +5786,16 @@ backend pg_write
         if confirm != "yes":
             print("Aborted.")
             return
+        try:
+            trials = input("Measure client-observed downtime over N trials (Enter for a single unmeasured failover): ").strip()
+        except EOFError:
+            trials = ""
+        if trials:
+            try:
+                self.run_failover_benchmark(trials=max(1, int(trials)))
+            except ValueError:
+                print(Colors.warn(f"Not a number: {trials}"))
+            return
         try:
             self._run_cmd([
                 "patronictl", "-c", f"{PATRONI_CONFIG_DIR}/patroni.yml",
@@ -1438,63 +5806,782 @@ backend pg_write
         except Exception as e:
             print(Colors.fail(f"Failover failed: {e}"))
 
-    def backup_pg_basebackup(self) -> None:
-        """Backup using pg_basebackup."""
-        print(Colors.header("\n=== Backup Using pg_basebackup ===\n"))
-        backup_dir = "/var/lib/pgsql/backups"
-        os.makedirs(backup_dir, exist_ok=True)
+    def _backup_source(self) -> tuple[str, str, str]:
+        """
+        (node, host, role) to back up from. backup_source is "replica" (least-lagging
+        running replica, else the leader), "leader", or a node name; without Patroni
+        REST the current node is used.
+        """
+        members = self.collect_cluster_health()
+        pref = self.config.backup_source
+        leader = next((m for m in members if m.is_leader and m.reachable), None)
+        if pref not in ("replica", "leader"):
+            m = next((m for m in members if m.node == pref), None)
+            if m is not None and m.reachable and m.healthy:
+                return m.node, m.host, "leader" if m.is_leader else "replica"
+            logger.warning("backup_source %s is not reachable and healthy; choosing automatically", pref)
+        if pref != "leader":
+            ranked = self.rank_switchover_candidates(members)
+            if ranked:
+                return ranked[0].node, ranked[0].host, "replica"
+            if leader is not None:
+                logger.warning("No running replica; backing up from the leader %s", leader.node)
+        if leader is not None:
+            return leader.node, leader.host, "leader"
+        return self.config.current_node, self.config.current_node_ip, "unknown"
+
+    def run_backup(self, max_rate: Optional[str] = None, json_output: bool = False, mode: Optional[str] = None) -> int:
+        """
+        Base backup from a replica (see _backup_source) with backup_compression
+        (server-side zstd by default) and optional --max-rate throttling. -P progress
+        is shown as throughput and ETA; backup_info.json in the backup directory records
+        source, options, duration and size.
+
+        mode (default backup_mode) "incremental" takes a PostgreSQL 17 incremental
+        backup against the newest catalogued backup, or a full one when there is none
+        or the chain already has backup_full_every backups. Incremental chains are
+        plain format (pg_combinebackup cannot read tar). Every backup is added to
+        the catalog and backup_retention_full is applied afterwards.
+        """
+        db_port, bin_dir, _, _ = self._patroni_layout()
+        mode = (mode or self.config.backup_mode).lower()
+        catalog = BackupCatalog(self.config.backup_dir)
+        parent = None
+        if mode == "incremental":
+            latest = catalog.latest()
+            if latest is not None and latest.get("format") == "plain" and os.path.exists(
+                os.path.join(latest["path"], "backup_manifest")
+            ):
+                try:
+                    if len(catalog.chain(latest["id"])) < max(1, self.config.backup_full_every):
+                        parent = latest
+                except ValueError as e:
+                    logger.warning("Taking a full backup: %s", e)
+        node, host, role = self._backup_source()
+        max_rate = self.config.backup_max_rate if max_rate is None else max_rate
+        fmt = "plain" if mode == "incremental" else self.config.backup_format
+        compression = PgBaseBackup.plain_compression(self.config.backup_compression) if fmt == "plain" \
+            else self.config.backup_compression
+        if compression != self.config.backup_compression:
+            logger.warning("backup_compression %s is client-side, which pg_basebackup cannot apply to plain "
+                           "format; compressing on the source with %s instead", self.config.backup_compression, compression)
+        compress = PgBaseBackup.compress_spec(compression, self.config.backup_compress_workers)
+        started = datetime.now()
+        backup_id = started.strftime("%Y%m%d_%H%M%S")
+        target = os.path.join(self.config.backup_dir, f"basebackup_{backup_id}")
+        engine = PgBaseBackup(
+            os.path.join(bin_dir, "pg_basebackup"), host, db_port, REPLICATION_USER, self.config.replication_password
+        )
+        cmd = engine.command(
+            target, fmt=fmt, compress=compress, max_rate=max_rate, label=f"pg_ha_setup {backup_id}",
+            incremental=os.path.join(parent["path"], "backup_manifest") if parent else None,
+            manifest_checksums=self.config.backup_manifest_checksums,
+        )
+        if not json_output:
+            print(f"Source: {node} ({host}, {role})")
+            print(f"Type: {'incremental on ' + parent['id'] if parent else 'full'}")
+            print(f"Format: {fmt}, compression: {compress or 'none'}, max rate: {max_rate or 'unlimited'}")
         if self.config.dry_run:
-            target = f"{backup_dir}/basebackup_YYYYMMDD_HHMMSS"
+            print(Colors.info("[DRY-RUN] Would run: " + " ".join(shlex.quote(c) for c in cmd)))
+            return 0
+        os.makedirs(self.config.backup_dir, exist_ok=True)
+        with contextlib.suppress(LookupError, OSError):
+            shutil.chown(self.config.backup_dir, "postgres", "postgres")
+
+        tty = sys.stdout.isatty() and not json_output
+        last_step = [-1]
+        seen: dict[str, BackupProgress] = {}
+
+        def show(progress: BackupProgress) -> None:
+            seen["progress"] = progress
+            if tty:
+                sys.stdout.write("\r" + progress.format())
+                sys.stdout.flush()
+            elif int(progress.percent // 10) != last_step[0]:
+                last_step[0] = int(progress.percent // 10)
+                logger.info("backup %s: %s", backup_id, progress.format())
+
+        t0 = time.monotonic()
+        try:
+            rc, output = engine.run(cmd, on_progress=show)
+        except FileNotFoundError as e:
+            rc, output = 127, str(e)
+        duration = time.monotonic() - t0
+        if tty:
+            print()
+        if rc != 0:
+            print(Colors.fail(f"pg_basebackup failed ({rc}): {output or 'no output'}"))
+            return 1
+        size = PgBaseBackup.size_of(target)
+        data_bytes = seen["progress"].total_kb * 1024 if "progress" in seen else None
+        info = {
+            "id": backup_id,
+            "path": target,
+            "type": "incremental" if parent else "full",
+            "parent": parent["id"] if parent else None,
+            "started": started.isoformat(timespec="seconds"),
+            "finished": datetime.now().isoformat(timespec="seconds"),
+            "duration_s": round(duration, 1),
+            "size_bytes": size,
+            "data_bytes": data_bytes,
+            "throughput_mb_s": round(data_bytes / 1048576 / duration, 1) if data_bytes and duration > 0 else None,
+            "compression_ratio": round(data_bytes / size, 2) if data_bytes and size else None,
+            "source": {"node": node, "host": host, "role": role},
+            "format": fmt,
+            "compression": compress or None,
+            "max_rate": max_rate or None,
+        }
+        try:
+            info.update(BackupCatalog.manifest_info(target))
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read %s/backup_manifest: %s", target, e)
+        with open(os.path.join(target, "backup_info.json"), "w", encoding="utf-8") as f:
+            json.dump(info, f, indent=2)
+        catalog.add(info)
+        info["expired"] = self._apply_backup_retention(catalog)
+        if self.config.backup_verify_after:
+            self._spawn_backup_verification(backup_id)
+        if json_output:
+            print(json.dumps(info, indent=2))
         else:
-            target = f"{backup_dir}/basebackup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        cmd = [
-            "sudo", "-u", "postgres",
-            "/usr/pgsql-17/bin/pg_basebackup",
-            "-h", self.config.current_node_ip,
-            "-D", target,
-            "-U", REPLICATION_USER,
-            "-Ft", "-z", "-Xs", "-P",
-        ]
-        print("Example (run as root or with sudo):")
-        print("  " + " ".join(cmd))
-        print("Or connect via HAProxy for leader: -h <haproxy_ip> -p", self.config.haproxy_port)
+            print(Colors.success(
+                f"Backup {target}: {size / 1073741824:.2f} GB on disk in {timedelta(seconds=int(duration))} "
+                f"({info['throughput_mb_s'] or '-'} MB/s, compression ratio {info['compression_ratio'] or '-'})"
+            ))
+        return 0
+
+    def _apply_backup_retention(self, catalog: BackupCatalog) -> list[str]:
+        """Delete chains older than the newest backup_retention_full full backups; returns their ids."""
+        expired = catalog.expired(self.config.backup_retention_full)
+        for entry in expired:
+            logger.info("Retention: removing backup %s (%s)", entry["id"], entry["path"])
+            shutil.rmtree(entry["path"], ignore_errors=True)
+        if expired:
+            catalog.remove({e["id"] for e in expired})
+        return [e["id"] for e in expired]
+
+    def _spawn_backup_verification(self, backup_id: str) -> None:
+        """Start `verify-backup` for backup_id detached, at idle CPU and I/O priority."""
+        cmd = [sys.executable, os.path.abspath(__file__)]
+        if self.config_file:
+            cmd += ["--config", os.path.abspath(self.config_file)]
+        cmd += ["verify-backup", "--backup-id", backup_id]
+        if shutil.which("ionice"):
+            cmd = ["ionice", "-c", "3"] + cmd
+        if shutil.which("nice"):
+            cmd = ["nice", "-n", "19"] + cmd
+        try:
+            subprocess.Popen(
+                cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                start_new_session=True, close_fds=True,
+            )
+            logger.info("Verifying backup %s in the background (results in verification.json, log %s)", backup_id, LOG_FILE)
+        except OSError as e:
+            logger.warning("Could not start background verification: %s", e)
+
+    def verify_backups(self, backup_ids: Optional[list[str]] = None, json_output: bool = False) -> int:
+        """
+        Verify catalogued backups (default: the newest) with BackupVerifier, running
+        up to backup_verify_workers archives/backups at once. Each backup gets a
+        verification.json (result, duration, files, bytes, errors) and its catalog
+        entry a "verified" summary. Exit code 1 if any backup fails.
+        """
+        catalog = BackupCatalog(self.config.backup_dir)
+        if backup_ids:
+            entries = [catalog.get(i) for i in backup_ids]
+            unknown = [i for i, e in zip(backup_ids, entries) if e is None]
+            if unknown:
+                print(Colors.fail(f"Unknown backup(s): {', '.join(unknown)}"))
+                return 1
+        else:
+            latest = catalog.latest()
+            entries = [latest] if latest else []
+        if not entries:
+            print(f"No catalogued backups in {self.config.backup_dir}")
+            return 0
+        _, bin_dir, _, _ = self._patroni_layout()
+        pg_verifybackup = os.path.join(bin_dir, "pg_verifybackup")
+
+        verifiers: dict[str, BackupVerifier] = {}
+        results: dict[str, dict[str, Any]] = {}
+        for e in entries:
+            try:
+                verifiers[e["id"]] = BackupVerifier(e["path"], pg_verifybackup)
+                errors = verifiers[e["id"]].manifest_errors()
+            except (OSError, ValueError) as ex:
+                errors = [f"backup_manifest: {ex}"]
+            results[e["id"]] = {"started": None, "finished": None, "files": 0, "bytes": 0,
+                                "errors": errors, "methods": set(), "seen": set()}
+        if self.config.dry_run:
+            for bid, v in verifiers.items():
+                print(Colors.info(f"[DRY-RUN] Would verify {bid}: " + ", ".join(label for label, _ in v.tasks())))
+            return 0
+
+        lock = threading.Lock()
+
+        def run(bid: str, fn: Callable[[], dict[str, Any]]) -> None:
+            started = time.monotonic()
+            out = fn()
+            with lock:
+                res = results[bid]
+                res["started"] = min(res["started"] or started, started)
+                res["files"] += out["files"]
+                res["bytes"] += out["bytes"]
+                res["errors"] += out["errors"]
+                res["methods"].add(out["method"])
+                res["seen"] |= out["seen"]
+                res["finished"] = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=max(1, self.config.backup_verify_workers), thread_name_prefix="verify") as pool:
+            futures = {
+                pool.submit(run, bid, fn): label
+                for bid, v in verifiers.items() if not results[bid]["errors"]
+                for label, fn in v.tasks()
+            }
+            for fut in futures:
+                try:
+                    fut.result()
+                except Exception as ex:  # keep verifying the rest
+                    logger.error("Verifying %s failed: %s", futures[fut], ex)
+                    bid = next(b for b, v in verifiers.items() if futures[fut].startswith(v.path))
+                    results[bid]["errors"].append(f"{futures[fut]}: {ex}")
+
+        failed = 0
+        report = []
+        for e in entries:
+            res = results[e["id"]]
+            v = verifiers.get(e["id"])
+            if v is not None and not res["errors"]:
+                res["errors"] += v.missing(res["seen"])
+            ok = not res["errors"]
+            failed += not ok
+            verification = {
+                "backup": e["id"],
+                "ok": ok,
+                "verified_at": datetime.now().isoformat(timespec="seconds"),
+                "duration_s": round(res["finished"] - res["started"], 2) if res["started"] is not None else 0.0,
+                "method": ", ".join(sorted(res["methods"])) or None,
+                "files": res["files"],
+                "bytes": res["bytes"],
+                "errors": res["errors"][:100],
+                "error_count": len(res["errors"]),
+            }
+            with contextlib.suppress(OSError):
+                with open(os.path.join(e["path"], "verification.json"), "w", encoding="utf-8") as f:
+                    json.dump(verification, f, indent=2)
+            e["verified"] = {"ok": ok, "at": verification["verified_at"], "duration_s": verification["duration_s"]}
+            if not ok:
+                logger.error("Backup %s failed verification: %s", e["id"], "; ".join(res["errors"][:3]))
+            report.append(verification)
+            if not json_output:
+                line = (f"{e['id']}: {verification['files']} files, {verification['bytes'] / 1073741824:.2f} GB "
+                        f"in {verification['duration_s']:.1f}s ({verification['method']})")
+                if ok:
+                    print(Colors.success(line))
+                else:
+                    print(Colors.fail(f"{line}: {verification['error_count']} error(s)"))
+                    for err in res["errors"][:10]:
+                        print(f"    {err}")
+        # Re-read so a backup that finished meanwhile is not dropped from the catalog
+        fresh = BackupCatalog(self.config.backup_dir)
+        for b in fresh.backups:
+            done = next((e for e in entries if e["id"] == b["id"]), None)
+            if done is not None:
+                b["verified"] = done["verified"]
+        with contextlib.suppress(OSError):
+            fresh.save()
+        if json_output:
+            print(json.dumps(report, indent=2))
+        return 1 if failed else 0
+
+    def list_backups(self, json_output: bool = False) -> int:
+        catalog = BackupCatalog(self.config.backup_dir)
+        if json_output:
+            print(json.dumps(catalog.backups, indent=2))
+            return 0
+        if not catalog.backups:
+            print(f"No catalogued backups in {self.config.backup_dir}")
+            return 0
+        print(f"{'ID':<16} {'TYPE':<11} {'PARENT':<16} {'TL':>3} {'START LSN':>12} {'END LSN':>12} {'SIZE GB':>8} {'TIME':>9}")
+        for b in sorted(catalog.backups, key=lambda b: b["id"]):
+            print(f"{b['id']:<16} {b.get('type', 'full'):<11} {(b.get('parent') or '-'):<16} {b.get('timeline') or '-':>3} "
+                  f"{b.get('start_lsn') or '-':>12} {b.get('end_lsn') or '-':>12} {b.get('size_bytes', 0) / 1073741824:8.2f} "
+                  f"{str(timedelta(seconds=int(b.get('duration_s') or 0))):>9}")
+        return 0
+
+    def restore_backup(self, backup_id: Optional[str] = None, target: Optional[str] = None, bin_dir: Optional[str] = None) -> int:
+        """
+        Rebuild a data directory from a catalogued backup (default: the newest):
+        plain-format chains through pg_combinebackup, a lone tar backup by extraction.
+        The result is owned by the database user; PostgreSQL/Patroni are not touched.
+        """
+        catalog = BackupCatalog(self.config.backup_dir)
+        entry = catalog.get(backup_id) if backup_id else catalog.latest()
+        if entry is None:
+            print(Colors.fail(f"No backup {backup_id} in {catalog.path}" if backup_id else f"No backups in {catalog.path}"))
+            return 1
+        try:
+            chain = catalog.chain(entry["id"])
+        except ValueError as e:
+            print(Colors.fail(str(e)))
+            return 1
+        target = target or os.path.join(self.config.backup_dir, f"restore_{entry['id']}")
+        if os.path.isdir(target) and os.listdir(target):
+            print(Colors.fail(f"{target} exists and is not empty"))
+            return 1
+        _, layout_bin_dir, data_dir, superuser_name = self._patroni_layout()
+        bin_dir = bin_dir or layout_bin_dir
+        print(f"Restoring {entry['id']} ({' -> '.join(b['id'] for b in chain)}) into {target}")
+        t0 = time.monotonic()
+        if all(b.get("format") == "plain" for b in chain):
+            rc = self._stream_cmd(
+                [os.path.join(bin_dir, "pg_combinebackup"), "-o", target] + [b["path"] for b in chain],
+                "restore", timeout=86400,
+            )
+        elif len(chain) == 1:
+            base = sorted(Path(entry["path"]).glob("base.tar*"))
+            wal = sorted(Path(entry["path"]).glob("pg_wal.tar*"))
+            if not base:
+                print(Colors.fail(f"No base.tar* in {entry['path']}"))
+                return 1
+            if not self.config.dry_run:
+                os.makedirs(os.path.join(target, "pg_wal"), exist_ok=True)
+            # GNU tar detects gzip/lz4/zstd compression on extraction
+            rc = self._stream_cmd(["tar", "-xf", str(base[0]), "-C", target], "restore", timeout=86400)
+            if rc == 0 and wal:
+                rc = self._stream_cmd(["tar", "-xf", str(wal[0]), "-C", os.path.join(target, "pg_wal")], "restore", timeout=86400)
+        else:
+            print(Colors.fail("Incremental chains must be plain format to combine."))
+            return 1
+        if rc != 0:
+            print(Colors.fail(f"Restore failed ({rc}); {target} is incomplete"))
+            return 1
         if not self.config.dry_run:
+            if os.geteuid() == 0:
+                self._run_cmd(["chown", "-R", f"{superuser_name}:", target], check=False)
+            os.chmod(target, 0o700)
+        print(Colors.success(f"Restored into {target} in {timedelta(seconds=int(time.monotonic() - t0))}"))
+        if os.path.abspath(target) != os.path.abspath(data_dir):
+            print(f"To use it, stop Patroni on this node and replace {data_dir} with {target}.")
+        return 0
+
+    def _seed_candidate(self, catalog: BackupCatalog, max_age_hours: float) -> Optional[list[dict[str, Any]]]:
+        """Newest restorable chain that is recent enough and has not failed verification."""
+        now = datetime.now()
+        for entry in sorted(catalog.backups, key=lambda b: b["id"], reverse=True):
             try:
-                self._run_cmd(cmd, timeout=600, check=False)
-                print(Colors.success(f"Backup directory: {target}"))
-            except Exception as e:
-                print(Colors.warn(f"pg_basebackup failed (cluster may be down or replication user not ready): {e}"))
+                age = now - datetime.strptime(entry["id"], "%Y%m%d_%H%M%S")
+            except ValueError:
+                continue
+            if age > timedelta(hours=max_age_hours):
+                break
+            try:
+                chain = catalog.chain(entry["id"])
+            except ValueError as e:
+                logger.info("Skipping %s: %s", entry["id"], e)
+                continue
+            if any((b.get("verified") or {}).get("ok") is False or not os.path.isdir(b["path"]) for b in chain):
+                logger.info("Skipping %s: failed verification or missing", entry["id"])
+                continue
+            if len(chain) > 1 and any(b.get("format") != "plain" for b in chain):
+                continue
+            return chain
+        return None
+
+    def _record_seed(self, backup_dir: str, record: dict[str, Any]) -> None:
+        path = os.path.join(backup_dir, "replica_seeds.json")
+        history: list[dict[str, Any]] = []
+        with contextlib.suppress(OSError, ValueError):
+            with open(path, "r", encoding="utf-8") as f:
+                history = json.load(f)
+        history = (history + [record])[-50:]
+        try:
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(history, f, indent=2)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning("Could not record seed in %s: %s", path, e)
+
+    @staticmethod
+    def _leader_has_wal(connstring: str, start_lsn: str, bin_dir: Optional[str] = None) -> Optional[bool]:
+        """
+        Whether the leader's pg_wal still holds the segment containing start_lsn (on any
+        timeline), so a replica restored from the backup can stream from there. None when
+        the leader cannot be asked; pg_ls_waldir() needs superuser or pg_monitor.
+        """
+        psql = os.path.join(bin_dir or "", "psql")
+        sql = (
+            "SELECT EXISTS (SELECT 1 FROM pg_ls_waldir() WHERE name ~ '^[0-9A-F]{24}$' "
+            f"AND substr(name, 9) = substr(pg_walfile_name({sql_literal(start_lsn)}::pg_lsn + 1), 9))"
+        )
+        try:
+            r = subprocess.run(
+                [psql if bin_dir and os.path.exists(psql) else "psql", "-d", connstring, "-XAtq",
+                 "-v", "ON_ERROR_STOP=1", "-c", sql],
+                capture_output=True, text=True, timeout=30, env=dict(os.environ, PGCONNECT_TIMEOUT="5"),
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.warning("seed-replica: WAL check on the leader failed: %s", e)
+            return None
+        if r.returncode != 0:
+            logger.warning("seed-replica: WAL check on the leader failed: %s", (r.stderr or r.stdout).strip())
+            return None
+        return r.stdout.strip() == "t"
+
+    def seed_replica(self, datadir: str, backup_dir: Optional[str] = None, max_age_hours: Optional[float] = None,
+                     bin_dir: Optional[str] = None, connstring: Optional[str] = None) -> int:
+        """
+        Patroni localbackup create-replica method: restore the newest usable backup
+        into datadir, after which Patroni starts the replica and it catches up by
+        streaming. A non-zero exit (no recent backup, WAL from the backup's start
+        already recycled on the leader, restore error) makes Patroni fall back to
+        pg_basebackup from the leader. Each attempt is appended to replica_seeds.json
+        in the backup directory.
+        """
+        backup_dir = backup_dir or self.config.replica_seed_backup_dir or self.config.backup_dir
+        max_age_hours = self.config.replica_seed_max_age_hours if max_age_hours is None else max_age_hours
+        self.config.backup_dir = backup_dir
+        started = datetime.now()
+        t0 = time.monotonic()
+        record: dict[str, Any] = {
+            "host": socket.gethostname(), "datadir": datadir, "started": started.isoformat(timespec="seconds"),
+            "backup": None, "ok": False,
+        }
+        chain = self._seed_candidate(BackupCatalog(backup_dir), max_age_hours)
+        if chain is None:
+            record["error"] = f"no usable backup newer than {max_age_hours}h in {backup_dir}"
+            logger.warning("seed-replica: %s; Patroni falls back to basebackup", record["error"])
+            self._record_seed(backup_dir, record)
+            return 1
+        record["backup"] = chain[-1]["id"]
+        start_lsn = chain[-1].get("start_lsn")
+        if connstring and start_lsn:
+            # Patroni passes the leader's connection string; streaming resumes at the backup's start LSN
+            record["wal_on_leader"] = self._leader_has_wal(connstring, start_lsn, bin_dir)
+            if record["wal_on_leader"] is False:
+                record["error"] = f"WAL at {start_lsn} from backup {record['backup']} is no longer on the leader"
+                logger.warning("seed-replica: %s; Patroni falls back to basebackup", record["error"])
+                self._record_seed(backup_dir, record)
+                return 1
+        # pg_combinebackup and tar need an empty (or missing) target
+        if os.path.isdir(datadir) and not os.listdir(datadir):
+            os.rmdir(datadir)
+        rc = self.restore_backup(chain[-1]["id"], datadir, bin_dir=bin_dir)
+        record["restore_s"] = round(time.monotonic() - t0, 1)
+        if rc != 0:
+            record["error"] = "restore failed"
+            # Leave an empty data directory for the basebackup fallback
+            shutil.rmtree(datadir, ignore_errors=True)
+        else:
+            record["ok"] = True
+            logger.info("seed-replica: restored %s into %s in %ss; streaming from the leader next",
+                        record["backup"], datadir, record["restore_s"])
+        self._record_seed(backup_dir, record)
+        return 0 if record["ok"] else 1
+
+    def rebuild_replica(self, member: str, json_output: bool = False) -> int:
+        """
+        `patronictl reinit` a replica and time it until it streams again. With
+        replica_seed_from_backup the restore part comes from replica_seeds.json, which
+        the member writes into its backup directory; when that is not shared with this
+        host the method is reported as unknown.
+        """
+        started = datetime.now()
+        if self.config.dry_run:
+            print(Colors.info(f"[DRY-RUN] Would reinit {member} and wait for it to stream"))
+            return 0
+        r = self._run_cmd([
+            "patronictl", "-c", f"{PATRONI_CONFIG_DIR}/patroni.yml", "reinit", self.config.cluster_name, member, "--force",
+        ], timeout=60, check=False)
+        if r.returncode != 0:
+            print(Colors.fail(f"patronictl reinit failed: {(r.stderr or r.stdout).strip()[-300:]}"))
+            return 1
+        t0 = time.monotonic()
+        deadline = t0 + self.config.replica_rebuild_timeout
+        collector = PatroniHealthCollector(self._patroni_members())
+        state = ""
+        try:
+            time.sleep(5)  # let Patroni stop PostgreSQL and start the create-replica method
+            while time.monotonic() < deadline:
+                m = next((m for m in collector.collect() if m.node == member), None)
+                current = m.state if m is not None and m.reachable else "unreachable"
+                if current != state:
+                    state = current
+                    if not json_output:
+                        print(f"  {timedelta(seconds=int(time.monotonic() - t0))}  {member}: {state}")
+                if m is not None and m.healthy and state in ("streaming", "running") and m.lag is not None \
+                        and m.lag <= self.config.maximum_lag_on_failover:
+                    break
+                time.sleep(5)
+            else:
+                print(Colors.fail(f"{member} did not catch up within {self.config.replica_rebuild_timeout}s"))
+                return 1
+        finally:
+            collector.close()
+        total = time.monotonic() - t0
+        seed = None
+        with contextlib.suppress(OSError, ValueError):
+            seed_dir = self.config.replica_seed_backup_dir or self.config.backup_dir
+            with open(os.path.join(seed_dir, "replica_seeds.json"), "r", encoding="utf-8") as f:
+                seed = next((s for s in reversed(json.load(f)) if s["started"] >= started.isoformat(timespec="seconds")), None)
+        if not self.config.replica_seed_from_backup:
+            method = "basebackup"
+        elif seed is None:
+            method = "unknown"  # the member's seed record is not visible from this host
+        else:
+            method = "localbackup" if seed.get("ok") else "basebackup"
+        report = {"member": member, "started": started.isoformat(timespec="seconds"), "total_s": round(total, 1),
+                  "method": method, "seed": seed}
+        if json_output:
+            print(json.dumps(report, indent=2))
+        else:
+            if method == "localbackup":
+                how = f"restored from backup {seed['backup']} in {seed['restore_s']}s, then streamed"
+            elif method == "basebackup":
+                how = "pg_basebackup from the leader"
+            else:
+                how = "method unknown: the member's replica_seeds.json is not visible from this host"
+            print(Colors.success(f"{member} rebuilt in {timedelta(seconds=int(total))} ({how})"))
+        return 0
+
+    def rebuild_replica_menu(self) -> None:
+        if not self._require_root():
+            return
+        print(Colors.header("\n=== Rebuild Replica ===\n"))
+        self.check_cluster_health()
+        try:
+            member = input("\nReplica to rebuild: ").strip()
+            confirm = input(f"Type 'yes' to wipe and rebuild {member}: ").strip().lower() if member else ""
+        except EOFError:
+            return
+        if confirm != "yes":
+            print("Aborted.")
+            return
+        self.rebuild_replica(member)
+
+    def restore_backup_menu(self) -> None:
+        print(Colors.header("\n=== Restore Backup ===\n"))
+        self.list_backups()
+        try:
+            backup_id = input("\nBackup ID (Enter for the newest): ").strip()
+            target = input("Target directory (Enter for backup_dir/restore_<id>): ").strip()
+        except EOFError:
+            return
+        self.restore_backup(backup_id or None, target or None)
+
+    def backup_pg_basebackup(self) -> None:
+        """Backup using pg_basebackup (menu 13); see run_backup."""
+        print(Colors.header("\n=== Backup Using pg_basebackup ===\n"))
+        if not self.config.dry_run and not self._require_root():
+            return
+        try:
+            mode = input(f"Backup type full/incremental (Enter for {self.config.backup_mode}): ").strip().lower()
+            max_rate = input(f"Max rate, e.g. 100M (Enter for {self.config.backup_max_rate or 'unlimited'}): ").strip()
+        except EOFError:
+            mode, max_rate = "", ""
+        if mode and mode not in ("full", "incremental"):
+            print(Colors.warn(f"Unknown backup type: {mode}"))
+            return
+        self.run_backup(max_rate=max_rate or None, mode=mode or None)
+
+    SETUP_CHECKPOINT = f"{CONFIG_DIR}/setup_checkpoint.json"
+
+    def _setup_graph(self) -> list[SetupStep]:
+        """Full-setup steps and their real dependencies."""
+        return [
+            SetupStep("validate_system_requirements", "Validate requirements", self.validate_system_requirements),
+            SetupStep("open_firewall_ports", "Open firewall ports", self._open_ports_interactive,
+                      ("validate_system_requirements",)),
+            SetupStep("install_packages", "Install packages", self.install_packages,
+                      ("validate_system_requirements",)),
+            SetupStep("configure_replication", "Configure replication", self.configure_replication),
+            SetupStep("configure_etcd", "Configure etcd", self.configure_etcd,
+                      ("install_packages", "open_firewall_ports")),
+            SetupStep("install_postgresql17", "Install PostgreSQL", self.install_postgresql17,
+                      ("install_packages",)),
+            # After Patroni: its prompt may switch on IntelliDB mode, which sets HAProxy's backend port
+            SetupStep("configure_haproxy", "Configure HAProxy", self.configure_haproxy,
+                      ("install_packages", "configure_patroni")),
+            SetupStep("configure_patroni", "Configure Patroni", self.configure_patroni,
+                      ("install_postgresql17",), exclusive=True),
+            SetupStep("configure_selinux", "Configure SELinux", self.configure_selinux,
+                      ("configure_etcd", "install_postgresql17", "configure_patroni")),
+            SetupStep("initialize_cluster", "Initialize cluster", self.initialize_cluster,
+                      ("open_firewall_ports", "configure_etcd", "configure_patroni", "configure_selinux")),
+        ]
 
     def full_automated_setup(self) -> None:
-        """Run full automated setup."""
+        """Run full automated setup as a dependency graph, resumable from a checkpoint."""
         if not self._require_root():
             return
         print(Colors.header("\n=== Full Automated Setup ===\n"))
-        steps = [
-            ("Validate requirements", self.validate_system_requirements),
-            ("Open firewall ports", self._open_ports_interactive),
-            ("Install packages", self.install_packages),
-            ("Configure etcd", self.configure_etcd),
-            ("Install PostgreSQL", self.install_postgresql17),
-            ("Configure replication", self.configure_replication),
-            ("Configure Patroni", self.configure_patroni),
-            ("Configure HAProxy", self.configure_haproxy),
-            ("Configure SELinux", self.configure_selinux),
-            ("Initialize cluster", self.initialize_cluster),
-        ]
-        for name, fn in steps:
-            print(f"\n--- {name} ---")
+        scheduler = StepScheduler(
+            self._setup_graph(),
+            max_workers=self.config.setup_parallelism,
+            checkpoint_path=None if self.config.dry_run else self.SETUP_CHECKPOINT,
+        )
+        resume = False
+        ckpt = scheduler.load_checkpoint()
+        if ckpt:
+            done = ", ".join(ckpt.get("completed") or {}) or "none"
+            print(Colors.info(f"Checkpoint from {ckpt.get('updated', '?')}: completed {done}"))
             try:
-                fn()
-            except Exception as e:
-                print(Colors.fail(f"Step failed: {e}"))
-                try:
-                    reply = input("Continue? [y/N]: ").strip().lower()
-                except EOFError:
-                    reply = "n"
-                if reply != "y":
-                    break
-        print(Colors.success("\nAutomated setup complete. Verify with 'Check Cluster Health'."))
+                reply = input("Resume from checkpoint? [Y/n]: ").strip().lower()
+            except EOFError:
+                reply = "y"
+            resume = reply != "n"
+        ok = scheduler.run(resume=resume)
+        scheduler.report()
+        if ok:
+            print(Colors.success("\nAutomated setup complete. Verify with 'Check Cluster Health'."))
+        else:
+            print(Colors.fail("\nAutomated setup incomplete. Fix the failed step and re-run option 14 to resume."))
+
+    # -------------------------------------------------------------------------
+    # Fleet Mode
+    # -------------------------------------------------------------------------
+
+    def select_node(self, node: str) -> None:
+        """Act as the given etcd node (sets current_node / current_node_ip)."""
+        if node not in self.config.etcd_nodes:
+            raise ValueError(f"Unknown node '{node}'; expected one of {self.config.etcd_nodes}")
+        self.config.current_node = node
+        self.config.current_node_ip = self.config.etcd_ips[self.config.etcd_nodes.index(node)]
+
+    def run_step(self, step: str) -> int:
+        """Run one named setup step non-interactively on this node. Returns exit code."""
+        methods = {name: method for name, method, _ in self.FLEET_STEPS}
+        if step not in methods:
+            print(Colors.fail(f"Unknown step '{step}'. Valid: {', '.join(methods)}"))
+            return 2
+        if not self._require_root():
+            return 1
+        self.interactive = False
+        try:
+            getattr(self, methods[step])()
+        except Exception as e:
+            print(Colors.fail(f"Step {step} failed: {e}"))
+            logger.exception("Step %s failed", step)
+            return 1
+        return 0
+
+    def _fleet_transport(self, transport: Optional[str] = None) -> FleetTransport:
+        kind = transport or self.config.fleet_transport
+        if kind == "local":
+            return LocalTransport(self.config, self.config_file)
+        if kind == "ssh":
+            return SSHTransport(self.config)
+        raise ValueError(f"Unknown fleet transport '{kind}' (use ssh or local)")
+
+    def _run_fleet_barrier(self, barrier: str) -> bool:
+        print(Colors.info(f"Barrier: waiting for {barrier} on all nodes..."))
+        if self.config.dry_run:
+            print(Colors.info("[DRY-RUN] Barrier skipped."))
+            return True
+        if barrier == "etcd_quorum":
+            t0 = time.monotonic()
+            ok = wait_for_etcd_quorum(self.config.etcd_ips)
+            if ok:
+                print(Colors.success(f"All etcd members healthy ({time.monotonic() - t0:.1f}s)."))
+            else:
+                print(Colors.fail("etcd quorum not reached; not starting Patroni anywhere."))
+            return ok
+        raise ValueError(f"Unknown barrier '{barrier}'")
+
+    def run_fleet(
+        self,
+        steps: Optional[list[str]] = None,
+        transport: Optional[str] = None,
+        json_output: bool = False,
+    ) -> int:
+        """
+        Run setup steps on every node in parallel, step by step.
+
+        A step starts on all its nodes at once; the next step only starts when
+        it succeeded everywhere, so nodes never drift apart. Returns exit code.
+        """
+        plan = [s for s in self.FLEET_STEPS if steps is None or s[0] in steps]
+        unknown = set(steps or []) - {s[0] for s in self.FLEET_STEPS}
+        if unknown:
+            print(Colors.fail(f"Unknown step(s): {', '.join(sorted(unknown))}"))
+            return 2
+        tp = self._fleet_transport(transport)
+        nodes = list(zip(self.config.etcd_nodes, self.config.etcd_ips))
+        # With --json, progress goes to stderr and only the summary to stdout
+        progress = contextlib.redirect_stdout(sys.stderr) if json_output else contextlib.nullcontext()
+        with progress:
+            results, failed, total = self._run_fleet_plan(plan, tp, nodes)
+        if json_output:
+            print(json.dumps({"ok": not failed, "duration_s": round(total, 3), "results": [r.to_dict() for r in results]}, indent=2))
+        return 1 if failed else 0
+
+    def _run_fleet_plan(
+        self,
+        plan: list[tuple[str, str, str]],
+        tp: FleetTransport,
+        nodes: list[tuple[str, str]],
+    ) -> tuple[list[FleetResult], bool, float]:
+        print(Colors.header(f"\n=== Fleet Run ({tp.name}) on {', '.join(n for n, _ in nodes)} ===\n"))
+        if not self.config.replication_password or not self.config.postgres_password:
+            if any(step == "configure_patroni" for step, _, _ in plan) and not self.config.dry_run:
+                print(Colors.fail("Set replication_password and postgres_password in the config: remote steps cannot prompt."))
+                return [], True, 0.0
+            print(Colors.warn("Passwords are not set in config; remote steps cannot prompt."))
+
+        results: list[FleetResult] = []
+        t_start = time.monotonic()
+        failed = False
+        for step, _, scope in plan:
+            barrier = self.FLEET_BARRIERS.get(step)
+            if barrier and not self._run_fleet_barrier(barrier):
+                failed = True
+                break
+            targets = nodes[:1] if scope == "first" else nodes
+            print(f"--- {step} on {', '.join(n for n, _ in targets)} ---")
+            with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+                futures = [
+                    pool.submit(tp.run, n, ip, step, self.config.fleet_step_timeout)
+                    for n, ip in targets
+                ]
+                step_results = [f.result() for f in futures]
+            results.extend(step_results)
+            for r in step_results:
+                logger.debug("fleet %s on %s:\n%s", step, r.node, r.output)
+                status = Colors.success("OK") if r.ok else Colors.fail(f"FAIL (rc={r.returncode})")
+                print(f"  {r.node:<12} {status}  {r.duration:.1f}s")
+                if not r.ok:
+                    for line in r.output.strip().splitlines()[-10:]:
+                        print(f"    {line}")
+            if not all(r.ok for r in step_results):
+                failed = True
+                break
+
+        total = time.monotonic() - t_start
+        if failed:
+            print(Colors.fail(f"\nFleet run stopped after {total:.1f}s; fix the failing node and re-run from that step (--step)."))
+        else:
+            print(Colors.success(f"\nFleet run complete in {total:.1f}s."))
+        return results, failed, total
+
+    def fleet_setup_menu(self) -> None:
+        """Interactive fleet run of menu steps 2-10 on all nodes."""
+        print(Colors.header("\n=== Fleet Setup (all nodes in parallel) ===\n"))
+        for step, _, scope in self.FLEET_STEPS:
+            barrier = self.FLEET_BARRIERS.get(step)
+            if barrier:
+                print(f"  [barrier: {barrier}]")
+            print(f"  {step}" + ("  (first node only)" if scope == "first" else ""))
+        print(f"\nNodes: {', '.join(f'{n} ({ip})' for n, ip in zip(self.config.etcd_nodes, self.config.etcd_ips))}")
+        print(f"Transport: {self.config.fleet_transport} (remote dir {self.config.fleet_remote_dir})")
+        try:
+            confirm = input("Run on all nodes? [y/N]: ").strip().lower()
+        except EOFError:
+            confirm = "n"
+        if confirm != "y":
+            print("Aborted.")
+            return
+        self.run_fleet()
 
     def uninstall_ha_stack(self) -> None:
         """Uninstall HA stack."""
@@ -1607,12 +6694,19 @@ backend pg_write
             print("  16. Security Hardening (Info)")
             print("  17. Enable TLS (Self-Signed Certs)")
             print("  18. Fix etcd for Patroni (3.5.x + reset data)")
-            print("  19. Exit")
+            print("  19. Fleet Setup (all nodes in parallel)")
+            print("  20. Replication Lag Sampler")
+            print("  21. HAProxy Runtime (drain / maint / weight, no reload)")
+            print("  22. Benchmark (pgbench: direct vs HAProxy)")
+            print("  23. Planned Switchover (lag-aware, drains HAProxy)")
+            print("  24. Restore Backup (pg_combinebackup)")
+            print("  25. Rebuild Replica (seed from backup)")
+            print("  26. Exit")
             print()
             try:
-                choice = input("Select option [1-19]: ").strip()
+                choice = input("Select option [1-26]: ").strip()
             except EOFError:
-                choice = "19"
+                choice = "26"
 
             if choice == "1":
                 self._run_safe("Validate System Requirements", self.validate_system_requirements)
@@ -1635,7 +6729,7 @@ backend pg_write
             elif choice == "10":
                 self._run_safe("Initialize Cluster", self.initialize_cluster)
             elif choice == "11":
-                self._run_safe("Check Cluster Health", self.check_cluster_health)
+                self._run_safe("Check Cluster Health", self._check_cluster_health_interactive)
             elif choice == "12":
                 self._run_safe("Simulate Failover", self.simulate_failover)
             elif choice == "13":
@@ -1651,6 +6745,20 @@ backend pg_write
             elif choice == "18":
                 self._run_safe("Fix etcd for Patroni (3.5.x + reset data)", self.fix_etcd_for_patroni)
             elif choice == "19":
+                self._run_safe("Fleet Setup", self.fleet_setup_menu)
+            elif choice == "20":
+                self._run_safe("Replication Lag Sampler", self.lag_sampler_menu)
+            elif choice == "21":
+                self._run_safe("HAProxy Runtime", self.haproxy_runtime_menu)
+            elif choice == "22":
+                self._run_safe("Benchmark", self.benchmark_menu)
+            elif choice == "23":
+                self._run_safe("Planned Switchover", self.planned_switchover_menu)
+            elif choice == "24":
+                self._run_safe("Restore Backup", self.restore_backup_menu)
+            elif choice == "25":
+                self._run_safe("Rebuild Replica", self.rebuild_replica_menu)
+            elif choice == "26":
                 print("Exiting.")
                 break
             else:
@@ -1666,15 +6774,58 @@ def main() -> None:
         formatter_class=argparse.RawDescriptionHelpFormatter,
         epilog="Log file: %s" % LOG_FILE,
     )
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=["backup", "backups", "benchmark", "connectivity", "failover-bench", "fleet", "health", "lag-sample", "rebuild-replica", "restore", "seed-replica", "serve-metrics", "step", "switchover", "verify-backup"],
+        help="Run a single non-interactive command instead of the menu",
+    )
     parser.add_argument("--config", "-c", help="YAML configuration file path")
     parser.add_argument("--dry-run", action="store_true", help="Simulate without making changes")
     parser.add_argument("--non-interactive", action="store_true", help="Use with --config; run validation and port menu only")
+    parser.add_argument("--json", action="store_true", help="Machine-readable JSON output for commands")
+    parser.add_argument("--node", help="Act as this etcd node (sets current_node/current_node_ip)")
+    parser.add_argument("--step", help="Step name for 'step', or comma-separated steps for 'fleet'")
+    parser.add_argument("--watch", type=float, metavar="SECONDS", help="With 'health': poll every SECONDS until Ctrl+C")
+    parser.add_argument("--duration", type=float, metavar="SECONDS", help="'lag-sample': how long to sample (default 60); 'benchmark': seconds per run")
+    parser.add_argument("--interval", type=float, default=1.0, metavar="SECONDS", help="With 'lag-sample': seconds between samples (default 1)")
+    parser.add_argument("--output", "-o", metavar="PATH", help="With 'lag-sample': write the series to PATH (.csv or .json)")
+    parser.add_argument("--scale", type=int, help="With 'benchmark': pgbench scale factor (default bench_scale)")
+    parser.add_argument("--clients", help="With 'benchmark': comma-separated client counts (default bench_clients)")
+    parser.add_argument("--max-rate", help="With 'backup': pg_basebackup --max-rate, e.g. 100M (default: backup_max_rate)")
+    parser.add_argument("--full", action="store_true", help="With 'backup': full backup regardless of backup_mode")
+    parser.add_argument("--incremental", action="store_true", help="With 'backup': incremental backup (PostgreSQL 17)")
+    parser.add_argument("--backup-id", action="append", help="With 'restore': backup to restore (default: newest). "
+                        "With 'verify-backup': backup to verify (repeatable; default: newest)")
+    parser.add_argument("--all", action="store_true", help="With 'verify-backup': verify every catalogued backup")
+    parser.add_argument("--target", help="With 'restore': output directory (default: backup_dir/restore_<id>)")
+    parser.add_argument("--datadir", help="With 'seed-replica' (run by Patroni): data directory to create")
+    parser.add_argument("--backup-dir", help="With 'seed-replica': backup directory (default: replica_seed_backup_dir)")
+    parser.add_argument("--max-age-hours", type=float, help="With 'seed-replica': newest usable backup age limit")
+    parser.add_argument("--bin-dir", help="With 'seed-replica': PostgreSQL binaries (pg_combinebackup)")
+    parser.add_argument("--connstring", help="With 'seed-replica' (passed by Patroni): leader connection string, "
+                        "used to check that the backup's WAL is still on the leader")
+    parser.add_argument("--member", help="With 'rebuild-replica': Patroni member to reinitialize")
+    parser.add_argument("--candidate", help="With 'switchover': target replica (default: least-lagging on the leader's timeline)")
+    parser.add_argument("--trials", type=int, default=3, help="With 'failover-bench': number of measured failovers (default 3)")
+    parser.add_argument("--transport", choices=["ssh", "local"], help="Fleet transport (default: fleet_transport)")
     parser.add_argument("--version", "-v", action="version", version="%(prog)s " + __version__)
-    args = parser.parse_args()
+    # Patroni appends --scope/--role to create-replica commands
+    args, unknown = parser.parse_known_args()
+    if unknown and args.command != "seed-replica":
+        parser.error(f"unrecognized arguments: {' '.join(unknown)}")
+
+    if args.json:
+        # Keep stdout parseable: console log lines go to stderr
+        for h in logger.handlers:
+            if getattr(h, "stream", None) is sys.stdout:
+                h.setStream(sys.stderr)
 
     config = HAConfig(dry_run=args.dry_run)
     try:
         app = PGHASetup(config=config, config_file=args.config)
+        if args.node:
+            app.select_node(args.node)
     except FileNotFoundError as e:
         print(Colors.fail(str(e)))
         sys.exit(1)
@@ -1683,7 +6834,51 @@ def main() -> None:
         sys.exit(1)
 
     try:
-        if args.non_interactive and args.config:
+        if args.command == "connectivity":
+            sys.exit(app.run_connectivity_check(json_output=args.json))
+        elif args.command == "health":
+            if args.watch:
+                app.watch_cluster_health(args.watch, json_output=args.json)
+                sys.exit(0)
+            sys.exit(app.run_health_check(json_output=args.json))
+        elif args.command == "serve-metrics":
+            sys.exit(app.serve_metrics())
+        elif args.command == "lag-sample":
+            sys.exit(app.run_lag_sampler(args.duration or 60.0, args.interval, output=args.output, json_output=args.json))
+        elif args.command == "backup":
+            mode = "full" if args.full else "incremental" if args.incremental else None
+            sys.exit(app.run_backup(max_rate=args.max_rate, json_output=args.json, mode=mode))
+        elif args.command == "backups":
+            sys.exit(app.list_backups(json_output=args.json))
+        elif args.command == "restore":
+            sys.exit(app.restore_backup(args.backup_id[-1] if args.backup_id else None, args.target))
+        elif args.command == "verify-backup":
+            ids = [b["id"] for b in BackupCatalog(app.config.backup_dir).backups] if args.all else args.backup_id
+            sys.exit(app.verify_backups(ids, json_output=args.json))
+        elif args.command == "seed-replica":
+            if not args.datadir:
+                parser.error("seed-replica needs --datadir (Patroni passes it)")
+            sys.exit(app.seed_replica(args.datadir, args.backup_dir, args.max_age_hours, args.bin_dir, args.connstring))
+        elif args.command == "rebuild-replica":
+            if not args.member:
+                parser.error("rebuild-replica needs --member NAME")
+            sys.exit(app.rebuild_replica(args.member, json_output=args.json))
+        elif args.command == "switchover":
+            sys.exit(app.planned_switchover(candidate=args.candidate, json_output=args.json))
+        elif args.command == "failover-bench":
+            sys.exit(app.run_failover_benchmark(trials=max(1, args.trials), json_output=args.json))
+        elif args.command == "benchmark":
+            clients = [int(x) for x in args.clients.split(",") if x.strip()] if args.clients else None
+            duration = int(args.duration) if args.duration else None
+            sys.exit(app.run_benchmark(args.scale, duration, clients, json_output=args.json))
+        elif args.command == "step":
+            if not args.step:
+                parser.error("step requires --step NAME")
+            sys.exit(app.run_step(args.step))
+        elif args.command == "fleet":
+            steps = [x.strip() for x in args.step.split(",") if x.strip()] if args.step else None
+            sys.exit(app.run_fleet(steps=steps, transport=args.transport, json_output=args.json))
+        elif args.non_interactive and args.config:
             app.validate_system_requirements()
             app.show_ports_and_firewall_menu()
         else: